@@ -6,34 +6,101 @@ Frame bias is calculated by the alignments in the bam file alone
 
 
 import pysam
-import subprocess
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
+from calculate_periodicity import write_header, write_row
+from offsets import summarise_footprints, resolve_offsets, frame_counts as footprint_frame_counts
+from read_counts import read_count, count_source, read_counter
+from region_frames import write_frame_stats, read_cds_table
+from stage_timer import stage
 
 
-def is_name_sorted(bam_path) -> bool:
+# reference slices handed out per worker process in check_bam
+SLICES_PER_WORKER = 4
+
+# reads checked when the header does not give the sort order
+SORT_SAMPLE_READS = 10000
+
+
+def sort_order(bam_path) -> str:
+    '''
+    sort order from the @HD SO: header field ('coordinate', 'queryname', 'unsorted'),
+    None if the header does not say
+    '''
+    with pysam.AlignmentFile(bam_path, 'rb', check_sq=False) as bam:
+        return bam.header.to_dict().get('HD', {}).get('SO')
+
+
+def sample_is_sorted(bam_path, key, sample_reads=SORT_SAMPLE_READS) -> bool:
     '''
-    check if a bam file is name sorted
+    check that the first sample_reads reads are in increasing key(read) order
     '''
-    bam = pysam.Samfile(bam_path, 'rb')
-    prev_read = None
-    for read in bam:
-        if prev_read:
-            if read.qname < prev_read.qname:
+    with pysam.AlignmentFile(bam_path, 'rb', check_sq=False) as bam:
+        prev_key = None
+        for i, read in enumerate(bam):
+            if i >= sample_reads:
+                break
+            if prev_key is not None and key(read) < prev_key:
                 return False
-        prev_read = read
+            prev_key = key(read)
     return True
 
 
-def sort_by_name(bam_path, num_threads=1) -> str:
+def is_name_sorted(bam_path, sample_reads=SORT_SAMPLE_READS) -> bool:
+    '''
+    check if a bam file is name sorted, from the header or, if it does not
+    say, from the first sample_reads reads
+    '''
+    order = sort_order(bam_path)
+    if order in ('queryname', 'coordinate', 'unsorted'):
+        return order == 'queryname'
+    return sample_is_sorted(bam_path, lambda read: read.query_name, sample_reads)
+
+
+def is_coordinate_sorted(bam_path, sample_reads=SORT_SAMPLE_READS) -> bool:
+    '''
+    check if a bam file is coordinate sorted, from the header or, if it does not
+    say, from the first sample_reads reads (unmapped reads sort last)
+    '''
+    order = sort_order(bam_path)
+    if order in ('queryname', 'coordinate', 'unsorted'):
+        return order == 'coordinate'
+    return sample_is_sorted(bam_path, lambda read: (read.reference_id < 0, read.reference_id, read.reference_start), sample_reads)
+
+
+def scratch_base(bam_path) -> str:
     '''
-    sort a bam file by name using samtools
+    name for files derived from bam_path in a shared directory: the input's name without
+    its extension and a hash of its absolute path, so that inputs with the same name
+    (e.g. STAR's Aligned.sortedByCoord.out.bam of several runs) never share files
     '''
-    sorted_bam_path = bam_path.replace(".bam", "_sorted.bam")
-    subprocess.call(["samtools", "sort", "-@", str(num_threads), "-n", bam_path, '-o', sorted_bam_path])
+    digest = hashlib.sha1(os.path.abspath(bam_path).encode()).hexdigest()[:12]
+    return f"{os.path.splitext(os.path.basename(bam_path))[0]}.{digest}"
+
+
+def sort_bam(bam_path, tmp_dir, num_threads=1, by_name=False) -> str:
+    '''
+    sort a bam file in process with pysam into tmp_dir, by coordinate or by name.
+    The sorted bam stays in tmp_dir for the caller. Raises pysam.SamtoolsError if sorting fails
+    '''
+    os.makedirs(tmp_dir, exist_ok=True)
+    base = scratch_base(bam_path)
+    sorted_bam_path = os.path.join(tmp_dir, base + ("_name_sorted.bam" if by_name else "_sorted.bam"))
+    arguments = ["-@", str(num_threads), "-T", os.path.join(tmp_dir, base + ".sort"), "-o", sorted_bam_path]
+    with stage('sort bam', inputs=[bam_path], outputs=[sorted_bam_path]):
+        pysam.sort(*(["-n"] if by_name else []), *arguments, bam_path)
     return sorted_bam_path
 
 
+def sort_by_name(bam_path, tmp_dir, num_threads=1) -> str:
+    '''
+    sort a bam file by name into tmp_dir
+    '''
+    return sort_bam(bam_path, tmp_dir, num_threads, by_name=True)
+
+
 def is_indexed(bam_path) -> bool:
     '''
     check if a bam.bai file exists
@@ -41,20 +108,204 @@ def is_indexed(bam_path) -> bool:
     return os.path.exists(bam_path + ".bai")
 
 
-def index_bam(bam_path) -> None:
+def index_bam(bam_path, num_threads=1) -> str:
+    '''
+    index a bam file in process with pysam. Raises pysam.SamtoolsError if indexing fails
+    '''
+    with stage('index bam', inputs=[bam_path], outputs=[bam_path + '.bai']):
+        pysam.index("-@", str(num_threads), bam_path, bam_path + ".bai")
+    return bam_path + ".bai"
+
+
+def ensure_index(bam_path, num_threads=1, tmp_dir=None) -> str:
+    '''
+    return a path to bam_path's alignments that has a .bai index next to it.
+
+    An existing index is used as it is. Otherwise the bam is sorted by coordinate
+    first if it needs to be, and indexed. With tmp_dir the sorted bam or a link to
+    the input and its index are written there rather than next to the input, which
+    is where they go without one. These are named after the input's path (see
+    scratch_base) and always indexed afresh, so an index left by another input is
+    never picked up.
+    '''
+    if is_indexed(bam_path):
+        return bam_path
+
+    if not is_coordinate_sorted(bam_path):
+        print("bam file not sorted by coordinate, sorting now...")
+        bam_path = sort_bam(bam_path, tmp_dir or os.path.dirname(os.path.abspath(bam_path)), num_threads)
+    elif tmp_dir:
+        os.makedirs(tmp_dir, exist_ok=True)
+        link = os.path.join(tmp_dir, scratch_base(bam_path) + ".bam")
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.abspath(bam_path), link)
+        bam_path = link
+
+    print("bam file not indexed, indexing now...")
+    index_bam(bam_path, num_threads)
+    return bam_path
+
+
+def mapped_reads_per_reference(bam_path) -> dict:
+    '''
+    number of mapped alignments per reference, read from the bam index
+    (the same numbers samtools idxstats reports) without touching the reads
+    '''
+    with pysam.Samfile(bam_path, 'rb') as bam:
+        return {stat.contig: stat.mapped for stat in bam.get_index_statistics()}
+
+
+def select_references(bam_path, min_reads=0) -> list:
     '''
-    index a bam file using samtools
+    references in header order with at least min_reads mapped alignments according to the index
     '''
-    subprocess.call(["samtools", "index", bam_path])
+    with pysam.Samfile(bam_path, 'rb') as bam:
+        references = list(bam.references)
+    if min_reads <= 0:
+        return references
+    mapped = mapped_reads_per_reference(bam_path)
+    return [reference for reference in references if mapped.get(reference, 0) >= min_reads]
 
 
-def check_bam(bam_path, output_path, num_threads=1, offset=15) -> str:
+def collect_footprints(bam_path, references, source='auto', counts_path=None) -> list:
+    '''
+    one pass over a slice of references recording every alignment's length, 5' end
+    and strand, summarised per reference (see offsets.summarise_footprints). Opens
+    its own pysam handle so that it can run in a worker process. source is where the
+    read counts are stored (see read_counts.count_source), 'auto' detects it.
+    counts_path is collapse's count table for the 'table' source
+
+    outputs:
+        footprints: list of (reference, table) in the order given
+    '''
+    count = read_counter(count_source(bam_path, counts_path=counts_path) if source == 'auto' else source, counts_path)
+    with pysam.Samfile(bam_path, 'rb') as bam:
+        return [(transcript, reference_footprints(bam, transcript, count)[0]) for transcript in references]
+
+
+def collect_footprints_and_frames(bam_path, references, offset=15, source='auto', counts_path=None) -> list:
+    '''
+    collect_footprints that also counts the frames of count_frames ((reference_start + offset) % 3
+    whatever the strand) in the same pass, so that periodicity.txt does not change when the
+    footprints are only needed for the frame stats
+
+    outputs:
+        list of (reference, table, {0: n, 1: n, 2: n}) in the order given
+    '''
+    count = read_counter(count_source(bam_path, counts_path=counts_path) if source == 'auto' else source, counts_path)
+    with pysam.Samfile(bam_path, 'rb') as bam:
+        return [(transcript, *reference_footprints(bam, transcript, count, offset)) for transcript in references]
+
+
+def reference_footprints(bam, transcript, count=read_count, offset=None) -> tuple:
+    '''
+    footprint table of one reference of an open bam, and its reads per frame as
+    reference_frames counts them if offset is given (else None)
+    '''
+    lengths, five_primes, reverse, counts = [], [], [], []
+    frames = {0:0, 1:0, 2:0} if offset is not None else None
+    for read in bam.fetch(transcript):
+        if read.is_unmapped:
+            continue
+        weight = count(read)
+        lengths.append(read.query_alignment_length)
+        if read.is_reverse:
+            five_primes.append(read.reference_end - 1)
+        else:
+            five_primes.append(read.reference_start)
+        reverse.append(read.is_reverse)
+        counts.append(weight)
+        if frames is not None:
+            frames[(read.reference_start + offset)%3] += weight
+    return summarise_footprints(lengths, five_primes, reverse, counts), frames
+
+
+def count_frames(bam_path, references, offset=15, source='auto', counts_path=None) -> list:
+    '''
+    count reads per frame for a slice of references. Opens its own pysam handle
+    so that it can run in a worker process
+
+    inputs:
+        bam_path: path to indexed bam file
+        references: reference names to count
+        offset: offset added to the read start before taking the frame
+        source: where the read counts are stored (see read_counts.count_source),
+            'auto' detects it. Uncollapsed alignments count 1
+        counts_path: collapse's count table for the 'table' source
+
+    outputs:
+        frame_counts: list of (reference, {0: n, 1: n, 2: n}) in the order given
+    '''
+    count = read_counter(count_source(bam_path, counts_path=counts_path) if source == 'auto' else source, counts_path)
+    with pysam.Samfile(bam_path, 'rb') as bam:
+        return [(transcript, reference_frames(bam, transcript, offset, count)) for transcript in references]
+
+
+def reference_frames(bam, transcript, offset=15, count=read_count) -> dict:
+    '''
+    {0: n, 1: n, 2: n} reads per frame of one reference of an open bam
+    '''
+    counts = {0:0, 1:0, 2:0}
+    for read in bam.fetch(transcript):
+        if read.is_unmapped:
+            continue
+        counts[(read.reference_start + offset)%3] += count(read)
+    return counts
+
+
+def split_references(references, num_slices) -> list:
+    '''
+    split references into contiguous slices, keeping their order
+    '''
+    size = max(len(references) // num_slices, 1)
+    return [references[i:i + size] for i in range(0, len(references), size)]
+
+
+def map_references(function, bam_path, references, num_threads=1, *args) -> list:
+    '''
+    run function(bam_path, slice, *args) over slices of references, in worker
+    processes when num_threads > 1, and concatenate the results in reference order
+    '''
+    if num_threads <= 1:
+        return function(bam_path, references, *args)
+
+    # several slices per worker so that a few deep references do not hold up the rest
+    slices = split_references(references, num_threads * SLICES_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=num_threads) as pool:
+        futures = [pool.submit(function, bam_path, references_slice, *args) for references_slice in slices]
+        return [pair for future in futures for pair in future.result()]
+
+
+def check_bam(bam_path, output_path, num_threads=1, offset=15, min_reads=0, report_skipped=False,
+              offsets=None, offsets_out=None, tmp_dir=None, frame_stats_out=None, frame_summary_out=None,
+              cds=None, counts_path=None) -> str:
     '''
     calculate frame bias from a bam file
 
     inputs:
         bam_path: path to bam file
-        num_threads: number of threads to use
+        output_path: path to write periodicity.txt
+        num_threads: number of worker processes. References are split into slices
+            that are counted in parallel and written back in the original order
+        offset: offset added to the read start before taking the frame
+        min_reads: only fetch references with at least this many mapped alignments
+            in the bam index. 0 fetches every reference
+        report_skipped: write references skipped by min_reads as zero rows
+        offsets: read length specific offsets, either 'auto' (inferred in the same
+            pass, see offsets.py), a path to an offset table or {read_length: offset}.
+            Lengths without an entry use offset. The a-site is taken from the 5' end
+            of the read, so reverse strand alignments are counted from reference_end
+        offsets_out: path to write the inferred offset table to (offsets='auto')
+        tmp_dir: where to sort and/or index the bam if it has no index (see ensure_index)
+        frame_stats_out: path to write frame counts by reference, read length and region
+            (5'UTR, CDS, 3'UTR; see region_frames.py) from the same pass. a-sites in these
+            tables are placed from the 5' end as with offsets, while periodicity.txt keeps
+            its frames (reference_start + offset) unless offsets are given
+        frame_summary_out: path to write the library summary of those counts
+        cds: tsv of reference, CDS start, CDS end for the regions. By default the CDS is
+            parsed from GENCODE style |CDS:start-end| reference names
+        counts_path: count table written by collapse for the reads of the bam (see read_counts.py)
 
     outputs:
         frame_counts: dictionary with frame bias for each transcript/reference
@@ -64,33 +315,48 @@ def check_bam(bam_path, output_path, num_threads=1, offset=15) -> str:
     #     print("bam file not sorted by name, sorting now...")
     #     bam_path = sort_by_name(bam_path, num_threads)
 
-    if not is_indexed(bam_path):
-        print("bam file not indexed, indexing now...")
-        index_bam(bam_path)
+    bam_path = ensure_index(bam_path, num_threads, tmp_dir)
 
-    with open(output_path, 'w') as f:
+    with pysam.Samfile(bam_path, 'rb') as bam:
+        references = list(bam.references)
 
-        # Initialize the output file
-        f.write('# Periodicity Checker\n')
-        f.write('# periodicity is calculated as the number of reads in the most abundant frame divided by the total number of reads\n')
-        f.write('contig\tframe0\tframe1\tframe2\ttotal\tperiodicity\n')
+    # skip references the index says are (nearly) empty
+    selected = select_references(bam_path, min_reads)
+    if len(selected) < len(references):
+        print(f"Skipping {len(references) - len(selected)} of {len(references)} references with fewer than {min_reads} mapped reads")
 
-        bam = pysam.Samfile(bam_path, 'rb')
+    # read counts come from the count tag, the count table, readN_xC names or count 1 (decided once for the bam)
+    source = count_source(bam_path, counts_path=counts_path)
 
-        frame_counts = {}
+    # get frame bias per transcript
+    if offsets is None and frame_stats_out is None:
+        frame_counts = dict(map_references(count_frames, bam_path, selected, num_threads, offset, source, counts_path))
+    elif offsets is None:
+        # the frame stats need the footprints, periodicity.txt keeps the count_frames frames
+        rows = map_references(collect_footprints_and_frames, bam_path, selected, num_threads, offset, source, counts_path)
+        footprints = [(transcript, table) for transcript, table, frames in rows]
+        frame_counts = {transcript: frames for transcript, table, frames in rows}
+        write_frame_stats(footprints, frame_stats_out, frame_summary_out, {}, offset,
+                          read_cds_table(cds) if cds else None)
+    else:
+        footprints = map_references(collect_footprints, bam_path, selected, num_threads, source, counts_path)
+        length_offsets = resolve_offsets(footprints, offsets, offset, offsets_out)
+        frame_counts = {
+            transcript: footprint_frame_counts(table, length_offsets, offset) for transcript, table in footprints
+        }
+        if frame_stats_out:
+            write_frame_stats(footprints, frame_stats_out, frame_summary_out, length_offsets, offset,
+                              read_cds_table(cds) if cds else None)
 
-        # get frame bias per transcript
-        for transcript in bam.references:
-            frame_counts[transcript] = {0:0, 1:0, 2:0}
-            transcript_reads = bam.fetch(transcript)
+    with open(output_path, 'w') as f:
 
-            for read in transcript_reads:
-                if read.is_unmapped:
-                    continue
-                frame_counts[transcript][(read.reference_start + offset)%3] += int(read.qname.split('_x')[1])
+        # Initialize the output file
+        write_header(f)
 
-            score = max(frame_counts[transcript].values()) / (max(sum(frame_counts[transcript].values()), 1))
-            f.write(f'{transcript}\t{frame_counts[transcript][0]}\t{frame_counts[transcript][1]}\t{frame_counts[transcript][2]}\t{frame_counts[transcript][0]+frame_counts[transcript][1]+frame_counts[transcript][2]}\t{score}\n')
-    f.close()   
+        for transcript in references:
+            if transcript in frame_counts:
+                write_row(f, transcript, frame_counts[transcript])
+            elif report_skipped:
+                write_row(f, transcript, {0:0, 1:0, 2:0})
 
-    return frame_counts
\ No newline at end of file
+    return frame_counts
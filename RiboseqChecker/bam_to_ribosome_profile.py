@@ -11,11 +11,22 @@ inputs:
 
 outputs:
 	bed: bed file with a-site positions and read counts
+	bigwig: optional bigwig file of the same profile
 
 '''
-from Bio import  SeqIO
 import pysam, os
 import argparse
+import numpy as np
+
+try:
+	import pyBigWig
+except ImportError:
+	pyBigWig = None
+
+from bam_check import mapped_reads_per_reference, collect_footprints, ensure_index
+from read_counts import read_count, count_source, read_counter
+from offsets import resolve_offsets, profile as footprint_profile
+from profile_store import write_store_entries, EXTENSION
 
 def run_weight_centered(all_reads):
 	'''
@@ -35,12 +46,13 @@ def run_weight_centered(all_reads):
 			else:
 				sequence[Asite] = 1.0/len(protect_nts[12:-12])
 
-		return sequence
+	return sequence
 
 
-def run_offset(all_reads, offset):
+def run_offset(all_reads, offset, count=read_count):
 	'''
-	calculate a-site position using provided offset. 
+	calculate a-site position using provided offset. count gives the number of
+	reads collapsed into an alignment
 	'''
 	sequence = {}
 		
@@ -48,10 +60,7 @@ def run_offset(all_reads, offset):
 		if read.qlen < 25 : continue
 
 		protect_nts = sorted(read.positions)
-		if "_x" in read.qname:
-			read_count = int(read.qname.split("_x")[1])
-		else:
-			read_count = 1
+		read_count = count(read)
 
 		if not read.is_reverse:
 			Asite = protect_nts[offset]
@@ -66,69 +75,257 @@ def run_offset(all_reads, offset):
 	return sequence
 
 
-def create_chrom_sizes(fasta_path):
+# cigar operations that consume the reference without an aligned base (deletion, skipped region)
+GAP_OPERATIONS = (2, 3)
+
+
+def is_contiguous(read):
 	'''
-	create chrom.sizes file from fasta input
+	True if the aligned reference positions of a read form one unbroken block
 	'''
+	for operation, length in read.cigartuples:
+		if operation in GAP_OPERATIONS:
+			return False
+	return True
 
-	chromSizesoutput = open(fasta_path + "_chrom.sizes","w")
 
-	records = []
-	record = False
-	for line in open(fasta_path, 'r').readlines():
-		if line[0] == '>':
-			if record:
-				records.append(record)
-			record = [line.strip("\n").split(' ')[0][1:], 0]
+def offset_array(all_reads, length, offset, count=read_count):
+	'''
+	array-backed equivalent of run_offset. A-sites are taken directly from
+	reference_start/reference_end for ungapped alignments (sorted(read.positions)
+	is only built for reads with deletions or skipped regions) and accumulated
+	in one bincount over the whole reference.
 
+	returns an integer array of read counts per reference position
+	'''
+	asites = []
+	counts = []
+	for read in all_reads:
+		if read.qlen < 25 : continue
+
+		if is_contiguous(read) and offset < read.reference_end - read.reference_start:
+			if not read.is_reverse:
+				asites.append(read.reference_start + offset)
+			else:
+				asites.append(read.reference_end - 1 - offset)
 		else:
-			sequence = line.strip('\n')
-			record[1] += len(sequence)
-			
-	for seq_record in records:
-		output_line = '%s\t%i\n' % (seq_record[0], seq_record[1])
-		chromSizesoutput.write(output_line)
+			protect_nts = sorted(read.positions)
+			asites.append(protect_nts[offset] if not read.is_reverse else protect_nts[-1 - offset])
+		counts.append(count(read))
 
-	chromSizesoutput.close()
+	if not asites:
+		return np.zeros(length, dtype=np.int64)
+	profile = np.bincount(asites, weights=counts, minlength=length)
+	return profile.astype(np.int64)
 
 
-def generate_profile(bam_path, fasta_path, mode="offset", offset=0, create_bw=False):
+def weight_centered_array(all_reads, length):
 	'''
-	create sorted bed file of a ribosome profile in two mode options
-	offset - calculate a site with an inputted estimated distance from read end. Same applied to all read lengths 
-	weight - weight centered approach is used (suitable for mnase digested reads)
+	array-backed equivalent of run_weight_centered. Each read spreads a weight of 1
+	over its aligned positions, excluding 12 nt at either end.
+
+	returns a float array of weights per reference position
 	'''
-	alignments	= pysam.Samfile(bam_path, 'rb') 
+	asites = []
+	weights = []
+	for read in all_reads:
+		if read.qlen < 25 : continue
+
+		if is_contiguous(read):
+			protect_nts = range(read.reference_start + 12, read.reference_end - 12)
+		else:
+			protect_nts = sorted(read.positions)[12:-12]
+		if not len(protect_nts):
+			continue
+		asites.extend(protect_nts)
+		weights.extend([1.0/len(protect_nts)] * len(protect_nts))
+
+	if not asites:
+		return np.zeros(length, dtype=np.float64)
+	return np.bincount(asites, weights=weights, minlength=length)
+
+
+def profile_array_entries(chrom, profile):
+	'''
+	(chrom, positions, values) for the nonzero positions of a profile array
+	'''
+	positions = np.flatnonzero(profile)
+	return chrom, positions, profile[positions]
+
+
+def profile_dict_entries(chrom, sequence):
+	'''
+	(chrom, positions, values) from a {position: value} profile dictionary
+	'''
+	positions = sorted(sequence)
+	return chrom, np.array(positions, dtype=np.int64), np.array([sequence[Asite] for Asite in positions])
+
+
+def reference_names(alignments, fasta_path=None):
+	'''
+	sorted reference names to build the profile for, without reading any sequence.
+	Taken from the fasta index (fasta_path.fai) when there is one, otherwise from the bam header
+	'''
+	if fasta_path and os.path.exists(fasta_path + ".fai"):
+		with open(fasta_path + ".fai") as fai:
+			return sorted(line.split('\t')[0] for line in fai if line.strip())
+	return sorted(alignments.references)
+
 
-	with open(fasta_path) as in_seq_handle:
-		seq_dict = SeqIO.to_dict(SeqIO.parse(in_seq_handle, "fasta"))
-		seq_dict_keys =  sorted(seq_dict.keys())
+def chrom_sizes_from_bam(alignments, chroms=None):
+	'''
+	[(chrom, length)] from the bam header, restricted to and ordered as chroms if given
+	'''
+	if chroms is None:
+		return list(zip(alignments.references, alignments.lengths))
+	return [(chrom, alignments.get_reference_length(chrom)) for chrom in chroms if alignments.get_tid(chrom) >= 0]
+
+
+def create_chrom_sizes(bam_path, chrom_sizes_path=None):
+	'''
+	create chrom.sizes file from the bam header
+	'''
+	if chrom_sizes_path is None:
+		chrom_sizes_path = bam_path + "_chrom.sizes"
+
+	with pysam.Samfile(bam_path, 'rb') as alignments, open(chrom_sizes_path, "w") as chromSizesoutput:
+		for chrom, length in chrom_sizes_from_bam(alignments):
+			chromSizesoutput.write('%s\t%i\n' % (chrom, length))
+
+	return chrom_sizes_path
+
+
+def length_offset_profiles(alignments, bam_path, chroms, offsets, offset, offsets_out=None, counts_path=None):
+	'''
+	yield (chrom, profile array) using read length specific offsets. Footprints of
+	every chrom are collected in one pass, offsets are resolved (inferred when
+	offsets is 'auto') and then applied to the collected footprints
+	'''
+	fetchable = [chrom for chrom in chroms if alignments.get_tid(chrom) >= 0]
+	footprints = collect_footprints(bam_path, fetchable, counts_path=counts_path)
+	length_offsets = resolve_offsets(footprints, offsets, offset, offsets_out)
+
+	for chrom, table in footprints:
+		# same minimum footprint length as run_offset
+		keep = table['length'] >= 25
+		table = {column: values[keep] for column, values in table.items()}
+		yield chrom, footprint_profile(table, alignments.get_reference_length(chrom), length_offsets, offset)
+
+
+def profile_entries(alignments, bam_path, chroms, mode="offset", offset=0, engine="array", offsets=None, offsets_out=None,
+		counts_path=None):
+	'''
+	yield (chrom, positions, values) for each chrom in the order given, positions ascending
+	'''
+	if mode == "offset" and offsets is not None:
+		for chrom, profile in length_offset_profiles(alignments, bam_path, chroms, offsets, offset, offsets_out, counts_path):
+			yield profile_array_entries(chrom, profile)
+		return
 
-	bed_path = str(bam_path) + ".bed"
+	# read counts come from the count tag, the count table, readN_xC names or count 1 (decided once for the bam)
+	count = read_counter(count_source(bam_path, counts_path=counts_path), counts_path)
 
-	bedfile = open(bed_path, "w")
+	for chrom in chroms:
 
-	for chrom in seq_dict_keys:		
 		try:
 			all_reads = alignments.fetch(chrom)
 		except:
 			print(f"No reads fetchable from provided bam file for chromosome {chrom}. Perhaps the fasta file is not what you aligned to")
 			continue
 
+		if engine == "array":
+			length = alignments.get_reference_length(chrom)
+			if mode == "offset":
+				profile = offset_array(all_reads, length, offset, count)
+			elif mode == "weight":
+				profile = weight_centered_array(all_reads, length)
+			yield profile_array_entries(chrom, profile)
+			continue
+
 		if mode == "offset":
-			sequence = run_offset(all_reads, offset)
+			sequence = run_offset(all_reads, offset, count)
 		
 		elif mode == "weight":
 			sequence = run_weight_centered(all_reads)
 
-		for Asite in sorted(sequence):
-			bedfile.write(f"{chrom}\t{Asite}\t{Asite + 1}\t{sequence[Asite]}\n")
-			
-	bedfile.close()
+		yield profile_dict_entries(chrom, sequence)
 
-	command = "sort -k1,1 -k2,2n %s > %s"%(bed_path, bed_path + ".sorted")
-	os.system(command)
-	return bed_path + ".sorted"
+
+def write_profile(entries, bed_path=None, bw_path=None, chrom_sizes=None, store_path=None):
+	'''
+	write (chrom, positions, values) entries to a bed file, a bigwig file and/or a binary
+	profile store (see profile_store.py) in one pass.
+	Entries must arrive sorted by chrom in chrom_sizes order and by position within a
+	chrom, which lets the files be written without an external sort.
+	'''
+	stored = [] if store_path else None
+	bedfile = open(bed_path, "w") if bed_path else None
+	bigwig = None
+	if bw_path:
+		if pyBigWig is None:
+			raise ImportError("pyBigWig is required to write bigwig files (pip install pyBigWig)")
+		bigwig = pyBigWig.open(bw_path, "w")
+		bigwig.addHeader(chrom_sizes)
+
+	try:
+		for chrom, positions, values in entries:
+			if bedfile:
+				for Asite, value in zip(positions, values):
+					bedfile.write(f"{chrom}\t{Asite}\t{Asite + 1}\t{value}\n")
+			if bigwig is not None and len(positions):
+				bigwig.addEntries(chrom, positions.tolist(), values=values.astype(float).tolist(), span=1)
+			if stored is not None and len(positions):
+				stored.append((chrom, positions, values))
+	finally:
+		if bedfile:
+			bedfile.close()
+		if bigwig is not None:
+			bigwig.close()
+
+	if store_path:
+		write_store_entries(stored, store_path)
+
+
+def generate_profile(bam_path, fasta_path=None, mode="offset", offset=0, create_bw=False, min_reads=0, engine="array",
+		offsets=None, offsets_out=None, create_bed=True, create_store=False, counts_path=None, tmp_dir=None):
+	'''
+	create sorted bed file of a ribosome profile in two mode options
+	offset - calculate a site with an inputted estimated distance from read end. Same applied to all read lengths 
+	weight - weight centered approach is used (suitable for mnase digested reads)
+
+	min_reads skips references with fewer mapped alignments than this in the bam index
+	engine is "array" (one numpy array per reference, sized from the bam header) or "dict" (per-position dictionary)
+	offsets (offset mode only) gives read length specific offsets: 'auto' to infer them in the
+	same pass (written to offsets_out), a path to an offset table or {read_length: offset}
+
+	references come from fasta_path.fai if present, otherwise from the bam header, so the
+	fasta itself is never loaded (fasta_path may be None).
+	references are visited in sorted order, so the bed (bam_path.bed) is written already sorted.
+	create_bw also writes bam_path.bw directly, with chrom sizes from the bam header (needs pyBigWig).
+	create_store also writes the profile as a binary store (bam_path.rprof, see profile_store.py).
+	counts_path is the count table collapse wrote for the reads of the bam (see read_counts.py).
+	an unindexed bam is indexed first (sorting it if needed, see bam_check.ensure_index), in tmp_dir if given.
+	the outputs are still named after the bam_path given, not the sorted or linked copy.
+	returns the bed path, or the store or bigwig path when create_bed is False
+	'''
+	out_prefix = str(bam_path)
+	bam_path = ensure_index(bam_path, tmp_dir=tmp_dir)
+	alignments	= pysam.Samfile(bam_path, 'rb') 
+	mapped = mapped_reads_per_reference(bam_path) if min_reads > 0 else {}
+
+	chroms = [chrom for chrom in reference_names(alignments, fasta_path) if min_reads <= 0 or mapped.get(chrom, 0) >= min_reads]
+
+	bed_path = out_prefix + ".bed" if create_bed else None
+	bw_path = out_prefix + ".bw" if create_bw else None
+	store_path = out_prefix + EXTENSION if create_store else None
+
+	entries = profile_entries(alignments, bam_path, chroms, mode, offset, engine, offsets, offsets_out, counts_path)
+	write_profile(entries, bed_path, bw_path, chrom_sizes_from_bam(alignments, chroms), store_path)
+	alignments.close()
+
+	if create_bed:
+		return bed_path
+	return store_path if create_store else bw_path
 
 
 if __name__ == '__main__':
@@ -136,16 +333,23 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--bam_path', help='path to the BAM file')
     parser.add_argument('--offset', type=int, help='offset for aligning the ribosome footprints (applied to all read lengths)')
-    parser.add_argument('--fasta_path', help='path to the FASTA file')
+    parser.add_argument('--fasta_path', help='path to the FASTA file (only its .fai index is read, if present)')
     parser.add_argument('--mode', help='\'offset\' or \'weight\'')
+    parser.add_argument('--min-reads', type=int, default=0, help='skip references with fewer mapped reads than this in the bam index')
+    parser.add_argument('--engine', default='array', help='\'array\' or \'dict\' profile engine')
+    parser.add_argument('--offsets', default=None, help='\'auto\' to infer offsets per read length, or a path to an offset table')
+    parser.add_argument('--offsets_out', default=None, help='where to write the inferred offset table')
+    parser.add_argument('--bigwig', action='store_true', help='also write a bigwig file (bam_path.bw), requires pyBigWig')
+    parser.add_argument('--store', action='store_true', help='also write a binary profile store (bam_path.rprof)')
+    parser.add_argument('--no_bed', action='store_true', help='do not write the bed file (use with --bigwig or --store)')
+    parser.add_argument('--counts', default=None, help='count table written by collapse (default: count tag or readN_xC names)')
+    parser.add_argument('--tmp_dir', default=None, help='where to sort and index the bam if it has no index (default: next to the bam)')
     args = parser.parse_args()
 
-    # Check if the BAM file is indexed, and create the index if necessary
-    if not os.path.exists(args.bam_path + ".bai"):
-        pysam.index(args.bam_path)
-
     # Call the main function to process the BAM LoCAM and create the BigWig file
-    generate_profile(bam_path=args.bam_path, fasta_path=args.fasta_path, mode=args.mode, offset=args.offset)
+    generate_profile(bam_path=args.bam_path, fasta_path=args.fasta_path, mode=args.mode, offset=args.offset, min_reads=args.min_reads, engine=args.engine,
+                     offsets=args.offsets, offsets_out=args.offsets_out, create_bw=args.bigwig, create_bed=not args.no_bed,
+                     create_store=args.store, counts_path=args.counts, tmp_dir=args.tmp_dir)
 
 
 
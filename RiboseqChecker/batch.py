@@ -0,0 +1,178 @@
+'''
+Batch mode: run many samples through one check.py invocation (--samples)
+
+The manifest is a tab separated file with one sample per line: a sample name and
+the path to its fastq (-A/-O) or bam (-B). A header line starting with "sample"
+and lines starting with # are ignored.
+
+Shared setup happens once: in -O mode the reference bowtie index is built (or
+found) in the index cache before any sample starts, so every sample reuses it.
+Samples are then run in a process pool. The global --threads budget is split
+evenly between the samples running at the same time, and each sample uses its
+share for bowtie, samtools and the python counting stages alike.
+
+Every sample writes its usual outputs into output/<sample>/ and a .complete marker
+when it finishes. Samples with a marker are skipped, so an interrupted batch can be
+rerun with the same command. Finally the per sample periodicity tables are
+summarised into output/periodicity_matrix.tsv (samples x metrics).
+'''
+import copy
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from realign_to_contigs import index_contigs
+
+
+COMPLETE_MARKER = '.complete'
+
+# columns of the combined matrix after the sample name
+METRICS = ['contigs', 'reads', 'frame0', 'frame1', 'frame2', 'periodicity', 'mean_periodicity', 'median_periodicity']
+
+
+def read_manifest(manifest_path: str) -> list:
+    '''
+    [(sample, path)] from a manifest, in file order
+    '''
+    samples = []
+    with open(manifest_path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if not fields[0] or fields[0].startswith('#') or fields[0] == 'sample':
+                continue
+            if len(fields) < 2:
+                raise ValueError(f"Manifest line needs a sample name and a path: {line.strip()}")
+            samples.append((fields[0], fields[1]))
+
+    for sample, path in samples:
+        if not is_safe_name(sample):
+            raise ValueError(f"Sample name {sample!r} must be a single file name (no '/' or '..'), it names the sample's output directory")
+
+    names = [sample for sample, path in samples]
+    if len(set(names)) != len(names):
+        raise ValueError("Sample names in the manifest must be unique")
+    return samples
+
+
+def is_safe_name(sample: str) -> bool:
+    '''
+    True if sample can be joined into a path as a single directory name
+    '''
+    separators = [os.sep] + ([os.altsep] if os.altsep else [])
+    return bool(sample.strip()) and '..' not in sample and not any(separator in sample for separator in separators)
+
+
+def sample_args(args, sample: str, path: str, threads: int):
+    '''
+    copy of the batch arguments for a single sample. Each sample gets its own output
+    and, with --tmp-dir, its own scratch directory under it, so samples running at the
+    same time never share sorted or indexed bams
+    '''
+    single = copy.copy(args)
+    single.samples = None
+    single.output = os.path.join(args.output, sample)
+    if args.tmp_dir:
+        single.tmp_dir = os.path.join(args.tmp_dir, sample)
+    single.threads = threads
+    if args.BAM:
+        single.bam = path
+    else:
+        single.fastq = path
+    return single
+
+
+def run_one(run_sample, args) -> str:
+    '''
+    worker: run a sample and mark it complete. Returns None or the error traceback
+    '''
+    try:
+        os.makedirs(args.output, exist_ok=True)
+        run_sample(args)
+        open(os.path.join(args.output, COMPLETE_MARKER), 'w').close()
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+def summarise_periodicity(periodicity_path: str) -> dict:
+    '''
+    library level metrics from a periodicity.txt table
+    '''
+    df = pd.read_csv(periodicity_path, sep='\t', comment='#')
+    frames = df[['frame0', 'frame1', 'frame2']].sum()
+    reads = frames.sum()
+    covered = df[df['total'] > 0]
+    return {
+        'contigs': len(covered),
+        'reads': reads,
+        'frame0': frames['frame0'] / reads if reads else 0,
+        'frame1': frames['frame1'] / reads if reads else 0,
+        'frame2': frames['frame2'] / reads if reads else 0,
+        'periodicity': df[['frame0', 'frame1', 'frame2']].max(axis=1).sum() / reads if reads else 0,
+        'mean_periodicity': covered['periodicity'].mean() if len(covered) else 0,
+        'median_periodicity': covered['periodicity'].median() if len(covered) else 0,
+    }
+
+
+def write_matrix(args, samples: list) -> str:
+    '''
+    combine the periodicity tables of all completed samples into one matrix
+    '''
+    rows = []
+    for sample, path in samples:
+        periodicity_path = os.path.join(args.output, sample, 'periodicity.txt')
+        if os.path.exists(os.path.join(args.output, sample, COMPLETE_MARKER)) and os.path.exists(periodicity_path):
+            rows.append(dict(sample=sample, **summarise_periodicity(periodicity_path)))
+
+    matrix_path = os.path.join(args.output, 'periodicity_matrix.tsv')
+    pd.DataFrame(rows, columns=['sample'] + METRICS).to_csv(matrix_path, sep='\t', index=False)
+    return matrix_path
+
+
+def run_batch(args, run_sample) -> str:
+    '''
+    run every sample of args.samples with run_sample(args) and write the combined matrix
+
+    inputs:
+        args: parsed check.py arguments (threads is the global budget)
+        run_sample: function running the selected mode for one sample
+
+    outputs:
+        matrix_path: path to periodicity_matrix.tsv
+    '''
+    samples = read_manifest(args.samples)
+    pending = [(sample, path) for sample, path in samples
+               if not os.path.exists(os.path.join(args.output, sample, COMPLETE_MARKER))]
+    print(f"{len(samples)} samples in manifest, {len(samples) - len(pending)} already complete")
+
+    if pending:
+        parallel = min(args.parallel_samples or max(args.threads // 4, 1), len(pending))
+        threads = max(args.threads // parallel, 1)
+        print(f"Running {parallel} samples at a time with {threads} threads each")
+
+        # build the shared reference index once, through the cache so every sample finds it
+        if args.organism:
+            if not args.index_cache:
+                args.index_cache = os.path.join(args.output, 'index_cache')
+            index_contigs(args.fasta, args.output, args.index_cache, args.index_cache_size)
+
+        failures = {}
+        with ProcessPoolExecutor(max_workers=parallel) as pool:
+            futures = {sample: pool.submit(run_one, run_sample, sample_args(args, sample, path, threads))
+                       for sample, path in pending}
+            for sample, future in futures.items():
+                error = future.result()
+                if error:
+                    failures[sample] = error
+                    print(f"Sample {sample} failed:\n{error}")
+                else:
+                    print(f"Sample {sample} complete")
+
+    matrix_path = write_matrix(args, samples)
+    print(f"Periodicity matrix written to {matrix_path}")
+
+    if pending and failures:
+        raise RuntimeError(f"{len(failures)} samples failed: {', '.join(failures)}. Rerun the same command to retry them")
+    return matrix_path
@@ -1,5 +1,16 @@
 import subprocess
 
+from stage_timer import stage
+
+
+def inchworm_command(fastq: str, kmer_length: int=30, min_contig_length=100, num_threads=1,
+                     inchworm_path='inchworm') -> list:
+    '''
+    inchworm command assembling the reads, the contigs are written to stdout
+    '''
+    return [inchworm_path, '--reads', fastq, '--run_inchworm', '-K', str(kmer_length),
+            '-L', str(min_contig_length), '--num_threads', str(num_threads)]
+
 
 def build_contigs(fastq: str, tmp_dir: str, kmer_length: int=30, min_contig_length=100, 
                      num_threads=1, inchworm_path='inchworm') -> str:
@@ -19,15 +30,17 @@ def build_contigs(fastq: str, tmp_dir: str, kmer_length: int=30, min_contig_leng
         contigs: path to contigs fasta file
     '''
     contigs = tmp_dir + '/contigs.fa'
-    cmd = [inchworm_path, '--reads', fastq, '--run_inchworm', '-K', str(kmer_length),
-              '-L', str(min_contig_length), '--num_threads', str(num_threads), '> ', contigs]
-
+    # contigs are written to stdout, which is captured below
+    cmd = inchworm_command(fastq, kmer_length, min_contig_length, num_threads, inchworm_path)
 
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    with stage('inchworm', inputs=[fastq], outputs=[contigs], python=False):
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
 
-    with open(contigs, 'w') as f:
-        for line in process.stdout:
-            f.write(line)
+        with open(contigs, 'w') as f:
+            for line in process.stdout:
+                f.write(line)
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
 
     print("Contigs outputted to ", contigs)
 
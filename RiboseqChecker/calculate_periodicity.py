@@ -6,39 +6,145 @@ input is the path to a tsv file with the following columns:
     - start
     - end
     - count
+
+two engines are available:
+    - vectorized: one grouped pass over the whole file (start % 3 weighted by count per contig)
+    - loop: the original per-position scan of each contig (kept for comparison)
 '''
 
 import pandas as pd
+import numpy as np
 import argparse
 
+from profile_store import read_profile
+
+
+def write_header(f):
+    '''
+    write the periodicity.txt header lines
+    '''
+    f.write('# Periodicity Checker\n')
+    f.write('# periodicity is calculated as the number of reads in the most abundant frame divided by the total number of reads\n')
+    f.write('contig\tframe0\tframe1\tframe2\ttotal\tperiodicity\n')
+
+
+def write_row(f, contig, frame_counts):
+    '''
+    write one contig line of periodicity.txt from a {0: n, 1: n, 2: n} frame count dictionary
+    '''
+    score = max(frame_counts.values()) / (max(sum(frame_counts.values()), 1))
+    f.write(f'{contig}\t{frame_counts[0]}\t{frame_counts[1]}\t{frame_counts[2]}\t{frame_counts[0]+frame_counts[1]+frame_counts[2]}\t{score}\n')
+
+
+def read_bed(bed_path:str) -> pd.DataFrame:
+    '''
+    read a profile bed file (or a binary profile store, see profile_store.py) into a dataframe
+    '''
+    return read_profile(bed_path)
+
+
+def frame_counts_loop(df:pd.DataFrame) -> dict:
+    '''
+    original frame counting: scan every position of each contig in turn
+
+    outputs:
+        frame_counts: {contig: {0: n, 1: n, 2: n}} in order of first appearance
+    '''
+    results = {}
+    for contig in df['contig'].unique():
+        frame_counts = {0:0, 1:0, 2:0}
+        contig_df = df[df['contig'] == contig]
+        for i in range(1, max(contig_df['start'])):
+            if i in contig_df['start'].values:
+                frame_counts[i%3] += contig_df[contig_df['start'] == i]['count'].values[0]
+        results[contig] = frame_counts
+    return results
+
+
+def frame_counts_vectorized(df:pd.DataFrame) -> dict:
+    '''
+    single grouped pass: count weighted by start % 3 per contig.
 
+    Mirrors the loop engine exactly so that the output is byte-identical:
+        - only the first row for a given (contig, start) is counted
+        - starts are counted from 1 up to, but not including, the contig's maximum start
+        - counts are summed in increasing start order
+        - a frame that receives no rows is reported as integer 0
 
-def calculate(bed_path:str, output_path:str):
+    outputs:
+        frame_counts: {contig: {0: n, 1: n, 2: n}} in order of first appearance
+    '''
+    codes, contigs = pd.factorize(df['contig'])
+    starts = df['start'].to_numpy()
+    counts = df['count'].to_numpy()
+
+    # the loop engine stops one short of the maximum start of each contig
+    max_start = np.full(len(contigs), np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(max_start, codes, starts.astype(np.int64))
+    keep = (starts >= 1) & (starts < max_start[codes])
+
+    # only the first row for each (contig, start) pair is used
+    kept = pd.DataFrame({'code': codes[keep], 'start': starts[keep]})
+    first = ~kept.duplicated(keep='first').to_numpy()
+    kept_codes = kept['code'].to_numpy()[first]
+    kept_starts = kept['start'].to_numpy()[first]
+    kept_counts = counts[keep][first]
+
+    # sum in increasing start order within each contig so floats add up the same way
+    order = np.lexsort((kept_starts, kept_codes))
+    bins = kept_codes[order] * 3 + kept_starts[order] % 3
+    kept_counts = kept_counts[order]
+
+    hits = np.bincount(bins, minlength=len(contigs) * 3)
+    if np.issubdtype(kept_counts.dtype, np.integer):
+        sums = np.zeros(len(contigs) * 3, dtype=kept_counts.dtype)
+        np.add.at(sums, bins, kept_counts)
+    else:
+        sums = np.bincount(bins, weights=kept_counts, minlength=len(contigs) * 3)
+
+    results = {}
+    for code, contig in enumerate(contigs):
+        results[contig] = {
+            frame: sums[code * 3 + frame] if hits[code * 3 + frame] else 0 for frame in range(3)
+        }
+    return results
+
+
+def calculate(bed_path:str, output_path:str, engine:str='vectorized'):
+    '''
+    calculate frame periodicity per contig from a profile bed file
+
+    inputs:
+        bed_path: path to bed file (contig, start, end, count) or profile store
+        output_path: path to write periodicity.txt
+        engine: 'vectorized' (default) or 'loop'
+    '''
     # read in tsv and use the following list as columns rather than the first row
-    df = pd.read_csv(bed_path, sep='\t', header=None, names=['contig', 'start', 'end', 'count'])
-    contigs = df['contig'].unique()
+    df = read_bed(bed_path)
+
+    if engine == 'vectorized':
+        frame_counts = frame_counts_vectorized(df)
+    elif engine == 'loop':
+        frame_counts = frame_counts_loop(df)
+    else:
+        raise ValueError(f"Unknown periodicity engine: {engine}")
+
     with open(output_path, 'w') as f:
 
         # Initialize the output file
-        f.write('# Periodicity Checker\n')
-        f.write('# periodicity is calculated as the number of reads in the most abundant frame divided by the total number of reads\n')
-        f.write('contig\tframe0\tframe1\tframe2\ttotal\tperiodicity\n')
-
-        # Iterate through each contig and calculate the periodicity
-        for contig in contigs:
-            frame_counts = {0:0, 1:0, 2:0}
-            contig_df = df[df['contig'] == contig]
-            for i in range(1, max(contig_df['start'])):
-                if i in contig_df['start'].values:
-                    frame_counts[i%3] += contig_df[contig_df['start'] == i]['count'].values[0]
-            score = max(frame_counts.values()) / (max(sum(frame_counts.values()), 1))
-            f.write(f'{contig}\t{frame_counts[0]}\t{frame_counts[1]}\t{frame_counts[2]}\t{frame_counts[0]+frame_counts[1]+frame_counts[2]}\t{score}\n')
-    f.close()
+        write_header(f)
+
+        # Iterate through each contig and write the periodicity
+        for contig in frame_counts:
+            write_row(f, contig, frame_counts[contig])
+
+    return output_path
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Calculate the periodicity of each contig in a tsv file.')
-    parser.add_argument('--tsv', type=str, help='Path to the tsv file.')
+    parser.add_argument('--tsv', type=str, help='Path to the tsv file (or profile store).')
     parser.add_argument('--output', type=str, help='Path to the output file.')
+    parser.add_argument('--engine', type=str, default='vectorized', choices=['vectorized', 'loop'], help='Frame counting engine.')
     args = parser.parse_args()
 
-    calculate(args)
\ No newline at end of file
+    calculate(args.tsv, args.output, engine=args.engine)
@@ -4,14 +4,84 @@ The main periodicity checker module. Calls the other modules to check for period
 '''
 
 import argparse
+import asyncio
 import os
 
 from collapse_fastq_to_single_fasta import collapse
 from build_contigs import build_contigs
-from realign_to_contigs import realign
+from realign_to_contigs import realign, index_contigs
 from calculate_periodicity import calculate
 from bam_to_ribosome_profile import generate_profile
-from bam_check import check_bam
+from bam_check import check_bam, ensure_index
+from genome_check import check_genome_bam, REGION_SIZE
+from stream_counts import stream_periodicity
+from batch import run_batch
+from kmer_agnostic import kmer_periodicity
+from fast_check import fast_check_bam, fast_report_from_periodicity
+from metrics import parse_metrics, run_metrics
+from stage_timer import stage, profiling
+from stage_runner import run_in_thread, run_concurrently, assemble, align_and_sort
+
+
+def selected_metrics(args):
+    '''
+    metrics requested with --metrics; frame is always included so periodicity.txt is written
+    '''
+    if not args.metrics:
+        return None
+    metrics = parse_metrics(args.metrics)
+    return metrics if 'frame' in metrics else ['frame'] + metrics
+
+
+def score_profile(args, profile_path, bam=None):
+    '''
+    write periodicity.txt from the profile, and metrics.tsv from the same read when --metrics is given
+    (with transcript lengths from the header of the bam the profile was made from)
+    '''
+    periodicity_path = f"{args.output}/periodicity.txt"
+    metrics = selected_metrics(args)
+    if not metrics:
+        with stage('score', inputs=[profile_path], outputs=[periodicity_path]):
+            return calculate(profile_path, periodicity_path)
+    with stage('score', inputs=[profile_path], outputs=[periodicity_path, f"{args.output}/metrics.tsv"]):
+        run_metrics(profile_path, f"{args.output}/metrics.tsv", metrics, periodicity_path, bam_path=bam)
+    return periodicity_path
+
+
+def run_profile(args, bam, reference_path):
+    '''
+    ribosome profile of the realigned bam as a bed file or profile store
+    '''
+    with stage('profile', inputs=[bam]) as outputs:
+        profile_path = generate_profile(bam, reference_path, offset=15, min_reads=args.min_reads,
+                                        offsets=args.offsets, offsets_out=f"{args.output}/offsets.tsv",
+                                        create_bw=args.bigwig, create_bed=not args.profile_store,
+                                        create_store=args.profile_store, counts_path=counts_table(args),
+                                        tmp_dir=args.tmp_dir or args.output)
+        outputs.append(profile_path)
+    return profile_path
+
+
+def run_streaming(args, reference_path, fa_path):
+    '''
+    streaming variant of the fastq modes. bowtie's SAM output is counted straight
+    from the pipe (see stream_counts.py), so only periodicity.txt and, if asked for,
+    the profile are written
+    '''
+    with stage('index', inputs=[reference_path]) as outputs:
+        index_prefix = index_contigs(reference_path, args.output, args.index_cache, args.index_cache_size)
+        outputs.append(index_prefix)
+    bed_path = f"{args.output}/profile.bed" if args.write_profile and not args.profile_store else None
+    store_path = f"{args.output}/profile.rprof" if args.write_profile and args.profile_store else None
+    bw_path = f"{args.output}/profile.bw" if args.bigwig else None
+    metrics_path = f"{args.output}/metrics.tsv" if args.metrics else None
+    periodicity_path = f"{args.output}/periodicity.txt"
+    with stage('stream align and count', inputs=[fa_path, index_prefix],
+               outputs=[periodicity_path, bed_path, store_path, bw_path, metrics_path]):
+        return stream_periodicity(fa_path, args.output, periodicity_path, num_threads=args.threads,
+                                  offset=15, bed_path=bed_path, bw_path=bw_path, index_prefix=index_prefix,
+                                  store_path=store_path, metrics=selected_metrics(args),
+                                  metrics_path=metrics_path, counts_path=counts_table(args))
 
 
 def run_agnostic(args, fa_path):
@@ -20,21 +90,34 @@ def run_agnostic(args, fa_path):
     reads with inchworm and then aligning the reads back to the contigs with bowtie.
     periodicity can be obtained from the resulting profilies
 
+    With --agnostic-engine kmer, contigs are built and reads placed in process from a
+    k-mer index of the collapsed reads instead (see kmer_agnostic.py)
+
     Necessary arguments:
         -q: path to fastq file (but this is handled prior to this function)
         --output: path to output directory
     '''
+    if args.agnostic_engine == 'kmer':
+        with stage('kmer contigs and count', inputs=[fa_path], outputs=[f"{args.output}/periodicity.txt"]):
+            return kmer_periodicity(fa_path, f"{args.output}/periodicity.txt",
+                                    contigs_path=f"{args.output}/contigs.fa")
+
     # build contigs from the collapsed fasta
     contigs = build_contigs(fa_path, args.output)
 
+    if args.stream:
+        return run_streaming(args, contigs, fa_path)
+
     # align reads back to contigs
-    bam = realign(contigs, fa_path, args.output)
+    with stage('align', inputs=[contigs, fa_path], outputs=[f"{args.output}/contigs.bam"]):
+        bam = realign(contigs, fa_path, args.output, num_threads=args.threads,
+                      index_cache=args.index_cache, index_cache_size_gb=args.index_cache_size)
 
-    # convert bam to bed
-    bed = generate_profile(bam, contigs, offset=15)
+    # convert bam to a bed (or binary store) profile
+    bed = run_profile(args, bam, contigs)
 
-    # calculate periodicity
-    periodicity = calculate(bed, f"{args.output}/periodicity.txt")
+    # calculate periodicity (and any other metrics in the same pass)
+    periodicity = score_profile(args, bed, bam)
     return periodicity
 
 
@@ -53,14 +136,19 @@ def run_organism(args, fa_path):
     # get the path to the reference
     reference_path = args.fasta
 
+    if args.stream:
+        return run_streaming(args, reference_path, fa_path)
+
     # align reads to reference
-    bam = realign(reference_path, fa_path, args.output)
+    with stage('align', inputs=[reference_path, fa_path], outputs=[f"{args.output}/contigs.bam"]):
+        bam = realign(reference_path, fa_path, args.output, num_threads=args.threads,
+                      index_cache=args.index_cache, index_cache_size_gb=args.index_cache_size)
 
-    # convert bam to bed
-    bed = generate_profile(bam, reference_path, offset=15) 
+    # convert bam to a bed (or binary store) profile
+    bed = run_profile(args, bam, reference_path)
 
-    # calculate periodicity
-    periodicity = calculate(bed, reference_path)
+    # calculate periodicity (and any other metrics in the same pass)
+    periodicity = score_profile(args, bed, bam)
     return periodicity
 
 
@@ -69,10 +157,116 @@ def run_bam(args):
     Wrapper function for bam mode. This involves calculating periodicity from a
     pre-existing bam file
     '''
-    check_bam(args.bam, f"{args.output}/periodicity.txt")
+    # an unindexed bam is sorted/indexed in the tmp directory, not next to the input
+    bam = ensure_index(args.bam, args.threads, args.tmp_dir or args.output)
+
+    if args.annotation:
+        with stage('check genome bam', inputs=[bam, args.annotation], outputs=[f"{args.output}/periodicity.txt"]):
+            return check_genome_bam(bam, args.annotation, f"{args.output}/periodicity.txt", num_threads=args.threads,
+                                    region_size=args.region_size, min_reads=args.min_reads,
+                                    report_skipped=args.report_skipped)
+
+    if args.fast:
+        with stage('fast check', inputs=[bam], outputs=[f"{args.output}/periodicity.txt"]):
+            return fast_check_bam(bam, f"{args.output}/periodicity.txt", f"{args.output}/fast_estimate.json",
+                                  tolerance=args.fast_tolerance, min_reads=args.min_reads, seed=args.seed)
+
+    with stage('check bam', inputs=[bam], outputs=[f"{args.output}/periodicity.txt"]):
+        check_bam(bam, f"{args.output}/periodicity.txt", num_threads=args.threads,
+                  min_reads=args.min_reads, report_skipped=args.report_skipped,
+                  offsets=args.offsets, offsets_out=f"{args.output}/offsets.tsv",
+                  frame_stats_out=f"{args.output}/frame_stats.tsv" if args.frame_stats else None,
+                  frame_summary_out=f"{args.output}/frame_summary.tsv", cds=args.cds)
 
 
 
+def counts_table(args):
+    '''
+    count table collapse writes next to collapsed.fa. The profile and streaming counters
+    read the collapse counts from it by read number (see read_counts.py)
+    '''
+    return args.output + '/collapsed.counts.npy'
+
+
+def run_collapse(args, sample_reads=None):
+    '''
+    collapse the fastq into a fasta of unique reads with counts
+    '''
+    with stage('collapse', inputs=[args.fastq], outputs=[args.output + '/collapsed.fa', counts_table(args)]):
+        return collapse(args.fastq, args.output + '/collapsed.fa', max_memory_mb=args.collapse_memory_mb, num_workers=args.threads,
+                        sample_reads=sample_reads, seed=args.seed, counts_path=counts_table(args))
+
+
+async def run_overlapped(args, sample_reads=None):
+    '''
+    modes A/O with --overlap: the steps run on the asyncio stage runner (see stage_runner.py).
+    In mode O the reference is indexed while the fastq is collapsed, and in both modes
+    bowtie's SAM output is sorted by samtools as it is produced instead of going through
+    contigs.sam
+    '''
+    fa_path = args.output + '/collapsed.fa'
+    collapse_step = run_in_thread(collapse, args.fastq, fa_path, max_memory_mb=args.collapse_memory_mb,
+                                  num_workers=args.threads, sample_reads=sample_reads, seed=args.seed,
+                                  counts_path=counts_table(args))
+
+    if args.organism:
+        reference_path = args.fasta
+        with stage('collapse and index', inputs=[args.fastq, reference_path], outputs=[fa_path]) as outputs:
+            fa_path, index_prefix = await run_concurrently(
+                collapse_step,
+                run_in_thread(index_contigs, reference_path, args.output, args.index_cache, args.index_cache_size))
+            outputs.append(index_prefix)
+    else:
+        with stage('collapse', inputs=[args.fastq], outputs=[fa_path]):
+            fa_path = await collapse_step
+        with stage('inchworm', inputs=[fa_path], outputs=[args.output + '/contigs.fa'], python=False):
+            reference_path = await assemble(fa_path, args.output, args.threads)
+        with stage('index', inputs=[reference_path]) as outputs:
+            index_prefix = await run_in_thread(index_contigs, reference_path, args.output,
+                                               args.index_cache, args.index_cache_size)
+            outputs.append(index_prefix)
+
+    with stage('bowtie | samtools sort', inputs=[fa_path, index_prefix],
+               outputs=[f"{args.output}/contigs.bam"], python=False):
+        bam = await align_and_sort(fa_path, args.output, index_prefix, args.threads)
+
+    bed = run_profile(args, bam, reference_path)
+    return score_profile(args, bed, bam)
+
+
+def run_sample(args):
+    '''
+    run the selected mode for a single fastq or bam file. With --profile the stage
+    timings are written to timings.json next to periodicity.txt
+    '''
+    sample_reads = args.fast_reads if args.fast else None
+    report_path = f"{args.output}/timings.json" if args.profile or args.cprofile else None
+    cprofile_dir = f"{args.output}/cprofile" if args.cprofile else None
+
+    with profiling(report_path, cprofile_dir):
+        if args.overlap and (args.agnostic or args.organism):
+            periodicity = asyncio.run(run_overlapped(args, sample_reads))
+
+        elif args.agnostic:
+            collapsed_fa_path = run_collapse(args, sample_reads)
+            periodicity = run_agnostic(args, collapsed_fa_path)
+
+        elif args.organism:
+            collapsed_fa_path = run_collapse(args, sample_reads)
+            periodicity = run_organism(args, collapsed_fa_path)
+
+        elif args.bam:
+            periodicity = run_bam(args)
+
+        else:
+            raise Exception("No mode selected")
+
+    if args.fast and not args.bam:
+        fast_report_from_periodicity(periodicity, f"{args.output}/fast_estimate.json", sample_reads)
+
+    return periodicity
+
+
 def main(args):
     '''
     Main function to bridge between argparse and the rest of the code.
@@ -84,21 +278,10 @@ def main(args):
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
+    if args.samples:
+        return run_batch(args, run_sample)
 
-    if args.agnostic:
-        collapsed_fa_path = collapse(args.fastq, args.output + '/collapsed.fa')
-        periodicity = run_agnostic(args, collapsed_fa_path)
-
-    elif args.organism:
-        collapsed_fa_path = collapse(args.fastq, args.output + '/collapsed.fa')
-        periodicity = run_organism(args, collapsed_fa_path)
-
-    elif args.bam:
-        periodicity = run_bam(args)
-
-    else:
-        raise Exception("No mode selected")
-
+    return run_sample(args)
 
 
 
@@ -119,14 +302,60 @@ if __name__ == "__main__":
     parser.add_argument("-f", "--fasta", help="reference fasta file path")
     parser.add_argument("-b", "--bam", help="bam file path")
     parser.add_argument('--output', type=str, help='Output directory')
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of threads/processes to use")
+    parser.add_argument('--min-reads', type=int, default=0, help='Only process references with at least this many mapped reads in the BAM index')
+    parser.add_argument('--report-skipped', action='store_true', help='Write references skipped by --min-reads as zero rows in periodicity.txt')
+    parser.add_argument('--offsets', default=None, help="Read length specific offsets: 'auto' infers them in the same pass (written to offsets.tsv in the output directory), or give the path to an offsets table")
+    parser.add_argument('--bigwig', action='store_true', help='Also write the ribosome profile as a BigWig file (requires pyBigWig)')
+    parser.add_argument('--stream', action='store_true', help='Modes A/O: count periodicity straight from the bowtie output stream without writing SAM/BAM/BED files')
+    parser.add_argument('--write-profile', action='store_true', help='With --stream, also write the ribosome profile to profile.bed')
+    parser.add_argument('--profile-store', action='store_true', help='Modes A/O: write the ribosome profile as a binary profile store (.rprof) instead of a bed file')
+    parser.add_argument('--index-cache', default=None, help='Directory of cached bowtie indexes shared between runs, keyed by reference content')
+    parser.add_argument('--index-cache-size', type=float, default=50, help='Size limit of the index cache in GB (least recently used indexes are evicted)')
+    parser.add_argument('--samples', default=None, help='Batch mode: tab separated manifest of sample name and fastq/bam path, one sample per line. Outputs go to --output/<sample>')
+    parser.add_argument('--parallel-samples', type=int, default=None, help='Batch mode: samples run at the same time (default: threads / 4); --threads is split between them')
+    parser.add_argument('--agnostic-engine', default='inchworm', choices=['inchworm', 'kmer'], help="Mode A: 'inchworm' assembles contigs with inchworm and realigns with bowtie, 'kmer' builds contigs and places reads in process from a k-mer index (no external tools)")
+    parser.add_argument('--metrics', default=None, help="Modes A/O: also write metrics.tsv with these per transcript metrics, computed from the same read of the profile: comma separated frame, fourier, uniformity or all")
+    parser.add_argument('--fast', action='store_true', help='Early verdict from a subsample: modes A/O sample --fast-reads reads, mode B visits random references until the 95%% CI of the periodicity estimate is narrower than --fast-tolerance. The estimate is written to fast_estimate.json')
+    parser.add_argument('--fast-reads', type=int, default=1000000, help='With --fast in modes A/O, number of reads sampled uniformly from the fastq')
+    parser.add_argument('--fast-tolerance', type=float, default=0.02, help='With --fast in mode B, stop once the confidence interval is narrower than this')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for --fast sampling')
+    parser.add_argument('--profile', action='store_true', help='Record wall time, cpu time, peak memory and file sizes of every stage (including bowtie, samtools and inchworm) in timings.json')
+    parser.add_argument('--cprofile', action='store_true', help='Run the python stages under cProfile and write the stats to the cprofile directory (implies --profile)')
+    parser.add_argument('--tmp-dir', default=None, help='Directory for sorting/indexing an unindexed bam (default: the output directory)')
+    parser.add_argument('--frame-stats', action='store_true', help='Mode B: also write read counts by reference, read length, region (5\'UTR/CDS/3\'UTR) and frame to frame_stats.tsv, and their library summary to frame_summary.tsv, from the same pass over the bam')
+    parser.add_argument('--cds', default=None, help='With --frame-stats, tsv of reference, CDS start and end (1 based, inclusive) instead of parsing |CDS:start-end| from the reference names')
+    parser.add_argument('--annotation', default=None, help='Mode B for genome aligned bams: GTF or GFF3 with CDS exons. Frames are taken from the a-site position in the CDS of the read\'s strand (see genome_check.py) and periodicity.txt has one row per transcript')
+    parser.add_argument('--region-size', type=int, default=REGION_SIZE, help='With --annotation, chromosomes are split into regions of this many nt counted by --threads worker processes')
+    parser.add_argument('--overlap', action='store_true', help='Modes A/O: run the pipeline on the asyncio stage runner, indexing the reference while the fastq is collapsed (mode O) and piping bowtie straight into samtools sort')
+    parser.add_argument('--collapse-memory-mb', type=float, default=None, help='Memory budget (MB) for collapsing the fastq; counts spill to disk when exceeded')
 
     args = parser.parse_args()
 
-    if args.agnostic and not args.fastq:
+    if args.agnostic and not (args.fastq or args.samples):
         parser.error("-A mode requires -q/--fastq option.")
-    if args.organism and (not args.fastq or not args.fasta):
+    if args.organism and (not (args.fastq or args.samples) or not args.fasta):
         parser.error("-O mode requires -f/--fasta, -q/--fastq options.")
-    if args.BAM and not args.bam:
+    if args.BAM and not (args.bam or args.samples):
         parser.error("-B mode requires -b/--bam option.")
+    if args.samples and not args.output:
+        parser.error("--samples requires --output.")
+    if args.stream and (args.BAM or args.offsets):
+        parser.error("--stream is only available in -A/-O modes with a single offset.")
+    if args.metrics and args.BAM:
+        parser.error("--metrics needs a ribosome profile and is only available in -A/-O modes.")
+    if args.agnostic_engine == 'kmer' and (args.stream or args.offsets or args.metrics or args.profile_store or args.bigwig):
+        parser.error("--agnostic-engine kmer only writes periodicity.txt and does not combine with --stream, --offsets, --metrics, --profile-store or --bigwig.")
+
+    if (args.frame_stats or args.cds) and not args.BAM:
+        parser.error("--frame-stats and --cds are only available in -B mode.")
+    if (args.frame_stats or args.cds) and args.fast:
+        parser.error("--frame-stats and --cds need the full pass over the bam and do not combine with --fast.")
+    if args.BAM and args.fast and args.offsets:
+        parser.error("-B --fast counts frames with a single offset and does not combine with --offsets.")
+    if args.annotation and (not args.BAM or args.fast or args.offsets or args.frame_stats):
+        parser.error("--annotation is only available in -B mode, without --fast, --offsets or --frame-stats.")
+    if args.overlap and (args.stream or args.agnostic_engine == 'kmer'):
+        parser.error("--overlap does not combine with --stream or --agnostic-engine kmer.")
 
     main(args)
\ No newline at end of file
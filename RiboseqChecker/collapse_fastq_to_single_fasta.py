@@ -1,51 +1,361 @@
 import argparse
 import gzip
+import heapq
+import itertools
+import math
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
+from read_counts import CountTableWriter
 
-def collapse(fastq: str, fasta: str) -> str:
+
+# bytes of (decompressed) FASTQ handed to a worker at a time
+CHUNK_BYTES = 16 << 20
+
+# rough per-sequence cost of a str key plus its int count in a dict (bytes, excluding the sequence itself)
+ENTRY_OVERHEAD = 120
+
+
+def open_fastq(fastq: str, binary: bool = False):
     '''
-    Collapse a FASTQ file to a FASTA file with read counts in the header.
+    Open a FASTQ file for reading (as text, or bytes with binary), handling gzip
+    if necessary by checking the magic number at the beginning of the file
     '''
-    # Store the unique reads in a dictionary with their counts
-    unique_reads = {}
-
-    # Open the FASTQ file for reading, handling gzip if necessary
-    # by checking the magic number at the beginning of the file
     with open(fastq, 'rb') as f:
         magic_number = f.read(2)
-        if magic_number == b'\x1f\x8b':
-            f = gzip.open(fastq, 'rt')
-        else:
-            f.seek(0)
-            f = open(fastq, 'r')
+    if magic_number == b'\x1f\x8b':
+        return gzip.open(fastq, 'rb' if binary else 'rt')
+    return open(fastq, 'rb' if binary else 'r')
 
-        for title, sequence, quality in FastqGeneralIterator(f):
-            if sequence in unique_reads:
-                unique_reads[sequence]['count'] += 1
-            else:
-                unique_reads[sequence] = {}
-                unique_reads[sequence]['count'] = 1
 
-    # Open the FASTA file for writing, handling gzip if necessary
+def open_fasta(fasta: str):
+    '''
+    Open the FASTA file for writing, handling gzip if necessary
+    '''
     if fasta.endswith('.gz'):
-        f = gzip.open(fasta, 'wt')
-    else:
-        f = open(fasta, 'w')
-
-    # Write the unique reads to the FASTA file
-    read_number = 1
-    for seq, vals in unique_reads.items():
-        f.write(f'>read{read_number}_x{vals["count"]}\n')
-        f.write(f"{seq}\n")
-        read_number += 1
+        return gzip.open(fasta, 'wt')
+    return open(fasta, 'w')
+
+
+def write_collapsed(records, fasta: str, counts_path: str = None) -> str:
+    '''
+    Write (sequence, count) pairs to a FASTA file using the readN_xC naming convention,
+    and the counts to a count table indexed by read number if counts_path is given.
+    The counts are written out as they come, so the table costs no memory per read
+    '''
+    table = CountTableWriter(counts_path) if counts_path else None
+    try:
+        with open_fasta(fasta) as f:
+            for read_number, (seq, count) in enumerate(records, start=1):
+                f.write(f'>read{read_number}_x{count}\n')
+                f.write(f"{seq}\n")
+                if table is not None:
+                    table.add(count)
+    finally:
+        if table is not None:
+            table.close()
     return fasta
 
 
+def spill_run(unique_reads: dict, tmp_dir: str) -> str:
+    '''
+    Write the in-memory counts to a temporary file sorted by sequence and return its path
+    '''
+    fd, run_path = tempfile.mkstemp(prefix='collapse_run_', suffix='.tsv', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as run:
+        for seq in sorted(unique_reads):
+            run.write(f"{seq}\t{unique_reads[seq]}\n")
+    return run_path
+
+
+def read_run(run_path: str):
+    '''
+    Yield (sequence, count) pairs from a sorted run file
+    '''
+    with open(run_path) as run:
+        for line in run:
+            seq, count = line.rstrip('\n').split('\t')
+            yield seq, int(count)
+
+
+def merge_runs(run_paths: list, unique_reads: dict):
+    '''
+    k-way merge sorted run files and the remaining in-memory counts, summing equal sequences
+    '''
+    streams = [read_run(path) for path in run_paths]
+    streams.append((seq, unique_reads[seq]) for seq in sorted(unique_reads))
+
+    current_seq, current_count = None, 0
+    for seq, count in heapq.merge(*streams):
+        if seq == current_seq:
+            current_count += count
+        else:
+            if current_seq is not None:
+                yield current_seq, current_count
+            current_seq, current_count = seq, count
+    if current_seq is not None:
+        yield current_seq, current_count
+
+
+def shard_of(sequence: str, num_shards: int) -> int:
+    '''
+    Deterministic shard assignment (the builtin hash is salted per process)
+    '''
+    return zlib.crc32(sequence.encode()) % num_shards
+
+
+def read_chunks(fastq: str, chunk_bytes: int = CHUNK_BYTES):
+    '''
+    Yield blocks of raw FASTQ bytes of about chunk_bytes, each cut after a multiple of
+    four lines. The main process only decompresses and looks for the cut (both in C);
+    splitting and checking the lines is left to the workers (see count_chunk)
+    '''
+    with open_fastq(fastq, binary=True) as f:
+        rest = b''
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            data = rest + block
+            # step back from the last newline over the lines of the unfinished record
+            cut = data.rfind(b'\n')
+            for _ in range(data.count(b'\n') % 4):
+                if cut < 0:
+                    break
+                cut = data.rfind(b'\n', 0, cut)
+            if cut >= 0:
+                yield data[:cut + 1]
+            rest = data[cut + 1:]
+        if rest.strip():
+            yield rest
+
+
+def chunk_sequences(chunk_index: int, data: bytes) -> list:
+    '''
+    Sequence lines of a block of four line FASTQ records, raising ValueError if a
+    record does not start with '@' or has no '+' line (wrapped or malformed FASTQ)
+    '''
+    lines = data.decode().replace('\r', '').split('\n')
+    while lines and not lines[-1]:
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError(f"FASTQ chunk {chunk_index} ends in a truncated record (records must span exactly four lines)")
+    for number, (header, separator) in enumerate(zip(lines[0::4], lines[2::4])):
+        if not header.startswith('@') or not separator.startswith('+'):
+            raise ValueError(f"FASTQ record {number} of chunk {chunk_index} is malformed: records must span exactly "
+                             f"four lines, starting with '@' and with a '+' line (got {header[:50]!r})")
+    return lines[1::4]
+
+
+def count_chunk(chunk_index: int, data: bytes, shard_dir: str, num_shards: int) -> list:
+    '''
+    Worker: split a block of FASTQ bytes into records, count its sequences and write
+    one pickled count dictionary per shard. Returns the shard file paths
+    '''
+    counts = Counter(chunk_sequences(chunk_index, data))
+
+    shards = [{} for _ in range(num_shards)]
+    for sequence, count in counts.items():
+        shards[shard_of(sequence, num_shards)][sequence] = count
+
+    shard_paths = []
+    for shard_index, shard in enumerate(shards):
+        shard_path = os.path.join(shard_dir, f'shard{shard_index}_chunk{chunk_index}.pkl')
+        with open(shard_path, 'wb') as f:
+            pickle.dump(shard, f, protocol=pickle.HIGHEST_PROTOCOL)
+        shard_paths.append(shard_path)
+    return shard_paths
+
+
+def merge_shard(shard_paths: list) -> dict:
+    '''
+    Worker: sum the per-chunk count dictionaries of a single shard
+    '''
+    merged = {}
+    for shard_path in shard_paths:
+        with open(shard_path, 'rb') as f:
+            for sequence, count in pickle.load(f).items():
+                merged[sequence] = merged.get(sequence, 0) + count
+        os.remove(shard_path)
+    return merged
+
+
+def collapse_parallel(fastq: str, fasta: str, num_workers: int, tmp_dir: str, chunk_bytes: int = CHUNK_BYTES,
+                      counts_path: str = None) -> str:
+    '''
+    Collapse with a process pool. The main process only decompresses the FASTQ and cuts
+    it into blocks of whole records; workers split and count each block and split the
+    counts into shards by sequence hash. Each shard is then merged independently, so no
+    sequence is counted in two shards.
+
+    Records must span exactly four lines (checked by the workers). Reads are numbered
+    shard by shard, so the order differs from the serial collapse but the readN_xC
+    convention is kept.
+    '''
+    num_shards = num_workers
+    shard_dir = tempfile.mkdtemp(prefix='collapse_shards_', dir=tmp_dir)
+    shard_paths = [[] for _ in range(num_shards)]
+
+    def collect(futures):
+        for future in futures:
+            for shard_index, shard_path in enumerate(future.result()):
+                shard_paths[shard_index].append(shard_path)
+
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            # keep a bounded number of chunks in flight so the file is never read ahead into memory
+            pending = set()
+            for chunk_index, data in enumerate(read_chunks(fastq, chunk_bytes)):
+                if len(pending) >= 2 * num_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(pool.submit(count_chunk, chunk_index, data, shard_dir, num_shards))
+            collect(pending)
+
+            merged = pool.map(merge_shard, shard_paths)
+            return write_collapsed(itertools.chain.from_iterable(shard.items() for shard in merged), fasta, counts_path)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def reservoir_sample(sequences, sample_size: int, seed: int = None) -> tuple:
+    '''
+    uniform random sample of sample_size items from an iterable of unknown length
+    (reservoir sampling, algorithm L: the number of items to skip is drawn directly
+    so the random generator is only called once per accepted item)
+
+    outputs:
+        reservoir: the sampled items
+        seen: number of items read
+    '''
+    rng = random.Random(seed)
+    reservoir = []
+    iterator = iter(sequences)
+    for item in itertools.islice(iterator, sample_size):
+        reservoir.append(item)
+    seen = len(reservoir)
+    if seen < sample_size:
+        return reservoir, seen
+
+    weight = math.exp(math.log(rng.random()) / sample_size)
+    while True:
+        skip = int(math.floor(math.log(rng.random()) / math.log(1 - weight)))
+        skipped = sum(1 for _ in itertools.islice(iterator, skip))
+        seen += skipped
+        if skipped < skip:
+            return reservoir, seen
+        item = next(iterator, None)
+        if item is None:
+            return reservoir, seen
+        seen += 1
+        reservoir[rng.randrange(sample_size)] = item
+        weight *= math.exp(math.log(rng.random()) / sample_size)
+
+
+def collapse_sample(fastq: str, fasta: str, sample_reads: int, seed: int = None, counts_path: str = None) -> str:
+    '''
+    Collapse a uniform random sample of sample_reads reads from a FASTQ file
+    '''
+    with open_fastq(fastq) as f:
+        sequences = (sequence for title, sequence, quality in FastqGeneralIterator(f))
+        reservoir, seen = reservoir_sample(sequences, sample_reads, seed)
+    print(f"Sampled {len(reservoir)} of {seen} reads")
+
+    unique_reads = {}
+    for sequence in reservoir:
+        unique_reads[sequence] = unique_reads.get(sequence, 0) + 1
+    return write_collapsed(unique_reads.items(), fasta, counts_path)
+
+
+def collapse(fastq: str, fasta: str, max_memory_mb: float = None, tmp_dir: str = None, num_workers: int = 1,
+             sample_reads: int = None, seed: int = None, counts_path: str = None) -> str:
+    '''
+    Collapse a FASTQ file to a FASTA file with read counts in the header.
+
+    inputs:
+        fastq: path to FASTQ file (optionally gzipped)
+        fasta: path to output FASTA file (add .gz to compress)
+        max_memory_mb: approximate memory budget for the count table. When it fills, the
+            counts are spilled to sorted runs on disk and merged at the end. None keeps
+            everything in memory and writes reads in order of first appearance
+        tmp_dir: directory for spilled runs (defaults to the output directory)
+        num_workers: number of processes to parse and count with. Above 1 the reads are
+            sharded by sequence hash across a process pool (see collapse_parallel). With
+            max_memory_mb a single worker is used
+        sample_reads: only collapse a uniform random sample of this many reads
+            (reservoir sampling, for fast checks). Overrides the two options above
+        seed: random seed for sample_reads
+        counts_path: also write the counts as a count table indexed by read number
+            (see read_counts.py), e.g. collapsed.counts.npy
+
+    outputs:
+        fasta: path to the collapsed FASTA file
+    '''
+    if sample_reads:
+        return collapse_sample(fastq, fasta, sample_reads, seed, counts_path)
+
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(fasta))
+
+    if num_workers > 1 and max_memory_mb:
+        # shards are merged in memory, so a budget needs the serial collapse with spilled runs
+        print(f"Collapsing with a single worker to stay within the {max_memory_mb} MB memory budget")
+        num_workers = 1
+
+    if num_workers > 1:
+        return collapse_parallel(fastq, fasta, num_workers, tmp_dir, counts_path=counts_path)
+
+    # Store the unique reads in a flat sequence -> count dictionary
+    unique_reads = {}
+    run_paths = []
+    budget = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+    used = 0
+
+    try:
+        with open_fastq(fastq) as f:
+            for title, sequence, quality in FastqGeneralIterator(f):
+                if sequence in unique_reads:
+                    unique_reads[sequence] += 1
+                    continue
+
+                unique_reads[sequence] = 1
+                if budget is not None:
+                    used += len(sequence) + ENTRY_OVERHEAD
+                    if used >= budget:
+                        run_paths.append(spill_run(unique_reads, tmp_dir))
+                        unique_reads = {}
+                        used = 0
+
+        if run_paths:
+            print(f"Merging {len(run_paths) + 1} collapse runs")
+            return write_collapsed(merge_runs(run_paths, unique_reads), fasta, counts_path)
+
+        # Write the unique reads to the FASTA file
+        return write_collapsed(unique_reads.items(), fasta, counts_path)
+
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', help='path to input FASTQ file')
     parser.add_argument('-o', help='path to output collapsed FASTA file (add .gz to the end to compress)')
+    parser.add_argument('--max-memory-mb', type=float, default=None, help='memory budget for the count table; spill sorted runs to disk when exceeded')
+    parser.add_argument('--tmp-dir', default=None, help='directory for spilled runs (defaults to the output directory)')
+    parser.add_argument('--num-workers', type=int, default=1, help='number of processes used to parse and count reads')
+    parser.add_argument('--sample-reads', type=int, default=None, help='only collapse a random sample of this many reads')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for --sample-reads')
+    parser.add_argument('--counts', default=None, help='also write the read counts to this count table (.npy, indexed by read number)')
 
     args = parser.parse_args()
-    collapse(args.i, args.o)
\ No newline at end of file
+    collapse(args.i, args.o, max_memory_mb=args.max_memory_mb, tmp_dir=args.tmp_dir, num_workers=args.num_workers,
+             sample_reads=args.sample_reads, seed=args.seed, counts_path=args.counts)
@@ -0,0 +1,167 @@
+'''
+Fast, early stopping periodicity verdicts (check.py --fast)
+
+The library level estimate is the fraction of reads that fall in the dominant frame
+of their reference, sum(max frame) / sum(total) over references. References are
+treated as clusters of reads, so its confidence interval comes from the ratio
+estimator variance over references rather than from a binomial over reads.
+
+In BAM mode references that the index reports as non-empty are visited in random
+order and counting stops as soon as the confidence interval is narrower than the
+tolerance. In the fastq modes the reads are subsampled in collapse instead and the
+estimate is reported from the resulting periodicity table.
+'''
+import json
+import math
+import random
+
+import numpy as np
+import pandas as pd
+import pysam
+
+from bam_check import select_references, reference_frames
+from read_counts import count_source, read_counter
+from calculate_periodicity import write_header, write_row
+
+
+# two sided 95% normal quantile
+Z_95 = 1.96
+
+# references counted before the interval is trusted for stopping
+MIN_REFERENCES = 30
+
+# references counted between checks of the stopping rule
+CHECK_EVERY = 10
+
+
+class RatioSums:
+    '''
+    running sums of the dominant frame and total reads per reference, so the ratio
+    estimate can be updated in O(1) per reference
+    '''
+    def __init__(self):
+        self.k = 0
+        self.dominant = self.totals = 0.0
+        self.dominant_squares = self.totals_squares = self.products = 0.0
+
+    def add(self, dominant, total) -> None:
+        self.k += 1
+        self.dominant += dominant
+        self.totals += total
+        self.dominant_squares += dominant * dominant
+        self.totals_squares += total * total
+        self.products += dominant * total
+
+    def estimate(self) -> tuple:
+        '''
+        sum(dominant) / sum(totals) with a 95% confidence interval treating each
+        reference as a cluster
+
+        outputs:
+            estimate, low, high
+        '''
+        if self.totals == 0:
+            return 0.0, 0.0, 1.0
+
+        estimate = self.dominant / self.totals
+        if self.k < 2:
+            return estimate, 0.0, 1.0
+
+        # sum((dominant - estimate * totals) ** 2) expanded into the running sums
+        squared_residuals = max(self.dominant_squares - 2 * estimate * self.products
+                                + estimate ** 2 * self.totals_squares, 0.0)
+        variance = squared_residuals / (self.k - 1) / self.k / (self.totals / self.k) ** 2
+        half_width = Z_95 * math.sqrt(variance)
+        return estimate, max(estimate - half_width, 0.0), min(estimate + half_width, 1.0)
+
+
+def ratio_estimate(dominant, totals) -> tuple:
+    '''
+    RatioSums.estimate of per reference dominant frame and total reads
+    '''
+    sums = RatioSums()
+    for reference_dominant, reference_total in zip(np.asarray(dominant, dtype=float), np.asarray(totals, dtype=float)):
+        sums.add(reference_dominant, reference_total)
+    return sums.estimate()
+
+
+def write_report(report: dict, report_path: str) -> str:
+    '''
+    write the fast mode verdict as json and print it
+    '''
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Periodicity estimate {report['estimate']:.4f} (95% CI {report['ci_low']:.4f}-{report['ci_high']:.4f}) "
+          f"from {report['reads']} reads")
+    return report_path
+
+
+def fast_check_bam(bam_path, output_path, report_path, offset=15, tolerance=0.02, min_reads=1, seed=None) -> dict:
+    '''
+    estimate periodicity from a random subset of references, stopping once the
+    95% confidence interval is narrower than tolerance
+
+    inputs:
+        bam_path: path to indexed bam file
+        output_path: periodicity.txt for the references that were visited (visit order)
+        report_path: json report with the estimate, interval and reads consumed
+        offset: offset added to the read start before taking the frame
+        tolerance: stop when the interval width falls below this
+        min_reads: only visit references with at least this many mapped reads in the index
+        seed: random seed for the visiting order
+
+    outputs:
+        report: dictionary written to report_path
+    '''
+    references = select_references(bam_path, max(min_reads, 1))
+    random.Random(seed).shuffle(references)
+    count = read_counter(count_source(bam_path))
+
+    sums = RatioSums()
+    with open(output_path, 'w') as f, pysam.AlignmentFile(bam_path, 'rb') as bam:
+        write_header(f)
+        for transcript in references:
+            frame_counts = reference_frames(bam, transcript, offset, count)
+            write_row(f, transcript, frame_counts)
+            sums.add(max(frame_counts.values()), sum(frame_counts.values()))
+
+            if sums.k >= MIN_REFERENCES and sums.k % CHECK_EVERY == 0:
+                estimate, low, high = sums.estimate()
+                if high - low < tolerance:
+                    break
+    estimate, low, high = sums.estimate()
+
+    report = {
+        'mode': 'bam',
+        'estimate': estimate,
+        'ci_low': low,
+        'ci_high': high,
+        'tolerance': tolerance,
+        'reads': int(sums.totals),
+        'references_visited': sums.k,
+        'references_available': len(references),
+        'stopped_early': sums.k < len(references),
+    }
+    write_report(report, report_path)
+    return report
+
+
+def fast_report_from_periodicity(periodicity_path, report_path, sampled_reads, tolerance=None) -> dict:
+    '''
+    estimate and interval from a periodicity table built from subsampled reads
+    '''
+    df = pd.read_csv(periodicity_path, sep='\t', comment='#')
+    df = df[df['total'] > 0]
+    estimate, low, high = ratio_estimate(df[['frame0', 'frame1', 'frame2']].max(axis=1), df['total'])
+    report = {
+        'mode': 'fastq',
+        'estimate': estimate,
+        'ci_low': low,
+        'ci_high': high,
+        'tolerance': tolerance,
+        'reads': int(df['total'].sum()),
+        'sampled_reads': sampled_reads,
+        'references_visited': len(df),
+    }
+    write_report(report, report_path)
+    return report
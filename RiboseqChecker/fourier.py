@@ -1,7 +1,12 @@
 '''
 Script that takes a bed file and calculates the fourier transform of the read counts
 
-
+two engines are available:
+    - vectorized: dense count vectors are built with one scatter per length bucket,
+      contigs are zero padded to the bucket length (a multiple of 3, so 1/3 is an exact
+      frequency bin) and scored with a 2-D numpy.fft.rfft. Every contig is scored
+    - loop: the original per-contig scan and fourier() scoring of the 100 most
+      abundant protein coding contigs
 '''
 import argparse
 import pandas as pd
@@ -9,6 +14,8 @@ import numpy as np
 from scipy.fftpack import fft, fftfreq
 import matplotlib.pyplot as plt
 
+from profile_store import read_profile
+
 def plot_profile(name, frame_counts):
     '''
     plot the ribosome profile given read counts
@@ -75,18 +82,113 @@ def fourier(counts):
 
     return 0
 
+# smallest padded length; keeps the +-10 bin window around 1/3 inside the rfft half spectrum
+MIN_BUCKET_LENGTH = 66
+
+# each length bucket is this much longer than the previous one
+BUCKET_GROWTH = 1.25
+
+# maximum number of matrix cells scored in one rfft call
+BATCH_CELLS = 2 ** 24
+
+
+def bucket_edges(max_length:int) -> np.ndarray:
+    '''
+    padded lengths (multiples of 3) growing geometrically up to at least max_length
+    '''
+    edges = [MIN_BUCKET_LENGTH]
+    while edges[-1] < max_length:
+        edges.append(int(np.ceil(edges[-1] * BUCKET_GROWTH / 3)) * 3)
+    return np.array(edges)
+
+
+def score_spectra(amplitudes:np.ndarray, padded_length:int) -> np.ndarray:
+    '''
+    array version of the fourier() score for a batch of rfft amplitude rows.
+
+    The peak is the highest amplitude above frequency 0.05. Rows whose peak is not
+    between 0.32 and 0.34 score 0, as do flat spectra (which fourier() rejects).
+    Otherwise the score is (max of the 20 bins around the peak - mean background) / max,
+    where the background is bins 4-10 either side of the peak summed and divided by 7.
+    '''
+    frequencies = np.fft.rfftfreq(padded_length)
+    positive = frequencies > 0.05
+    masked = np.where(positive, amplitudes, -np.inf)
+    peak = np.argmax(masked, axis=1)
+    peak_amplitude = masked[np.arange(len(masked)), peak]
+    flat = peak_amplitude == np.where(positive, amplitudes, np.inf).min(axis=1)
+
+    valid = (frequencies[peak] > 0.32) & (frequencies[peak] < 0.34) & ~flat & (peak >= 10)
+    window = np.clip(peak[:, None] + np.arange(-10, 10), 0, amplitudes.shape[1] - 1)
+    full = np.take_along_axis(amplitudes, window, axis=1)
+    background = np.concatenate([full[:, 0:7], full[:, 13:20]], axis=1).sum(axis=1) / 7
+    window_max = full.max(axis=1)
+
+    scores = np.zeros(len(amplitudes))
+    valid &= window_max > 0
+    scores[valid] = (window_max[valid] - background[valid]) / window_max[valid]
+    return scores
+
+
+def fourier_scores(df:pd.DataFrame) -> pd.DataFrame:
+    '''
+    score every contig of a bed dataframe (contig, start, end, count)
+
+    As in the loop engine each contig's vector covers positions 1 to max(start) - 1 and
+    only the first row for a position is used.
+
+    outputs:
+        dataframe with contig, length, total and fourier score in order of first appearance
+    '''
+    codes, contigs = pd.factorize(df['contig'])
+    starts = df['start'].to_numpy().astype(np.int64)
+    counts = df['count'].to_numpy().astype(np.float64)
+
+    lengths = np.zeros(len(contigs), dtype=np.int64)
+    np.maximum.at(lengths, codes, starts - 1)
+
+    # single scatter per bucket from the first row of each position inside the vector
+    keep = (starts >= 1) & (starts <= lengths[codes])
+    first = ~pd.DataFrame({'code': codes, 'start': starts}).duplicated(keep='first').to_numpy()
+    keep &= first
+    codes, starts, counts = codes[keep], starts[keep], counts[keep]
+    totals = np.bincount(codes, weights=counts, minlength=len(contigs))
+
+    scores = np.zeros(len(contigs))
+    edges = bucket_edges(lengths.max(initial=0))
+    bucket_of_contig = np.searchsorted(edges, lengths)
+    bucket_of_row = bucket_of_contig[codes]
+
+    for bucket, padded_length in enumerate(edges):
+        members = np.flatnonzero((bucket_of_contig == bucket) & (lengths > 0))
+        if not len(members):
+            continue
+        rows = np.flatnonzero(bucket_of_row == bucket)
+        row_of_contig = np.full(len(contigs), -1)
+        row_of_contig[members] = np.arange(len(members))
+
+        batch_size = max(BATCH_CELLS // padded_length, 1)
+        for batch_start in range(0, len(members), batch_size):
+            batch = members[batch_start:batch_start + batch_size]
+            batch_rows = rows[(row_of_contig[codes[rows]] >= batch_start) & (row_of_contig[codes[rows]] < batch_start + len(batch))]
+
+            dense = np.zeros((len(batch), padded_length))
+            dense[row_of_contig[codes[batch_rows]] - batch_start, starts[batch_rows] - 1] = counts[batch_rows]
+            scores[batch] = score_spectra(np.abs(np.fft.rfft(dense, axis=1)), padded_length)
+
+    return pd.DataFrame({'contig': contigs, 'length': lengths, 'total': totals, 'fourier_score': scores})
+
+
 def sort_dict_by_value(d):
     '''
     Sort a dictionary by value
     '''
     return {k: v for k, v in sorted(d.items(), key=lambda item: item[1])}
 
-def main(args):
+def main_loop(df):
     '''
-    Main function to bridge between argparse and the rest of the code.
+    original scoring of the 100 most abundant protein coding contigs
     '''
-    df = pd.read_csv(args.bed, sep="\t", header=None, names=['contig', 'start', 'end', 'count'])
-
     # Extract the start positions
     grouped = df.groupby('contig')
     #calculate totals per contig from grouped dataframe
@@ -116,9 +218,33 @@ def main(args):
         
     print(sum( [periodicity_scores[x] for x in periodicity_scores] ) / len(periodicity_scores))
 
+
+def main(args):
+    '''
+    Main function to bridge between argparse and the rest of the code.
+    '''
+    df = read_profile(args.bed)
+
+    if args.engine == 'loop':
+        main_loop(df)
+        return
+
+    scores = fourier_scores(df)
+    if args.output:
+        scores.to_csv(args.output, sep='\t', index=False)
+
+    positive = scores[scores['fourier_score'] > 0]
+    print(f"{len(positive)} of {len(scores)} contigs with a 1/3 frequency peak")
+    if len(positive):
+        print(positive['fourier_score'].mean())
+    return scores
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Calculate periodicity from a bed file')
-    parser.add_argument('--bed', help='Path to bed file')
+    parser.add_argument('--bed', help='Path to bed file or profile store')
+    parser.add_argument('--output', default=None, help='Path to write per contig scores (vectorized engine)')
+    parser.add_argument('--engine', default='vectorized', choices=['vectorized', 'loop'], help='Scoring engine')
     args = parser.parse_args()
     main(args)
 
@@ -0,0 +1,293 @@
+'''
+Periodicity of genome aligned bams (check.py -B --annotation)
+
+check_bam takes the frame of an alignment as (reference_start + offset) % 3, which only
+means something when the references are transcripts. For a genome bam the frame has to
+come from the annotated CDS, so here:
+
+    1. the CDS exons of a GTF or GFF3 annotation are grouped by transcript and one
+       transcript per gene is kept (the longest CDS). Their exons form an interval index
+       per chromosome and strand: sorted, non overlapping intervals each knowing its
+       transcript and the CDS position of its first base in transcript orientation
+    2. the a-site of every alignment is placed offset nt from its 5' end along the
+       aligned bases (so across introns), from reference_end for reverse strand reads
+    3. the a-site is looked up in the index of the read's strand and projected into CDS
+       coordinates; its frame is the CDS position % 3, so frame 0 is in frame with the
+       start codon on either strand. Reads outside annotated CDS, or on the strand
+       opposite to it, are not counted, nor are secondary and supplementary alignments
+
+Chromosomes are split into regions of region_size nt that are counted by a pool of
+worker processes. An alignment belongs to the region containing its reference_start,
+so alignments crossing a region boundary are counted once. periodicity.txt has one row
+per transcript with reads (every kept transcript with report_skipped), in annotation order.
+'''
+import argparse
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pysam
+
+from bam_check import ensure_index, select_references
+from bam_to_ribosome_profile import is_contiguous
+from calculate_periodicity import write_header, write_row
+from read_counts import count_source, read_counter
+
+
+# default size of the chromosome regions handed to workers
+REGION_SIZE = 10000000
+
+TRANSCRIPT_PATTERNS = [re.compile(r'transcript_id "([^"]+)"'), re.compile(r'Parent=(?:transcript:)?([^;,]+)')]
+GENE_PATTERNS = [re.compile(r'gene_id "([^"]+)"'), re.compile(r'gene_id=([^;]+)')]
+
+# GFF3 transcript/mRNA features: ID=transcript:X;Parent=gene:Y (Ensembl) or ID=X;Parent=Y (GENCODE)
+ID_PATTERNS = [re.compile(r'(?:^|;)ID=(?:transcript:)?([^;]+)')]
+PARENT_PATTERNS = [re.compile(r'(?:^|;)Parent=(?:gene:)?([^;,]+)')]
+
+
+def attribute(attributes: str, patterns):
+    '''
+    first match of the patterns in a GTF/GFF3 attribute column, or None
+    '''
+    for pattern in patterns:
+        match = pattern.search(attributes)
+        if match:
+            return match.group(1)
+    return None
+
+
+def read_annotation(annotation_path: str) -> dict:
+    '''
+    CDS exons per transcript from a GTF or GFF3 file. The gene of a transcript is the
+    gene_id of its CDS lines, or else (GFF3 without gene_id, e.g. Ensembl) the Parent of
+    the transcript feature the CDS lines point to
+
+    outputs:
+        {transcript: {'chrom', 'strand', 'gene', 'exons': [(start, end), ...]}} with zero based,
+        half open exons sorted by position, in order of first appearance
+    '''
+    transcripts = {}
+    parents = {}
+    with open(annotation_path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9:
+                continue
+            if fields[2] != 'CDS':
+                feature, parent = attribute(fields[8], ID_PATTERNS), attribute(fields[8], PARENT_PATTERNS)
+                if feature is not None and parent is not None:
+                    parents[feature] = parent
+                continue
+            transcript = attribute(fields[8], TRANSCRIPT_PATTERNS)
+            if transcript is None:
+                continue
+            entry = transcripts.setdefault(transcript, {
+                'chrom': fields[0], 'strand': fields[6],
+                'gene': attribute(fields[8], GENE_PATTERNS), 'exons': []})
+            entry['exons'].append((int(fields[3]) - 1, int(fields[4])))
+    for transcript, entry in transcripts.items():
+        entry['exons'].sort()
+        if entry['gene'] is None:
+            entry['gene'] = parents.get(transcript, transcript)
+    return transcripts
+
+
+def representative_transcripts(transcripts: dict) -> list:
+    '''
+    the transcript with the longest CDS of every gene (the first one on ties), in annotation order
+    '''
+    best = {}
+    for transcript, entry in transcripts.items():
+        length = sum(end - start for start, end in entry['exons'])
+        if entry['gene'] not in best or length > best[entry['gene']][1]:
+            best[entry['gene']] = (transcript, length)
+    kept = {transcript for transcript, length in best.values()}
+    return [transcript for transcript in transcripts if transcript in kept]
+
+
+def build_index(transcripts: dict, names: list) -> dict:
+    '''
+    interval index of the CDS exons of the named transcripts
+
+    outputs:
+        {(chrom, reverse): (starts, ends, transcript, cds_offset)} arrays sorted by start.
+        transcript is the position in names and cds_offset the CDS position of the exon's
+        first base in transcript orientation (its last base on the reverse strand).
+        Exons overlapping an earlier exon on the same strand are dropped
+    '''
+    intervals = {}
+    for number, transcript in enumerate(names):
+        entry = transcripts[transcript]
+        reverse = entry['strand'] == '-'
+        exons = entry['exons'][::-1] if reverse else entry['exons']
+        cds_offset = 0
+        for start, end in exons:
+            intervals.setdefault((entry['chrom'], reverse), []).append((start, end, number, cds_offset))
+            cds_offset += end - start
+
+    index = {}
+    for key, rows in intervals.items():
+        rows.sort()
+        kept, last_end = [], -1
+        for row in rows:
+            if row[0] >= last_end:
+                kept.append(row)
+                last_end = row[1]
+        starts, ends, numbers, offsets = (np.array(column, dtype=np.int64) for column in zip(*kept))
+        index[key] = (starts, ends, numbers, offsets)
+    return index
+
+
+def project(intervals, positions: np.ndarray, reverse: bool) -> tuple:
+    '''
+    transcript number and CDS position of genomic positions (-1 outside the intervals)
+    '''
+    starts, ends, numbers, offsets = intervals
+    exon = np.searchsorted(starts, positions, side='right') - 1
+    clipped = np.maximum(exon, 0)
+    inside = (exon >= 0) & (positions < ends[clipped])
+    if reverse:
+        cds_positions = offsets[clipped] + ends[clipped] - 1 - positions
+    else:
+        cds_positions = offsets[clipped] + positions - starts[clipped]
+    return np.where(inside, numbers[clipped], -1), np.where(inside, cds_positions, -1)
+
+
+def read_asite(read, offset: int):
+    '''
+    a-site of an alignment offset aligned bases from its 5' end, or None if it is shorter
+    '''
+    if is_contiguous(read) and offset < read.reference_end - read.reference_start:
+        return read.reference_end - 1 - offset if read.is_reverse else read.reference_start + offset
+    positions = read.get_reference_positions()
+    if offset >= len(positions):
+        return None
+    return positions[-1 - offset] if read.is_reverse else positions[offset]
+
+
+def count_region(bam_path: str, chrom: str, start: int, end: int, index: dict, num_transcripts: int,
+                 offset=15, source=None) -> tuple:
+    '''
+    frame counts per transcript of the alignments starting in chrom:start-end. Opens its
+    own pysam handle so that it can run in a worker process
+
+    outputs:
+        frames: (num_transcripts, 3) int64 counts by CDS frame
+        reads: alignments counted, assigned: of which in an annotated CDS on their strand
+    '''
+    count = read_counter(source)
+    asites = {False: [], True: []}
+    weights = {False: [], True: []}
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        for read in bam.fetch(chrom, start, end):
+            if read.is_unmapped or read.is_secondary or read.is_supplementary:
+                continue
+            if read.reference_start < start or read.query_alignment_length < 25:
+                continue
+            asite = read_asite(read, offset)
+            if asite is None:
+                continue
+            asites[read.is_reverse].append(asite)
+            weights[read.is_reverse].append(count(read))
+
+    frames = np.zeros(num_transcripts * 3, dtype=np.int64)
+    reads, assigned = 0, 0
+    for reverse in (False, True):
+        strand_weights = np.array(weights[reverse], dtype=np.int64)
+        reads += int(strand_weights.sum())
+        if (chrom, reverse) not in index or not len(strand_weights):
+            continue
+        numbers, cds_positions = project(index[(chrom, reverse)], np.array(asites[reverse], dtype=np.int64), reverse)
+        hit = numbers >= 0
+        assigned += int(strand_weights[hit].sum())
+        frames += np.bincount(numbers[hit] * 3 + cds_positions[hit] % 3, weights=strand_weights[hit],
+                              minlength=len(frames)).astype(np.int64)
+    return frames.reshape(-1, 3), reads, assigned
+
+
+def genome_regions(bam_path: str, chroms: list, region_size: int = REGION_SIZE) -> list:
+    '''
+    (chrom, start, end) regions of at most region_size nt covering the given chromosomes
+    '''
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        return [(chrom, start, min(start + region_size, bam.get_reference_length(chrom)))
+                for chrom in chroms for start in range(0, bam.get_reference_length(chrom), region_size)]
+
+
+def map_regions(arguments: list, num_threads=1):
+    '''
+    yield count_region results for every argument tuple, in worker processes when num_threads > 1
+    '''
+    if num_threads <= 1 or not arguments:
+        for region_arguments in arguments:
+            yield count_region(*region_arguments)
+        return
+    with ProcessPoolExecutor(max_workers=num_threads) as pool:
+        yield from pool.map(count_region, *zip(*arguments))
+
+
+def check_genome_bam(bam_path: str, annotation_path: str, output_path: str, num_threads=1, offset=15,
+                     region_size=REGION_SIZE, min_reads=0, report_skipped=False, tmp_dir=None) -> dict:
+    '''
+    strand aware frame bias of a genome aligned bam over annotated CDS
+
+    inputs:
+        bam_path: path to a genome aligned bam
+        annotation_path: GTF or GFF3 with CDS lines (transcript_id / Parent attributes)
+        output_path: path to write periodicity.txt (one row per transcript)
+        num_threads: number of worker processes counting regions
+        offset: a-site offset from the read 5' end along the aligned bases
+        region_size: chromosomes are split into regions of this many nt
+        min_reads: skip chromosomes with fewer mapped alignments in the bam index
+        report_skipped: write transcripts without reads as zero rows
+        tmp_dir: where to sort and/or index the bam if it has no index (see ensure_index)
+
+    outputs:
+        frame_counts: {transcript: {0: n, 1: n, 2: n}}
+    '''
+    bam_path = ensure_index(bam_path, num_threads, tmp_dir)
+
+    transcripts = read_annotation(annotation_path)
+    names = representative_transcripts(transcripts)
+    index = build_index(transcripts, names)
+    print(f"{len(names)} of {len(transcripts)} annotated transcripts kept (longest CDS per gene)")
+
+    # only chromosomes with annotated CDS and enough reads
+    annotated = {chrom for chrom, reverse in index}
+    chroms = [chrom for chrom in select_references(bam_path, min_reads) if chrom in annotated]
+    regions = genome_regions(bam_path, chroms, region_size)
+    source = count_source(bam_path)
+
+    frames = np.zeros((len(names), 3), dtype=np.int64)
+    reads, assigned = 0, 0
+    arguments = [(bam_path, chrom, start, end, {key: value for key, value in index.items() if key[0] == chrom},
+                  len(names), offset, source) for chrom, start, end in regions]
+    for region_frames, region_reads, region_assigned in map_regions(arguments, num_threads):
+        frames += region_frames
+        reads += region_reads
+        assigned += region_assigned
+    print(f"{assigned} of {reads} reads in annotated CDS on their strand, counted over {len(regions)} regions")
+
+    frame_counts = {}
+    with open(output_path, 'w') as f:
+        write_header(f)
+        for number, transcript in enumerate(names):
+            if frames[number].any() or report_skipped:
+                frame_counts[transcript] = {frame: int(frames[number, frame]) for frame in range(3)}
+                write_row(f, transcript, frame_counts[transcript])
+    return frame_counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Strand aware periodicity of a genome aligned bam over annotated CDS')
+    parser.add_argument('--bam', help='genome aligned bam')
+    parser.add_argument('--annotation', help='GTF or GFF3 with CDS exons')
+    parser.add_argument('--output', help='path to write periodicity.txt')
+    parser.add_argument('--threads', type=int, default=1, help='worker processes')
+    parser.add_argument('--offset', type=int, default=15, help='a-site offset from the read 5\' end')
+    parser.add_argument('--region-size', type=int, default=REGION_SIZE, help='nt per region handed to a worker')
+    args = parser.parse_args()
+
+    check_genome_bam(args.bam, args.annotation, args.output, args.threads, args.offset, args.region_size)
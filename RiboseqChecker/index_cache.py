@@ -0,0 +1,190 @@
+'''
+Persistent, content addressed cache for aligner indexes
+
+Entries are keyed by the sha256 of the reference fasta plus the build command and
+the builder's version, so the same reference indexed with the same parameters and
+tool is only built once no matter where the file lives. Concurrent runs are serialised per key with a lock file:
+the first run builds into a temporary directory and renames it into place, the
+others wait on the lock and then reuse the finished entry.
+
+The cache is limited in size. Every use touches the entry, and after a new entry
+is added the least recently used entries are removed until the cache fits. Entries
+that another run holds a lock on, or that were used within EVICTION_GRACE seconds
+(so a run that is still aligning against them is not pulled from under), are kept.
+Temporary build directories left by a crashed or killed build are removed once they
+are older than EVICTION_GRACE and no build holds their entry's lock.
+
+layout:
+    cache_dir/<key>/index.*     built index files
+    cache_dir/<key>/reference   path of the fasta the entry was built from (informational)
+    cache_dir/<key>.lock        lock file for the entry (kept after eviction)
+    cache_dir/.<key>.*/         temporary directory of a build in progress
+'''
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+
+# files are hashed in blocks of this size
+HASH_BLOCK_SIZE = 1 << 20
+
+# name of the index prefix inside an entry
+INDEX_NAME = 'index'
+
+# entries used more recently than this (seconds) are never evicted
+EVICTION_GRACE = 6 * 60 * 60
+
+
+def cache_key(reference_path: str, build_args: list) -> str:
+    '''
+    sha256 of the reference content and the build command
+    '''
+    digest = hashlib.sha256()
+    with open(reference_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    digest.update('\0'.join(build_args).encode())
+    return digest.hexdigest()
+
+
+def directory_size(path: str) -> int:
+    '''
+    total size of the files below path
+    '''
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class EntryLock:
+    '''
+    exclusive flock on cache_dir/<key>.lock for the lifetime of a with block.
+    With blocking=False, acquired is False when another process holds the lock
+    '''
+    def __init__(self, cache_dir: str, key: str, blocking: bool = True):
+        self.path = os.path.join(cache_dir, key + '.lock')
+        self.blocking = blocking
+        self.acquired = False
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.handle, flags)
+            self.acquired = True
+        except BlockingIOError:
+            self.acquired = False
+        return self
+
+    def __exit__(self, *exc):
+        if self.acquired:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+
+
+def remove_stale_builds(cache_dir: str) -> list:
+    '''
+    remove temporary build directories (.<key>.*) older than EVICTION_GRACE whose
+    entry is not locked, i.e. left behind by a build that did not finish
+
+    outputs:
+        removed: names of the removed directories
+    '''
+    removed = []
+    for name in os.listdir(cache_dir):
+        build_dir = os.path.join(cache_dir, name)
+        if not name.startswith('.') or not os.path.isdir(build_dir):
+            continue
+        if time.time() - os.path.getmtime(build_dir) < EVICTION_GRACE:
+            continue
+        with EntryLock(cache_dir, name[1:].split('.')[0], blocking=False) as lock:
+            if not lock.acquired:
+                continue
+            shutil.rmtree(build_dir, ignore_errors=True)
+        removed.append(name)
+    return removed
+
+
+def evict(cache_dir: str, max_size: int, keep: str = None) -> list:
+    '''
+    remove least recently used entries until the cache is at most max_size bytes.
+    Entries locked by another run and the entry keep are never removed. Stale
+    temporary build directories are removed first (see remove_stale_builds)
+
+    outputs:
+        removed: keys of the removed entries
+    '''
+    for name in remove_stale_builds(cache_dir):
+        print(f"Removed unfinished index build {name}")
+
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry) and not key.startswith('.'):
+            entries.append((os.path.getmtime(entry), key, directory_size(entry)))
+
+    total = sum(size for used, key, size in entries)
+    removed = []
+    for used, key, size in sorted(entries):
+        if total <= max_size:
+            break
+        if key == keep or time.time() - used < EVICTION_GRACE:
+            continue
+        with EntryLock(cache_dir, key, blocking=False) as lock:
+            if not lock.acquired:
+                continue
+            # the lock file is left in place: a run blocked on it would otherwise hold a lock
+            # on an unlinked inode while a new run locks a fresh file and builds alongside it
+            shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+        removed.append(key)
+    return removed
+
+
+def cached_index(reference_path: str, cache_dir: str, build, build_args: list, max_size: int = None) -> str:
+    '''
+    return the prefix of a cached index for reference_path, building it if needed
+
+    inputs:
+        reference_path: fasta file to index
+        cache_dir: cache directory (created if missing)
+        build: function(reference_path, prefix) that builds the index at prefix
+        build_args: build parameters, part of the cache key
+        max_size: maximum cache size in bytes (None for unlimited)
+
+    outputs:
+        prefix: index prefix to pass to the aligner
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    key = cache_key(reference_path, build_args)
+    entry = os.path.join(cache_dir, key)
+
+    with EntryLock(cache_dir, key):
+        if os.path.isdir(entry):
+            print(f"Reusing cached index {entry}")
+        else:
+            print(f"Building index into cache {entry}")
+            build_dir = tempfile.mkdtemp(prefix='.' + key + '.', dir=cache_dir)
+            try:
+                build(reference_path, os.path.join(build_dir, INDEX_NAME))
+                with open(os.path.join(build_dir, 'reference'), 'w') as f:
+                    f.write(os.path.abspath(reference_path) + '\n')
+                os.rename(build_dir, entry)
+            except BaseException:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+
+        # mark as most recently used
+        now = time.time()
+        os.utime(entry, (now, now))
+
+    if max_size is not None:
+        for removed in evict(cache_dir, max_size, keep=key):
+            print(f"Evicted cached index {removed}")
+
+    return os.path.join(entry, INDEX_NAME)
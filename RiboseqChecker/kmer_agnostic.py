@@ -0,0 +1,270 @@
+'''
+In-process agnostic mode: periodicity from a k-mer index of the collapsed reads,
+without inchworm, bowtie-build or bowtie (check.py -A --agnostic-engine kmer)
+
+    1. every k-mer of every collapsed read is encoded as a 2 bit integer and the
+       k-mers are counted (weighted by the readN_xC counts) into a sorted array
+    2. contigs are built greedily as inchworm does: starting from the most abundant
+       unused k-mer, extend right and then left one base at a time with the most
+       abundant unused k-mer that overlaps by k - 1, until none is left. Contigs
+       shorter than min_contig_length are dropped. The sorted k-mer array is the
+       index: extensions are looked up with np.searchsorted and used k-mers are
+       marked in a boolean mask, so no per k-mer python objects are created
+    3. every k-mer used by a contig remembers the contig and its position in it, so a
+       read is placed by its first k-mer that belongs to a contig (its anchor). The
+       a-site is placed offset nt downstream of the read start, as generate_profile's
+       offset mode does, and its frame is counted for the contig
+
+Reads are only placed on the forward strand (bowtie runs with --norc in the aligner
+based path) and every read is placed at most once. periodicity.txt is written in the
+usual format with one row per contig that received reads.
+'''
+import argparse
+
+import numpy as np
+
+from calculate_periodicity import write_header, write_row
+
+
+# k-mer length (at most 31 so a k-mer fits in 62 bits). Shorter than the footprints
+# so that reads starting a few nt apart still share k-mers
+KMER_LENGTH = 21
+
+# contigs shorter than this are dropped, as inchworm -L
+MIN_CONTIG_LENGTH = 100
+
+# k-mers seen fewer times than this are not used to build contigs (sequencing errors)
+MIN_KMER_COUNT = 2
+
+# the 2 bit codes of A, C, G and T, to form the 4 candidate extensions at once
+EXTENSIONS = np.arange(4, dtype=np.uint64)
+
+# 2 bit codes per ascii base, 4 for anything that is not ACGT
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+
+def read_collapsed(fasta_path: str) -> tuple:
+    '''
+    sequences and counts of a collapsed fasta (readN_xC headers, one sequence line)
+
+    outputs:
+        sequences: list of sequence bytes
+        counts: int64 array
+    '''
+    sequences, counts = [], []
+    with open(fasta_path, 'rb') as f:
+        for header in f:
+            sequences.append(next(f).rstrip())
+            name = header.rstrip()
+            counts.append(int(name.split(b'_x')[1]) if b'_x' in name else 1)
+    return sequences, np.array(counts, dtype=np.int64)
+
+
+def read_kmers(sequences: list, k: int):
+    '''
+    k-mer codes of every read, grouped by read length
+
+    outputs:
+        (read indices, codes, valid) per read length, codes is (reads, length - k + 1)
+        and valid marks windows without non ACGT bases
+    '''
+    lengths = np.array([len(sequence) for sequence in sequences])
+    for length in np.unique(lengths):
+        if length < k:
+            continue
+        reads = np.flatnonzero(lengths == length)
+        bases = BASE_CODES[np.frombuffer(b''.join(sequences[i] for i in reads), dtype=np.uint8).reshape(len(reads), length)]
+
+        windows = length - k + 1
+        codes = np.zeros((len(reads), windows), dtype=np.uint64)
+        invalid = np.zeros((len(reads), windows), dtype=bool)
+        for j in range(k):
+            column = bases[:, j:j + windows]
+            codes = (codes << np.uint64(2)) | (column & 3).astype(np.uint64)
+            invalid |= column == 4
+        yield reads, codes, ~invalid
+
+
+def count_kmers(sequences: list, counts: np.ndarray, k: int) -> tuple:
+    '''
+    sorted unique k-mer codes and their summed read counts
+    '''
+    all_codes, all_counts = [], []
+    for reads, codes, valid in read_kmers(sequences, k):
+        all_codes.append(codes[valid])
+        all_counts.append(np.broadcast_to(counts[reads][:, None], codes.shape)[valid])
+    if not all_codes:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+
+    kmers, inverse = np.unique(np.concatenate(all_codes), return_inverse=True)
+    return kmers, np.bincount(inverse.ravel(), weights=np.concatenate(all_counts), minlength=len(kmers)).astype(np.int64)
+
+
+def build_contigs(kmers: np.ndarray, abundance: np.ndarray, k: int, min_contig_length=MIN_CONTIG_LENGTH,
+                  min_kmer_count=MIN_KMER_COUNT) -> tuple:
+    '''
+    greedy k-mer extension into contigs
+
+    outputs:
+        kmer_contig: contig of every k-mer (-1 if in no kept contig)
+        kmer_position: start of every k-mer in its contig
+        contig_lengths: length of every kept contig
+        contig_kmers: k-mer indices of every kept contig in order (to spell it out)
+    '''
+    mask = np.uint64((1 << (2 * k)) - 1)
+    shift = np.uint64(2 * (k - 1))
+    two = np.uint64(2)
+    usable = abundance >= min_kmer_count
+    # usable k-mers not in a contig yet
+    available = usable.copy()
+    search = kmers.searchsorted
+
+    def best_next(candidates):
+        '''
+        index of the most abundant available k-mer among the candidates (the first
+        in ACGT order on ties), or None
+        '''
+        found = search(candidates)
+        # take(mode='clip') keeps candidates past the last k-mer in bounds, they never match
+        found = found[(kmers.take(found, mode='clip') == candidates) & available.take(found, mode='clip')]
+        if not len(found):
+            return None
+        return int(found[abundance[found].argmax()])
+
+    kmer_contig = np.full(len(kmers), -1, dtype=np.int64)
+    kmer_position = np.zeros(len(kmers), dtype=np.int64)
+    contig_lengths, contig_kmers = [], []
+
+    for seed in np.flatnonzero(usable)[np.argsort(-abundance[usable], kind='stable')]:
+        if not available[seed]:
+            continue
+        available[seed] = False
+
+        right = []
+        current = kmers[seed]
+        while True:
+            i = best_next(((current << two) & mask) | EXTENSIONS)
+            if i is None:
+                break
+            available[i] = False
+            right.append(i)
+            current = kmers[i]
+
+        left = []
+        current = kmers[seed]
+        while True:
+            i = best_next((current >> two) | (EXTENSIONS << shift))
+            if i is None:
+                break
+            available[i] = False
+            left.append(i)
+            current = kmers[i]
+
+        path = left[::-1] + [seed] + right
+        if len(path) + k - 1 < min_contig_length:
+            continue
+        contig = len(contig_lengths)
+        kmer_contig[path] = contig
+        kmer_position[path] = np.arange(len(path))
+        contig_lengths.append(len(path) + k - 1)
+        contig_kmers.append(path)
+
+    return kmer_contig, kmer_position, np.array(contig_lengths, dtype=np.int64), contig_kmers
+
+
+def contig_sequence(kmers: np.ndarray, path: list, k: int) -> str:
+    '''
+    spell out a contig from its k-mer path
+    '''
+    def decode(code):
+        return ''.join('ACGT'[(code >> (2 * (k - 1 - j))) & 3] for j in range(k))
+    codes = kmers[path].tolist()
+    return decode(codes[0]) + ''.join('ACGT'[code & 3] for code in codes[1:])
+
+
+def place_reads(sequences: list, counts: np.ndarray, kmers: np.ndarray, kmer_contig: np.ndarray,
+                kmer_position: np.ndarray, contig_lengths: np.ndarray, k: int, offset: int = 15) -> np.ndarray:
+    '''
+    frame counts per contig from reads placed by their first anchored k-mer
+
+    outputs:
+        frames: (contigs, 3) read counts by a-site position % 3
+    '''
+    frames = np.zeros(len(contig_lengths) * 3, dtype=np.int64)
+    if not len(kmers):
+        return frames.reshape(-1, 3)
+    for reads, codes, valid in read_kmers(sequences, k):
+        found = np.searchsorted(kmers, codes)
+        found[found == len(kmers)] = 0
+        anchored = valid & (kmers[found] == codes) & (kmer_contig[found] >= 0)
+
+        has_anchor = anchored.any(axis=1)
+        column = np.argmax(anchored, axis=1)[has_anchor]
+        anchor = found[has_anchor, column]
+        contig = kmer_contig[anchor]
+        asite = kmer_position[anchor] - column + offset
+
+        inside = (asite >= 0) & (asite < contig_lengths[contig])
+        frames += np.bincount(contig[inside] * 3 + asite[inside] % 3,
+                              weights=counts[reads[has_anchor]][inside], minlength=len(frames)).astype(np.int64)
+    return frames.reshape(-1, 3)
+
+
+def kmer_periodicity(fasta_path: str, output_path: str, k: int = KMER_LENGTH, offset: int = 15,
+                     min_contig_length: int = MIN_CONTIG_LENGTH, min_kmer_count: int = MIN_KMER_COUNT,
+                     contigs_path: str = None) -> str:
+    '''
+    agnostic periodicity from collapsed reads without assembly or alignment tools
+
+    inputs:
+        fasta_path: collapsed fasta (readN_xC)
+        output_path: path to write periodicity.txt
+        k: k-mer length (at most 31)
+        offset: a-site offset from the read 5' end
+        min_contig_length: drop shorter contigs
+        min_kmer_count: k-mers seen fewer times are not used for contigs
+        contigs_path: optionally write the contigs as fasta
+
+    outputs:
+        output_path
+    '''
+    if not 0 < k <= 31:
+        raise ValueError("k-mer length must be between 1 and 31")
+
+    sequences, counts = read_collapsed(fasta_path)
+    kmers, abundance = count_kmers(sequences, counts, k)
+    print(f"{len(kmers)} distinct {k}-mers from {len(sequences)} collapsed reads")
+
+    kmer_contig, kmer_position, contig_lengths, contig_kmers = build_contigs(
+        kmers, abundance, k, min_contig_length, min_kmer_count)
+    print(f"{len(contig_lengths)} contigs of at least {min_contig_length} nt")
+
+    if contigs_path:
+        with open(contigs_path, 'w') as f:
+            for contig, path in enumerate(contig_kmers):
+                f.write(f'>contig{contig}\n{contig_sequence(kmers, path, k)}\n')
+
+    frames = place_reads(sequences, counts, kmers, kmer_contig, kmer_position, contig_lengths, k, offset)
+    with open(output_path, 'w') as f:
+        write_header(f)
+        for contig in np.flatnonzero(frames.sum(axis=1)):
+            write_row(f, f'contig{contig}', {frame: int(frames[contig, frame]) for frame in range(3)})
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Agnostic periodicity from a k-mer index of collapsed reads')
+    parser.add_argument('--fasta', help='collapsed fasta (readN_xC headers)')
+    parser.add_argument('--output', help='path to write periodicity.txt')
+    parser.add_argument('--kmer', type=int, default=KMER_LENGTH, help='k-mer length (at most 31)')
+    parser.add_argument('--offset', type=int, default=15, help='a-site offset from the read 5\' end')
+    parser.add_argument('--min-contig-length', type=int, default=MIN_CONTIG_LENGTH, help='drop shorter contigs')
+    parser.add_argument('--min-kmer-count', type=int, default=MIN_KMER_COUNT, help='ignore rarer k-mers when building contigs')
+    parser.add_argument('--contigs', default=None, help='also write the contigs to this fasta')
+    args = parser.parse_args()
+
+    kmer_periodicity(args.fasta, args.output, args.kmer, args.offset, args.min_contig_length,
+                     args.min_kmer_count, args.contigs)
@@ -0,0 +1,127 @@
+'''
+Per transcript QC metrics from a single read of a ribosome profile
+
+The profile (bed or profile store) is read once and the selected metrics are
+computed from the same dataframe:
+    frame: frame0, frame1, frame2, total, periodicity as in periodicity.txt (calculate_periodicity)
+    fourier: length and the 1/3 frequency score (fourier.fourier_scores)
+    uniformity: raw and length normalized entropy of the read distribution over positions and
+        the fraction of positions covered (uniform.entropy_scores)
+
+The contig column is factorized once up front, so every metric groups by integer
+codes rather than strings. The metrics are joined into one wide table, one row per
+transcript in order of first appearance. periodicity.txt can be written from the
+same frame counts.
+'''
+import argparse
+
+import pandas as pd
+
+from calculate_periodicity import frame_counts_vectorized, write_header, write_row
+from fourier import fourier_scores
+from uniform import entropy_scores, reference_lengths
+from profile_store import read_profile
+
+
+METRICS = ['frame', 'fourier', 'uniformity']
+
+
+def parse_metrics(metrics) -> list:
+    '''
+    list of metric names from a comma separated string or a list, 'all' for every metric
+    '''
+    if isinstance(metrics, str):
+        metrics = [metric.strip() for metric in metrics.split(',') if metric.strip()]
+    if 'all' in metrics:
+        return list(METRICS)
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown or not metrics:
+        raise ValueError(f"Unknown metrics {', '.join(unknown)}, choose from {', '.join(METRICS)}")
+    return [metric for metric in METRICS if metric in metrics]
+
+
+def frame_table(frame_counts: dict) -> pd.DataFrame:
+    '''
+    periodicity.txt columns as a dataframe from {contig: {0: n, 1: n, 2: n}}
+    '''
+    rows = []
+    for contig, counts in frame_counts.items():
+        total = counts[0] + counts[1] + counts[2]
+        rows.append((contig, counts[0], counts[1], counts[2], total, max(counts.values()) / max(total, 1)))
+    return pd.DataFrame(rows, columns=['contig', 'frame0', 'frame1', 'frame2', 'total', 'periodicity'])
+
+
+def compute_metrics(df: pd.DataFrame, metrics=METRICS, periodicity_path: str = None, lengths: dict = None) -> pd.DataFrame:
+    '''
+    compute the selected metrics from a bed style dataframe (contig, start, end, count)
+
+    inputs:
+        df: profile dataframe, as read by profile_store.read_profile
+        metrics: metric names, see METRICS
+        periodicity_path: also write periodicity.txt here (requires the frame metric)
+        lengths: {contig: length} normalizing the uniformity (see uniform.entropy_scores)
+
+    outputs:
+        wide dataframe, one row per contig
+    '''
+    metrics = parse_metrics(metrics)
+    if periodicity_path and 'frame' not in metrics:
+        raise ValueError("Writing periodicity.txt requires the frame metric")
+
+    # factorize once; the metrics then factorize the categorical codes cheaply
+    if not isinstance(df['contig'].dtype, pd.CategoricalDtype):
+        codes, contigs = pd.factorize(df['contig'])
+        df = df.assign(contig=pd.Categorical.from_codes(codes, categories=contigs))
+
+    table = pd.DataFrame({'contig': pd.unique(df['contig']).astype(object)})
+
+    if 'frame' in metrics:
+        frame_counts = frame_counts_vectorized(df)
+        if periodicity_path:
+            with open(periodicity_path, 'w') as f:
+                write_header(f)
+                for contig in frame_counts:
+                    write_row(f, contig, frame_counts[contig])
+        table = table.merge(frame_table(frame_counts), on='contig', how='left')
+
+    if 'fourier' in metrics:
+        scores = fourier_scores(df)[['contig', 'length', 'fourier_score']]
+        table = table.merge(scores.astype({'contig': object}), on='contig', how='left')
+
+    if 'uniformity' in metrics:
+        entropy = entropy_scores(df, lengths)[['contig', 'positions', 'coverage', 'entropy', 'normalized_entropy']]
+        table = table.merge(entropy.astype({'contig': object}), on='contig', how='left')
+
+    return table
+
+
+def run_metrics(profile_path: str, output_path: str, metrics=METRICS, periodicity_path: str = None,
+                fasta_path: str = None, bam_path: str = None) -> str:
+    '''
+    read a profile once and write the selected metrics as a tab separated table
+
+    inputs:
+        profile_path: bed file or profile store
+        output_path: path of the metrics table
+        metrics: metric names or a comma separated string, see METRICS
+        periodicity_path: also write periodicity.txt from the same frame counts
+        fasta_path, bam_path: reference fasta or bam giving the transcript lengths for the
+            uniformity (see uniform.reference_lengths)
+    '''
+    lengths = reference_lengths(fasta_path, bam_path) if 'uniformity' in parse_metrics(metrics) else None
+    table = compute_metrics(read_profile(profile_path), metrics, periodicity_path, lengths)
+    table.to_csv(output_path, sep='\t', index=False)
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute per transcript QC metrics from a profile in one pass')
+    parser.add_argument('--bed', help='Path to the profile bed file or profile store')
+    parser.add_argument('--output', help='Path of the metrics table')
+    parser.add_argument('--metrics', default='all', help=f"Comma separated metrics to compute: {', '.join(METRICS)} or all")
+    parser.add_argument('--periodicity', default=None, help='Also write periodicity.txt to this path')
+    parser.add_argument('--fasta', default=None, help='Reference fasta for the transcript lengths of the uniformity')
+    parser.add_argument('--bam', default=None, help='Bam the profile was made from, its header gives the transcript lengths (instead of --fasta)')
+    args = parser.parse_args()
+
+    run_metrics(args.bed, args.output, args.metrics, args.periodicity, args.fasta, args.bam)
@@ -0,0 +1,188 @@
+'''
+Read length specific a-site offsets
+
+Footprints are collected in a single pass over the bam as one compact table per
+reference (read length, 5' end, strand, count; see bam_check.collect_footprints).
+An offset per read length is inferred from those tables and then applied to the
+same tables, so the bam only has to be read once.
+
+Offsets are inferred in two ways:
+    start_codon: for references with a GENCODE style |CDS:start-end| field, the most
+        common distance between the 5' end and the start codon (the p-site) is taken
+        for reads covering the start codon, and the a-site is 3 nt further
+    frame: otherwise the offset closest to the default is chosen that puts the a-sites
+        of that read length in the dominant frame of each reference
+
+The offset table is a tsv with the columns read_length, offset, method, reads and can
+be passed back in with --offsets to skip inference.
+'''
+import re
+import numpy as np
+
+
+CDS_PATTERN = re.compile(r'\|CDS:(\d+)-(\d+)\|')
+
+# candidate p-site distances from the read 5' end (inclusive)
+PSITE_RANGE = (9, 18)
+
+# reads needed at start codons before a read length is phased from them
+MIN_START_CODON_READS = 20
+
+
+def parse_cds(reference: str):
+    '''
+    zero based, half open CDS coordinates from a GENCODE style |CDS:start-end| name, or None
+    '''
+    match = CDS_PATTERN.search(reference)
+    if not match:
+        return None
+    return int(match.group(1)) - 1, int(match.group(2))
+
+
+def summarise_footprints(lengths, five_primes, reverse, counts) -> dict:
+    '''
+    collapse per read values into a table of unique (length, 5' end, strand) with summed counts
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    five_primes = np.asarray(five_primes, dtype=np.int64)
+    reverse = np.asarray(reverse, dtype=bool)
+    counts = np.asarray(counts, dtype=np.int64)
+    if not len(lengths):
+        return {'length': lengths, 'five_prime': five_primes, 'reverse': reverse, 'count': counts}
+
+    keys = np.stack([lengths, five_primes, reverse.astype(np.int64)], axis=1)
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    summed = np.bincount(inverse.ravel(), weights=counts, minlength=len(unique)).astype(np.int64)
+    return {'length': unique[:, 0], 'five_prime': unique[:, 1], 'reverse': unique[:, 2].astype(bool), 'count': summed}
+
+
+def asites(table: dict, offsets: dict, default_offset: int) -> np.ndarray:
+    '''
+    a-site position of every row of a footprint table given offsets per read length
+    '''
+    lookup = np.full(max(table['length'].max(initial=0), max(offsets, default=0)) + 1, default_offset, dtype=np.int64)
+    for length, offset in offsets.items():
+        lookup[length] = offset
+    row_offsets = lookup[table['length']]
+    return np.where(table['reverse'], table['five_prime'] - row_offsets, table['five_prime'] + row_offsets)
+
+
+def frame_counts(table: dict, offsets: dict, default_offset: int) -> dict:
+    '''
+    {0: n, 1: n, 2: n} frame counts of the a-sites in a footprint table
+    '''
+    frames = np.bincount(asites(table, offsets, default_offset) % 3, weights=table['count'], minlength=3)
+    return {frame: int(frames[frame]) for frame in range(3)}
+
+
+def profile(table: dict, length: int, offsets: dict, default_offset: int) -> np.ndarray:
+    '''
+    integer read counts per reference position from a footprint table
+    '''
+    positions = asites(table, offsets, default_offset)
+    inside = (positions >= 0) & (positions < length)
+    return np.bincount(positions[inside], weights=table['count'][inside], minlength=length).astype(np.int64)
+
+
+def offset_matrices(footprints, default_offset: int):
+    '''
+    build the inference matrices from (reference, table) pairs
+
+    outputs:
+        start_codon: {read_length: counts by distance from 5' end to the start codon}
+        frame: {read_length: counts by a-site frame relative to the reference's dominant frame}
+    '''
+    start_codon = {}
+    frame = {}
+    for reference, table in footprints:
+        if not len(table['count']):
+            continue
+
+        # frame of each length relative to the dominant frame of the reference at the default offset
+        default_frames = asites(table, {}, default_offset) % 3
+        dominant = np.argmax(np.bincount(default_frames, weights=table['count'], minlength=3))
+        relative = (default_frames - dominant) % 3
+        for length in np.unique(table['length']):
+            rows = table['length'] == length
+            frame.setdefault(int(length), np.zeros(3))
+            frame[int(length)] += np.bincount(relative[rows], weights=table['count'][rows], minlength=3)
+
+        cds = parse_cds(reference)
+        if cds is None:
+            continue
+        distance = cds[0] - table['five_prime']
+        covering = ~table['reverse'] & (distance >= 0) & (distance < table['length'])
+        for length, dist, count in zip(table['length'][covering], distance[covering], table['count'][covering]):
+            start_codon.setdefault(int(length), np.zeros(int(length)))
+            start_codon[int(length)][dist] += count
+    return start_codon, frame
+
+
+def infer_offsets(footprints, default_offset: int = 15, min_start_codon_reads: int = MIN_START_CODON_READS) -> dict:
+    '''
+    pick an a-site offset per read length from (reference, table) footprint pairs
+
+    outputs:
+        table: {read_length: (offset, method, reads)}
+    '''
+    start_codon, frame = offset_matrices(footprints, default_offset)
+    table = {}
+    for length in sorted(frame):
+        reads = int(frame[length].sum())
+        distances = start_codon.get(length)
+        low, high = PSITE_RANGE[0], min(PSITE_RANGE[1], length - 1)
+        if distances is not None and high >= low and distances[low:high + 1].sum() >= min_start_codon_reads:
+            psite = low + int(np.argmax(distances[low:high + 1]))
+            table[length] = (psite + 3, 'start_codon', reads)
+        else:
+            # shift 0 keeps the default, 1 moves one nt back, 2 one nt forward
+            shift = int(np.argmax(frame[length]))
+            table[length] = (default_offset + [0, -1, 1][shift], 'frame', reads)
+    return table
+
+
+def write_offsets(table: dict, path: str) -> str:
+    '''
+    write an inferred offset table as tsv
+    '''
+    with open(path, 'w') as f:
+        f.write('read_length\toffset\tmethod\treads\n')
+        for length in sorted(table):
+            offset, method, reads = table[length]
+            f.write(f'{length}\t{offset}\t{method}\t{reads}\n')
+    return path
+
+
+def read_offsets(path: str) -> dict:
+    '''
+    read an offset table written by write_offsets (only the first two columns are required)
+    '''
+    offsets = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if not fields[0] or not fields[0].isdigit():
+                continue
+            offsets[int(fields[0])] = int(fields[1])
+    return offsets
+
+
+def resolve_offsets(footprints, offsets, default_offset: int, offsets_out: str = None) -> dict:
+    '''
+    turn the offsets argument into {read_length: offset}
+
+    inputs:
+        footprints: (reference, table) pairs from bam_check.collect_footprints
+        offsets: 'auto' to infer from the footprints, a path to an offset table or a dictionary
+        default_offset: offset for read lengths missing from the table
+        offsets_out: where to write the inferred table (auto only)
+    '''
+    if offsets == 'auto':
+        table = infer_offsets(footprints, default_offset)
+        if offsets_out:
+            write_offsets(table, offsets_out)
+            print(f"Read length offsets written to {offsets_out}")
+        return {length: table[length][0] for length in table}
+    if isinstance(offsets, str):
+        return read_offsets(offsets)
+    return dict(offsets)
@@ -0,0 +1,190 @@
+'''
+Binary ribosome profile store
+
+A profile (the contig, start, end, count rows of a profile bed) is stored as three
+flat arrays behind a small json index, so it can be memory mapped and a single
+reference sliced out without parsing the rest of the file:
+
+    magic           8 bytes, b'RIBOPROF'
+    header length   little endian uint64
+    header          json: version, references (in file order), rows, count dtype
+    padding         to a multiple of ALIGNMENT bytes
+    offsets         int64[references + 1], rows of reference i are offsets[i]:offsets[i + 1]
+    starts          int64[rows]
+    counts          count dtype[rows]
+
+Rows keep the order they had in the bed within each reference and references keep
+their order of first appearance, so every scorer gives the same result from the
+store as from the bed it was converted from.
+'''
+import argparse
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+
+MAGIC = b'RIBOPROF'
+VERSION = 1
+ALIGNMENT = 64
+
+# default file extension of a profile store
+EXTENSION = '.rprof'
+
+
+def padding(position: int) -> int:
+    return -position % ALIGNMENT
+
+
+def write_store(store_path: str, references: list, offsets, starts, counts) -> str:
+    '''
+    write a profile store from flat arrays
+
+    inputs:
+        references: reference names in file order
+        offsets: int array of len(references) + 1 row boundaries
+        starts: a-site position of every row
+        counts: read count of every row (integer or float)
+    '''
+    offsets = np.ascontiguousarray(offsets, dtype='<i8')
+    starts = np.ascontiguousarray(starts, dtype='<i8')
+    counts = np.asarray(counts)
+    counts = np.ascontiguousarray(counts, dtype='<i8' if np.issubdtype(counts.dtype, np.integer) else '<f8')
+    if len(offsets) != len(references) + 1 or offsets[-1] != len(starts) or len(starts) != len(counts):
+        raise ValueError("offsets, starts and counts do not describe the same rows")
+
+    header = json.dumps({
+        'version': VERSION,
+        'references': list(references),
+        'rows': int(len(starts)),
+        'count_dtype': counts.dtype.str,
+    }).encode()
+
+    with open(store_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * padding(len(MAGIC) + 8 + len(header)))
+        for array in (offsets, starts, counts):
+            f.write(array.tobytes())
+            f.write(b'\0' * padding(array.nbytes))
+    return store_path
+
+
+def write_store_entries(entries, store_path: str) -> str:
+    '''
+    write a profile store from (chrom, positions, values) entries as produced for write_profile
+    '''
+    references, starts, counts = [], [], []
+    for chrom, positions, values in entries:
+        references.append(chrom)
+        starts.append(np.asarray(positions, dtype=np.int64))
+        counts.append(np.asarray(values))
+
+    offsets = np.zeros(len(references) + 1, dtype=np.int64)
+    np.cumsum([len(positions) for positions in starts], out=offsets[1:])
+    return write_store(store_path, references,
+                       offsets,
+                       np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64),
+                       np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64))
+
+
+class ProfileStore:
+    '''
+    read only, memory mapped view of a profile store
+
+    store.references    reference names in file order
+    store[reference]    (starts, counts) arrays of one reference, without reading the others
+    store.frame()       the whole profile as a bed style dataframe
+    '''
+    def __init__(self, store_path: str):
+        with open(store_path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{store_path} is not a profile store")
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length))
+        if header['version'] != VERSION:
+            raise ValueError(f"Unsupported profile store version {header['version']} in {store_path}")
+
+        self.path = store_path
+        self.references = header['references']
+        self.index = {reference: i for i, reference in enumerate(self.references)}
+        rows = header['rows']
+
+        position = len(MAGIC) + 8 + header_length
+        position += padding(position)
+        arrays = []
+        for dtype, length in (('<i8', len(self.references) + 1), ('<i8', rows), (header['count_dtype'], rows)):
+            dtype = np.dtype(dtype)
+            arrays.append(np.memmap(store_path, dtype=dtype, mode='r', offset=position, shape=(length,))
+                          if length else np.zeros(0, dtype=dtype))
+            position += length * dtype.itemsize
+            position += padding(length * dtype.itemsize)
+        self.offsets, self.starts, self.counts = arrays
+
+    def __len__(self):
+        return len(self.references)
+
+    def __contains__(self, reference):
+        return reference in self.index
+
+    def __getitem__(self, reference):
+        i = self.index[reference]
+        return self.starts[self.offsets[i]:self.offsets[i + 1]], self.counts[self.offsets[i]:self.offsets[i + 1]]
+
+    def frame(self) -> pd.DataFrame:
+        '''
+        bed style dataframe (contig, start, end, count). The contig column is categorical,
+        so no per row strings are created
+        '''
+        codes = np.repeat(np.arange(len(self.references)), np.diff(self.offsets))
+        starts = np.asarray(self.starts)
+        return pd.DataFrame({
+            'contig': pd.Categorical.from_codes(codes, categories=pd.Index(self.references, dtype=object)),
+            'start': starts,
+            'end': starts + 1,
+            'count': np.asarray(self.counts),
+        })
+
+
+def is_store(path: str) -> bool:
+    '''
+    True if path is a profile store rather than a text bed
+    '''
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_profile(path: str) -> pd.DataFrame:
+    '''
+    read a profile from a store or a bed file into a bed style dataframe
+    '''
+    if is_store(path):
+        return ProfileStore(path).frame()
+    return pd.read_csv(path, sep='\t', header=None, names=['contig', 'start', 'end', 'count'])
+
+
+def bed_to_store(bed_path: str, store_path: str = None) -> str:
+    '''
+    convert a profile bed file to a store (bed_path with EXTENSION by default)
+    '''
+    store_path = store_path or bed_path + EXTENSION
+    df = pd.read_csv(bed_path, sep='\t', header=None, names=['contig', 'start', 'end', 'count'])
+
+    # group rows by reference in order of first appearance, keeping their order within a reference
+    codes, references = pd.factorize(df['contig'])
+    order = np.argsort(codes, kind='stable')
+    offsets = np.zeros(len(references) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=len(references)), out=offsets[1:])
+    return write_store(store_path, list(references), offsets,
+                       df['start'].to_numpy()[order], df['count'].to_numpy()[order])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a profile bed file to a binary profile store')
+    parser.add_argument('--bed', help='Path to the profile bed file')
+    parser.add_argument('--output', default=None, help=f'Path of the store (default: bed path + {EXTENSION})')
+    args = parser.parse_args()
+
+    print(bed_to_store(args.bed, args.output))
@@ -0,0 +1,208 @@
+'''
+Read counts of collapsed reads as integers instead of parsing readN_xC names
+
+collapse writes one fasta record per unique read with its count in the name. Parsing
+the count back out of every alignment's query name costs a string split per read, and
+uncollapsed bams have no count at all. Counts can instead be carried as:
+
+    COUNT_TAG      integer aux tag on every alignment (tag_counts adds it to an aligned bam)
+    count table    sidecar .counts.npy written by collapse (--counts), indexed by read
+                   number: table[N] is the count of readN_xC (table[0] is unused)
+
+The counters pick the source once per bam with count_source (the tag if the first reads
+carry it, else the count table if one is given and the reads are named readN, else the
+names if they are readN_xC, else every alignment weighs 1) and then read each count
+through read_counter without testing every read. check.py -A/-O writes the count table
+next to the collapsed fasta and counts from it.
+'''
+import argparse
+import itertools
+import re
+import sys
+from array import array
+
+import numpy as np
+import pysam
+
+
+# aux tag holding the number of reads collapsed into an alignment
+COUNT_TAG = 'XC'
+
+# alignments inspected by count_source
+SOURCE_SAMPLE_READS = 100
+
+# names of collapsed reads (readN_xC, count in group 1) and of numbered reads for the
+# count table (readN or readN_xC, number in group 1)
+COLLAPSED_NAME = re.compile(r'read\d+_x(\d+)')
+NUMBERED_NAME = re.compile(r'read(\d+)(?:_x\d+)?')
+
+# counts buffered by CountTableWriter before they are written out
+TABLE_FLUSH_COUNTS = 1 << 16
+
+# bytes of the .npy header CountTableWriter reserves, so it can be rewritten in place with the final length
+TABLE_HEADER_BYTES = 128
+
+
+def name_count(name: str) -> int:
+    '''
+    count of a readN_xC name, 1 for any other name
+    '''
+    match = COLLAPSED_NAME.fullmatch(name)
+    return int(match[1]) if match else 1
+
+
+def read_count(read) -> int:
+    '''
+    number of reads collapsed into an alignment, from its count tag or readN_xC name,
+    1 if not collapsed
+    '''
+    if read.has_tag(COUNT_TAG):
+        return read.get_tag(COUNT_TAG)
+    return name_count(read.query_name)
+
+
+def count_source(bam_path: str, sample_reads: int = SOURCE_SAMPLE_READS, counts_path: str = None):
+    '''
+    where the read counts of a bam are stored, judged from its first alignments. Names
+    have to match the whole readN_xC (or readN for the table) pattern; later reads whose
+    names do not count 1
+
+    outputs:
+        'tag' (COUNT_TAG), 'table' (counts_path, by read number), 'name' (readN_xC)
+        or None (uncollapsed, every alignment counts 1)
+    '''
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        reads = list(itertools.islice(bam.fetch(until_eof=True), sample_reads))
+    if reads and all(read.has_tag(COUNT_TAG) for read in reads):
+        return 'tag'
+    if counts_path and reads and all(NUMBERED_NAME.fullmatch(read.query_name) for read in reads):
+        return 'table'
+    if reads and all(COLLAPSED_NAME.fullmatch(read.query_name) for read in reads):
+        return 'name'
+    return None
+
+
+def read_counter(source, counts_path: str = None):
+    '''
+    function returning the count of an alignment for a count_source result
+    ('table' needs the counts_path it was detected with)
+    '''
+    if source == 'tag':
+        return lambda read: read.get_tag(COUNT_TAG)
+    if source == 'table':
+        count = table_counter(counts_path)
+        return lambda read: count(read.query_name)
+    if source == 'name':
+        return lambda read: name_count(read.query_name)
+    return lambda read: 1
+
+
+def read_number(name: str) -> int:
+    '''
+    N of a readN or readN_xC name
+    '''
+    return int(name[4:].partition('_x')[0])
+
+
+def table_counter(counts_path: str):
+    '''
+    function returning the count of a readN or readN_xC name from a count table, 1 for
+    any other name
+    '''
+    # indexing a memoryview gives python ints without copying the memory mapped table
+    counts = memoryview(np.ascontiguousarray(read_count_table(counts_path)))
+
+    numbered = NUMBERED_NAME.fullmatch
+
+    def count(name: str) -> int:
+        match = numbered(name)
+        return counts[int(match[1])] if match else 1
+    return count
+
+
+class CountTableWriter:
+    '''
+    write the counts of read1, read2, ... as a count table while they are produced,
+    holding at most TABLE_FLUSH_COUNTS of them in memory. The .npy header is written
+    with room to spare and filled in with the final length on close
+    '''
+    def __init__(self, counts_path: str):
+        self.counts_path = counts_path
+        self.file = open(counts_path, 'wb')
+        self.file.write(self.header(0))
+        # table[0] is unused, read numbers start at 1
+        self.buffer = array('I', [0])
+        self.length = 1
+
+    @staticmethod
+    def header(length: int) -> bytes:
+        text = f"{{'descr': '<u4', 'fortran_order': False, 'shape': ({length},), }}"
+        preamble = np.lib.format.magic(1, 0) + (TABLE_HEADER_BYTES - 10).to_bytes(2, 'little')
+        return preamble + text.ljust(TABLE_HEADER_BYTES - 11).encode('latin1') + b'\n'
+
+    def add(self, count: int) -> None:
+        self.buffer.append(count)
+        self.length += 1
+        if len(self.buffer) >= TABLE_FLUSH_COUNTS:
+            self.flush()
+
+    def flush(self) -> None:
+        # np.dtype('<u4') on disk, array('I') is native order
+        if sys.byteorder != 'little':
+            self.buffer.byteswap()
+        self.buffer.tofile(self.file)
+        self.buffer = array('I')
+
+    def close(self) -> str:
+        self.flush()
+        self.file.seek(0)
+        self.file.write(self.header(self.length))
+        self.file.close()
+        return self.counts_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_count_table(counts_path: str) -> np.ndarray:
+    '''
+    count table indexed by read number (memory mapped)
+    '''
+    return np.load(counts_path, mmap_mode='r')
+
+
+def tag_counts(bam_path: str, output_path: str, counts_path: str = None) -> str:
+    '''
+    copy a bam adding COUNT_TAG to every alignment
+
+    inputs:
+        bam_path: bam aligned from a collapsed fasta
+        output_path: path to write the tagged bam (indexed if the input is coordinate sorted)
+        counts_path: count table written by collapse. Without it the counts are parsed
+            from the readN_xC names (1 for other names)
+
+    outputs:
+        output_path
+    '''
+    count = table_counter(counts_path) if counts_path else name_count
+    with pysam.AlignmentFile(bam_path, 'rb') as bam, \
+            pysam.AlignmentFile(output_path, 'wb', template=bam) as output:
+        sorted_by_coordinate = bam.header.to_dict().get('HD', {}).get('SO') == 'coordinate'
+        for read in bam.fetch(until_eof=True):
+            read.set_tag(COUNT_TAG, count(read.query_name), value_type='i')
+            output.write(read)
+    if sorted_by_coordinate:
+        pysam.index(output_path)
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f'Add the read count tag ({COUNT_TAG}) to a bam aligned from collapsed reads')
+    parser.add_argument('--bam', help='input bam')
+    parser.add_argument('--output', help='path to write the tagged bam')
+    parser.add_argument('--counts', default=None, help='count table written by collapse (default: parse readN_xC names)')
+    args = parser.parse_args()
+    tag_counts(args.bam, args.output, args.counts)
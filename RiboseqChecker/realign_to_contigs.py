@@ -14,32 +14,90 @@ outputs:
 import subprocess
 import argparse
 
+from index_cache import cached_index
+from stage_timer import stage
 
-def index_contigs(contigs: str, tmp_dir: str) -> str:
+
+# bowtie-build parameters (part of the index cache key)
+BUILD_ARGS = ["bowtie-build"]
+
+# default size limit of the index cache in GB
+INDEX_CACHE_SIZE_GB = 50
+
+
+def build_version() -> str:
+    '''
+    bowtie-build --version output, part of the index cache key so that an index built
+    by another bowtie version is not reused
+    '''
+    return subprocess.run(BUILD_ARGS[:1] + ['--version'], capture_output=True, text=True, check=True).stdout
+
+
+def build_index(contigs: str, prefix: str) -> str:
+    '''
+    run bowtie-build, raising if it fails
+    '''
+    cmd = BUILD_ARGS + [contigs, prefix]
+    with stage('bowtie-build', inputs=[contigs], outputs=[prefix], python=False):
+        subprocess.run(cmd, check=True)
+    return prefix
+
+
+def index_contigs(contigs: str, tmp_dir: str, index_cache=None, index_cache_size_gb=INDEX_CACHE_SIZE_GB) -> str:
     '''
-    construct bowtie index from fasta file and realign reads to contigs
+    construct bowtie index from fasta file and return its prefix
+
+    with index_cache the index is taken from (or built into) the content addressed
+    cache in that directory instead of tmp_dir (see index_cache.py), keyed by the
+    reference, BUILD_ARGS and the bowtie-build version
     '''
+    if index_cache:
+        return cached_index(contigs, index_cache, build_index, BUILD_ARGS + [build_version()],
+                            int(index_cache_size_gb * 1024 ** 3))
+
     # construct bowtie index
-    cmd = ["bowtie-build",  contigs, tmp_dir + '/contig_index']
-    subprocess.call(cmd)
+    return build_index(contigs, tmp_dir + '/contig_index')
+
+
+def bowtie_command(reads: str, tmp_dir: str, num_threads=1, sam_path=None, index_prefix=None) -> list:
+    '''
+    bowtie command reporting all alignments of the reads to the contig index as SAM.
+    Without sam_path the SAM is written to stdout. The index defaults to tmp_dir/contig_index
+    '''
+    if index_prefix is None:
+        index_prefix = tmp_dir + '/contig_index'
+    cmd = [f"bowtie", '-a', '--norc', '-p', str(num_threads),  '-v', '3', '--seedlen', '25', index_prefix, '-f', reads, '-S']
+    if sam_path:
+        cmd.append(sam_path)
+    return cmd
+
+
+def sort_command(sam_path: str, bam_path: str, num_threads=1) -> list:
+    '''
+    samtools sort command converting SAM to a sorted bam. sam_path '-' reads stdin
+    '''
+    return [f"samtools", 'sort', '-@', str(num_threads), sam_path, '-o', bam_path]
 
 
-def algin_reads_to_contigs(reads: str, tmp_dir: str, num_threads=1) -> str:
+def algin_reads_to_contigs(reads: str, tmp_dir: str, num_threads=1, index_prefix=None) -> str:
     '''
     realign reads to contigs
     '''
     # realign reads to contigs
-    cmd = [f"bowtie", '-a', '--norc', '-p', str(num_threads),  '-v', '3', '--seedlen', '25', tmp_dir + '/contig_index', '-f', reads, '-S', tmp_dir + '/contigs.sam']
+    index_prefix = index_prefix or tmp_dir + '/contig_index'
+    cmd = bowtie_command(reads, tmp_dir, num_threads, tmp_dir + '/contigs.sam', index_prefix)
     print(cmd)
-    subprocess.call(cmd)
+    with stage('bowtie', inputs=[reads, index_prefix], outputs=[tmp_dir + '/contigs.sam'], python=False):
+        subprocess.run(cmd, check=True)
 
-    cmd = [f"samtools", 'sort', '-@', str(num_threads), tmp_dir + '/contigs.sam', '-o', tmp_dir + '/contigs.bam']
-    subprocess.call(cmd)
+    cmd = sort_command(tmp_dir + '/contigs.sam', tmp_dir + '/contigs.bam', num_threads)
+    with stage('samtools sort', inputs=[tmp_dir + '/contigs.sam'], outputs=[tmp_dir + '/contigs.bam'], python=False):
+        subprocess.run(cmd, check=True)
 
     return tmp_dir + '/contigs.bam'
 
 
-def realign(contigs: str, reads: str, tmp_dir: str, num_threads=1) -> str:
+def realign(contigs: str, reads: str, tmp_dir: str, num_threads=1, index_cache=None, index_cache_size_gb=INDEX_CACHE_SIZE_GB) -> str:
     '''
     wrapper function for realigning reads to contigs
 
@@ -48,10 +106,13 @@ def realign(contigs: str, reads: str, tmp_dir: str, num_threads=1) -> str:
         reads: path to reads fastq file
         tmp_dir: path to tmp directory
         num_threads: number of threads to use
+        index_cache: optional directory of cached bowtie indexes, reused when the
+            contigs content and build parameters match
+        index_cache_size_gb: size limit of the index cache
 
     outputs:    
         bam: path to sorted bam file
     '''
-    index_contigs(contigs, tmp_dir)
-    bam = algin_reads_to_contigs(reads, tmp_dir, num_threads)
+    index_prefix = index_contigs(contigs, tmp_dir, index_cache, index_cache_size_gb)
+    bam = algin_reads_to_contigs(reads, tmp_dir, num_threads, index_prefix)
     return bam
@@ -0,0 +1,149 @@
+'''
+Frame counts per read length and transcript region (check.py -B --frame-stats)
+
+The footprint tables of bam_check.collect_footprints (one pass over the bam) are turned
+into a reads x read length x region x frame count tensor per reference:
+
+    region   5utr, cds, 3utr for references with CDS coordinates (a GENCODE style
+             |CDS:start-end| name as offsets.parse_cds reads it, or a --cds table),
+             noncoding for references without
+    frame    a-site position relative to the CDS start mod 3 (frame 0 is in frame with
+             the start codon), or the a-site position mod 3 without a CDS, as in
+             periodicity.txt
+
+a-sites are placed from the read 5' end with the read length offsets (see offsets.py).
+Only the non zero cells are written, as a tidy table with the columns reference,
+read_length, region, frame, reads. The library summary adds the tensors of all
+references up and has one row per read length and region plus an 'all' row per region,
+with the reads per frame and the fraction in the dominant frame.
+'''
+import numpy as np
+
+from offsets import parse_cds, asites
+
+
+REGIONS = ['5utr', 'cds', '3utr', 'noncoding']
+
+
+def read_cds_table(path: str) -> dict:
+    '''
+    CDS coordinates from a tsv of reference, CDS start and CDS end (1 based, inclusive as
+    in GENCODE headers). Lines whose start is not a number (a header) are skipped
+
+    outputs:
+        {reference: (start, end)} zero based, half open
+    '''
+    cds = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3 or not fields[1].isdigit():
+                continue
+            cds[fields[0]] = (int(fields[1]) - 1, int(fields[2]))
+    return cds
+
+
+def reference_cds(reference: str, cds_table: dict = None):
+    '''
+    CDS of a reference from the table if given, else from its name, or None
+    '''
+    if cds_table is not None:
+        return cds_table.get(reference)
+    return parse_cds(reference)
+
+
+def region_frame_counts(table: dict, cds, lengths: np.ndarray, offsets: dict, default_offset: int) -> np.ndarray:
+    '''
+    read counts of one footprint table by read length, region and frame
+
+    inputs:
+        table: footprint table of one reference (see offsets.summarise_footprints)
+        cds: (start, end) zero based half open, or None
+        lengths: read lengths of the tensor's first axis (ascending, including every length of the table)
+
+    outputs:
+        (len(lengths), len(REGIONS), 3) int64 array
+    '''
+    shape = (len(lengths), len(REGIONS), 3)
+    if not len(table['count']):
+        return np.zeros(shape, dtype=np.int64)
+
+    positions = asites(table, offsets, default_offset)
+    if cds is None:
+        regions = np.full(len(positions), REGIONS.index('noncoding'))
+        frames = positions % 3
+    else:
+        start, end = cds
+        regions = np.where(positions < start, 0, np.where(positions < end, 1, 2))
+        frames = (positions - start) % 3
+
+    cells = (np.searchsorted(lengths, table['length']) * len(REGIONS) + regions) * 3 + frames
+    counts = np.bincount(cells, weights=table['count'], minlength=np.prod(shape))
+    return counts.astype(np.int64).reshape(shape)
+
+
+def footprint_lengths(footprints) -> np.ndarray:
+    '''
+    sorted read lengths present in (reference, table) footprint pairs
+    '''
+    lengths = [np.unique(table['length']) for reference, table in footprints if len(table['length'])]
+    return np.unique(np.concatenate(lengths)) if lengths else np.zeros(0, dtype=np.int64)
+
+
+def write_frame_stats(footprints, stats_path: str, summary_path: str = None, offsets: dict = None,
+                      default_offset: int = 15, cds_table: dict = None) -> np.ndarray:
+    '''
+    write the tidy per reference table and the library summary
+
+    inputs:
+        footprints: (reference, table) pairs from bam_check.collect_footprints
+        stats_path: tidy table of the non zero cells per reference
+        summary_path: library summary by read length and region
+        offsets: {read_length: offset}; lengths missing use default_offset
+        cds_table: {reference: (start, end)} from read_cds_table; None parses the names
+
+    outputs:
+        library: (read lengths, regions, frames) tensor summed over references
+    '''
+    offsets = offsets or {}
+    lengths = footprint_lengths(footprints)
+    library = np.zeros((len(lengths), len(REGIONS), 3), dtype=np.int64)
+    with open(stats_path, 'w') as f:
+        f.write('reference\tread_length\tregion\tframe\treads\n')
+        for reference, table in footprints:
+            tensor = region_frame_counts(table, reference_cds(reference, cds_table), lengths, offsets, default_offset)
+            library += tensor
+            for length, region, frame in zip(*np.nonzero(tensor)):
+                f.write(f'{reference}\t{lengths[length]}\t{REGIONS[region]}\t{frame}\t{tensor[length, region, frame]}\n')
+    print(f"Frame counts by read length and region written to {stats_path}")
+
+    if summary_path:
+        write_frame_summary(library, lengths, summary_path)
+    return library
+
+
+def summary_row(f, read_length, region: str, frames: np.ndarray) -> None:
+    total = int(frames.sum())
+    dominant = frames.max() / total if total else 0.0
+    f.write(f'{read_length}\t{region}\t{total}\t{frames[0]}\t{frames[1]}\t{frames[2]}\t{dominant:.4f}\n')
+
+
+def write_frame_summary(library: np.ndarray, lengths: np.ndarray, summary_path: str) -> str:
+    '''
+    library level reads per frame by read length and region, with an 'all' row per region
+    '''
+    with open(summary_path, 'w') as f:
+        f.write('read_length\tregion\treads\tframe_0\tframe_1\tframe_2\tdominant_fraction\n')
+        for region_index, region in enumerate(REGIONS):
+            region_counts = library[:, region_index, :]
+            if not region_counts.any():
+                continue
+            for length_index in np.flatnonzero(region_counts.sum(axis=1)):
+                summary_row(f, lengths[length_index], region, region_counts[length_index])
+            summary_row(f, 'all', region, region_counts.sum(axis=0))
+
+    cds = library[:, REGIONS.index('cds'), :].sum(axis=0)
+    if cds.sum():
+        print(f"{cds[0] / cds.sum():.1%} of {cds.sum()} CDS reads in frame 0")
+    print(f"Library frame summary written to {summary_path}")
+    return summary_path
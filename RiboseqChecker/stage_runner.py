@@ -0,0 +1,119 @@
+'''
+asyncio stage runner for the fastq modes (check.py -A/-O with --overlap)
+
+Pipeline steps run as coroutines so that independent steps overlap and external tools
+stream into each other instead of going through intermediate files:
+
+    run_command       one external tool, optionally with stdout going straight to a file
+    run_pipe          producer | consumer connected by an os pipe (bowtie | samtools sort),
+                      the data never passes through python
+    run_in_thread     a blocking python step (collapse, cached bowtie-build) in a worker thread
+    run_concurrently  await several steps at once. If one fails the others are cancelled
+                      (killing their subprocesses) before the error is raised
+
+The steps of one sample are composed in check.py: in mode O the reference is indexed
+while the fastq is collapsed, and in both modes the bowtie SAM output is sorted by
+samtools as it is produced, so contigs.sam is never written.
+'''
+import asyncio
+import functools
+import os
+import subprocess
+
+from build_contigs import inchworm_command
+from realign_to_contigs import bowtie_command, sort_command
+
+
+async def wait_process(process, cmd: list) -> None:
+    '''
+    wait for a subprocess, raising CalledProcessError if it fails. When the waiting
+    task is cancelled the process is killed
+    '''
+    try:
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+async def run_command(cmd: list, stdout_path: str = None) -> None:
+    '''
+    run an external tool, writing its stdout to stdout_path if given
+    '''
+    if stdout_path is None:
+        process = await asyncio.create_subprocess_exec(*cmd)
+    else:
+        with open(stdout_path, 'wb') as f:
+            process = await asyncio.create_subprocess_exec(*cmd, stdout=f)
+    await wait_process(process, cmd)
+
+
+async def run_pipe(producer: list, consumer: list) -> None:
+    '''
+    run producer | consumer. If either fails the other is killed
+    '''
+    read_end, write_end = os.pipe()
+    try:
+        producer_process = await asyncio.create_subprocess_exec(*producer, stdout=write_end)
+        try:
+            consumer_process = await asyncio.create_subprocess_exec(*consumer, stdin=read_end)
+        except BaseException:
+            producer_process.kill()
+            await producer_process.wait()
+            raise
+    finally:
+        # the children hold their own copies, so the consumer sees end of file when the producer exits
+        os.close(read_end)
+        os.close(write_end)
+    await run_concurrently(wait_process(producer_process, producer), wait_process(consumer_process, consumer))
+
+
+async def run_in_thread(function, *args, **kwargs):
+    '''
+    run a blocking function in the default thread pool
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+
+async def run_concurrently(*steps) -> list:
+    '''
+    await the steps together and return their results in order. The first failure
+    cancels the remaining steps, waits for them to finish and is then raised.
+    Steps running in a thread cannot be interrupted and run to completion
+    '''
+    tasks = [asyncio.ensure_future(step) for step in steps]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def assemble(fa_path: str, tmp_dir: str, num_threads=1) -> str:
+    '''
+    inchworm contigs of the collapsed reads, streamed to tmp_dir/contigs.fa
+    '''
+    contigs = tmp_dir + '/contigs.fa'
+    await run_command(inchworm_command(fa_path, num_threads=num_threads), stdout_path=contigs)
+    print("Contigs outputted to ", contigs)
+    return contigs
+
+
+async def align_and_sort(reads: str, tmp_dir: str, index_prefix: str, num_threads=1) -> str:
+    '''
+    bowtie alignments of the reads sorted by samtools as they are produced
+
+    outputs:
+        bam: tmp_dir/contigs.bam
+    '''
+    bam = tmp_dir + '/contigs.bam'
+    await run_pipe(bowtie_command(reads, tmp_dir, num_threads, index_prefix=index_prefix),
+                   sort_command('-', bam, num_threads))
+    return bam
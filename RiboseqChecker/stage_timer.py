@@ -0,0 +1,210 @@
+'''
+Per stage timing and resource report (check.py --profile)
+
+Pipeline steps are wrapped in stage(name, inputs, outputs). Without an active report
+stage() does nothing, so library functions can be instrumented unconditionally. The
+with block gets the outputs list, so outputs only known at the end can be appended.
+Inside profiling(report_path) every stage records:
+
+    wall_s                wall clock time
+    cpu_s                 cpu time of this process (all threads)
+    children_cpu_s        cpu time of child processes that finished during the stage
+                          (bowtie, samtools, inchworm, process pool workers)
+    peak_rss_mb           peak resident memory of this process during the stage. On
+                          linux the high water mark is reset at the start of every
+                          stage, elsewhere it is the peak since the process started
+    children_max_rss_mb   largest peak resident memory of any child process finished so far
+    inputs, outputs       sizes in bytes of the files the stage reads and writes (an
+                          index prefix counts every file starting with it)
+
+Stages can be nested (realign contains bowtie-build, bowtie and samtools sort); nested
+stages name their parent. With a cprofile directory, python stages are also run under
+cProfile and the stats are dumped to <directory>/<n>_<stage>.prof (nested stages are
+part of their parent's dump). Stages are listed in the order they finish, start_s gives
+their start relative to the start of the run.
+'''
+import cProfile
+import glob
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+# report being recorded by profiling(), None when profiling is off
+_report = None
+
+
+def peak_rss_available() -> bool:
+    '''
+    True if the peak resident memory of this process can be reset (linux)
+    '''
+    return os.path.exists('/proc/self/clear_refs') and os.path.exists('/proc/self/status')
+
+
+def reset_peak_rss() -> None:
+    '''
+    reset the high water mark of resident memory to the current value (linux only)
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    '''
+    peak resident memory of this process in MB, since the last reset where supported
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return max_rss_mb(resource.RUSAGE_SELF)
+
+
+def max_rss_mb(who) -> float:
+    '''
+    ru_maxrss in MB (kilobytes on linux, bytes on macos)
+    '''
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def file_sizes(paths) -> dict:
+    '''
+    {path: size in bytes} of files, or of every file starting with path for prefixes
+    '''
+    sizes = {}
+    for path in paths:
+        if not path:
+            continue
+        path = str(path)
+        if os.path.isfile(path):
+            sizes[path] = os.path.getsize(path)
+        else:
+            matches = [match for match in glob.glob(glob.escape(path) + '*') if os.path.isfile(match)]
+            sizes[path] = sum(os.path.getsize(match) for match in matches) if matches else None
+    return sizes
+
+
+def fold_peak(records, peak: float) -> None:
+    '''
+    raise the peak memory seen so far by each open stage record
+    '''
+    for record in records:
+        record['nested_peak_rss_mb'] = max(record.get('nested_peak_rss_mb', 0), peak)
+
+
+class Report:
+    '''
+    stages recorded by profiling()
+    '''
+    def __init__(self, cprofile_dir=None):
+        self.cprofile_dir = cprofile_dir
+        self.stages = []
+        self.open_stages = []
+        self.profiler_active = False
+        self.start = time.perf_counter()
+
+    def as_dict(self) -> dict:
+        return {
+            'command': sys.argv,
+            'wall_s': time.perf_counter() - self.start,
+            'cpu_s': time.process_time(),
+            'children_cpu_s': children_cpu(),
+            'peak_rss_mb': max_rss_mb(resource.RUSAGE_SELF),
+            'children_max_rss_mb': max_rss_mb(resource.RUSAGE_CHILDREN),
+            'peak_rss_reset_per_stage': peak_rss_available(),
+            'stages': self.stages,
+        }
+
+
+@contextmanager
+def stage(name, inputs=(), outputs=(), python=True):
+    '''
+    record a pipeline stage when profiling is on
+
+    inputs:
+        name: stage name in the report
+        inputs, outputs: file paths (or index prefixes) whose sizes are reported
+        python: False for stages that only wait on a subprocess (never cProfiled)
+    '''
+    outputs = list(outputs)
+    report = _report
+    if report is None:
+        yield outputs
+        return
+
+    record = {'name': name, 'parent': report.open_stages[-1]['name'] if report.open_stages else None}
+
+    # keep the enclosing stages' peak before this stage resets the high water mark
+    fold_peak(report.open_stages, peak_rss_mb())
+    report.open_stages.append(record)
+
+    profiler = None
+    if python and report.cprofile_dir and not report.profiler_active:
+        profiler = cProfile.Profile()
+        report.profiler_active = True
+
+    reset_peak_rss()
+    wall, cpu, child_cpu = time.perf_counter(), time.process_time(), children_cpu()
+    record['start_s'] = wall - report.start
+    if profiler:
+        profiler.enable()
+    try:
+        yield outputs
+        record['status'] = 'ok'
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            report.profiler_active = False
+            os.makedirs(report.cprofile_dir, exist_ok=True)
+            record['cprofile'] = os.path.join(report.cprofile_dir, f"{len(report.stages)}_{name.replace(' ', '_')}.prof")
+            profiler.dump_stats(record['cprofile'])
+
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.process_time() - cpu
+        record['children_cpu_s'] = children_cpu() - child_cpu
+        record['peak_rss_mb'] = max(peak_rss_mb(), record.pop('nested_peak_rss_mb', 0))
+        record['children_max_rss_mb'] = max_rss_mb(resource.RUSAGE_CHILDREN)
+        record['inputs'] = file_sizes(inputs)
+        record['outputs'] = file_sizes(outputs)
+        report.open_stages.pop()
+        report.stages.append(record)
+        fold_peak(report.open_stages, record['peak_rss_mb'])
+
+
+@contextmanager
+def profiling(report_path=None, cprofile_dir=None):
+    '''
+    record every stage run inside the with block and write the json report to
+    report_path, also when a stage fails. Does nothing when report_path is None
+    '''
+    global _report
+    if report_path is None:
+        yield None
+        return
+
+    _report = Report(cprofile_dir)
+    try:
+        yield _report
+    finally:
+        report, _report = _report, None
+        with open(report_path, 'w') as f:
+            json.dump(report.as_dict(), f, indent=2)
+        print(f"Stage timings written to {report_path}")
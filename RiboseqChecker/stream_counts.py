@@ -0,0 +1,203 @@
+'''
+Streaming periodicity for the fastq modes (check.py -O/-A with --stream)
+
+bowtie's SAM output is read straight from a pipe and every alignment updates the
+a-site counts of its reference on the fly, so no SAM, BAM or intermediate bed file
+is written. A-sites are placed as the offset engine of generate_profile places them
+and the periodicity table is written exactly as calculate() writes it from that bed.
+The profile can optionally be written as a sorted bed and/or bigwig.
+
+a-site counts are buffered as (reference, position) keys and compacted with
+numpy every FLUSH_EVERY alignments, so memory grows with the number of distinct
+a-sites rather than with the number of alignments.
+'''
+import re
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from realign_to_contigs import bowtie_command
+from calculate_periodicity import frame_counts_vectorized, write_header, write_row
+from bam_to_ribosome_profile import write_profile
+from metrics import compute_metrics
+from read_counts import name_count, table_counter
+
+
+CIGAR_PATTERN = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# alignments buffered before the a-site keys are compacted
+FLUSH_EVERY = 1000000
+
+
+def sam_asite(flag: int, pos: int, cigar: str, offset: int):
+    '''
+    a-site of a SAM alignment (1-based pos) as offset_array computes it, or None
+    for footprints shorter than 25 nt
+    '''
+    aligned, reference, gapped = 0, 0, False
+    operations = [(int(length), operation) for length, operation in CIGAR_PATTERN.findall(cigar)]
+    for length, operation in operations:
+        if operation in 'MI=X':
+            aligned += length
+        if operation in 'MDN=X':
+            reference += length
+        if operation in 'DN':
+            gapped = True
+    if aligned < 25:
+        return None
+
+    start = pos - 1
+    reverse = flag & 16
+    if not gapped and offset < reference:
+        return start + reference - 1 - offset if reverse else start + offset
+
+    protect_nts = []
+    position = start
+    for length, operation in operations:
+        if operation in 'M=X':
+            protect_nts.extend(range(position, position + length))
+        if operation in 'MDN=X':
+            position += length
+    return protect_nts[-1 - offset] if reverse else protect_nts[offset]
+
+
+def compact(keys, counts):
+    '''
+    sum counts of equal keys
+    '''
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, np.bincount(inverse.ravel(), weights=counts, minlength=len(unique)).astype(np.int64)
+
+
+def count_sam(lines, offset=15, flush_every=FLUSH_EVERY, count=name_count):
+    '''
+    accumulate a-site counts from SAM text lines. count gives the read count of a query
+    name (readN_xC names by default, see read_counts.py)
+
+    outputs:
+        references: [(name, length)] in header order
+        keys: sorted int64 keys, reference base + position (decoded by profile_frame)
+        counts: summed read counts per key
+    '''
+    references = []
+    reference_ids = {}
+    bases = []
+    next_base = 0
+
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    buffer_keys, buffer_counts = [], []
+
+    for line in lines:
+        if line.startswith('@'):
+            if line.startswith('@SQ'):
+                tags = dict(field.split(':', 1) for field in line.rstrip('\n').split('\t')[1:])
+                reference_ids[tags['SN']] = len(references)
+                references.append((tags['SN'], int(tags['LN'])))
+                bases.append(next_base)
+                next_base += int(tags['LN']) + 1
+            continue
+
+        qname, flag, rname, pos, mapq, cigar = line.split('\t', 6)[:6]
+        flag = int(flag)
+        if flag & 4:
+            continue
+
+        asite = sam_asite(flag, int(pos), cigar, offset)
+        if asite is None:
+            continue
+        buffer_keys.append(bases[reference_ids[rname]] + asite)
+        buffer_counts.append(count(qname))
+
+        if len(buffer_keys) >= flush_every:
+            keys, counts = compact(np.concatenate([keys, buffer_keys]), np.concatenate([counts, buffer_counts]))
+            buffer_keys, buffer_counts = [], []
+
+    keys, counts = compact(np.concatenate([keys, np.array(buffer_keys, dtype=np.int64)]),
+                           np.concatenate([counts, np.array(buffer_counts, dtype=np.int64)]))
+    return references, np.array(bases, dtype=np.int64), keys, counts
+
+
+def profile_frame(references, bases, keys, counts) -> pd.DataFrame:
+    '''
+    bed style dataframe (contig, start, end, count) ordered as generate_profile writes
+    it: references sorted by name, positions ascending
+    '''
+    reference_index = np.searchsorted(bases, keys, side='right') - 1
+    positions = keys - bases[reference_index]
+
+    names = np.array([name for name, length in references], dtype=object)
+    rank = np.empty(len(references), dtype=np.int64)
+    rank[np.argsort(names, kind='stable')] = np.arange(len(references))
+    order = np.lexsort((positions, rank[reference_index]))
+
+    return pd.DataFrame({
+        'contig': names[reference_index[order]],
+        'start': positions[order],
+        'end': positions[order] + 1,
+        'count': counts[order],
+    })
+
+
+def write_periodicity(df: pd.DataFrame, output_path: str) -> str:
+    '''
+    write periodicity.txt from a profile dataframe, as calculate() does from the bed
+    '''
+    frame_counts = frame_counts_vectorized(df)
+    with open(output_path, 'w') as f:
+        write_header(f)
+        for contig in frame_counts:
+            write_row(f, contig, frame_counts[contig])
+    return output_path
+
+
+def profile_entries(df: pd.DataFrame):
+    '''
+    (chrom, positions, values) per reference for write_profile
+    '''
+    for chrom, group in df.groupby('contig', sort=False):
+        yield chrom, group['start'].to_numpy(), group['count'].to_numpy()
+
+
+def stream_periodicity(reads: str, tmp_dir: str, output_path: str, num_threads=1, offset=15,
+                       bed_path=None, bw_path=None, index_prefix=None, store_path=None,
+                       metrics=None, metrics_path=None, counts_path=None) -> str:
+    '''
+    align reads to the bowtie index in tmp_dir and count periodicity from the SAM stream
+
+    inputs:
+        reads: collapsed fasta
+        tmp_dir: directory holding contig_index (see realign_to_contigs.index_contigs)
+        output_path: path to write periodicity.txt
+        num_threads: bowtie threads
+        offset: a-site offset applied to all read lengths
+        bed_path, bw_path, store_path: optionally write the profile as a bed, bigwig and/or profile store
+        index_prefix: bowtie index to use instead of tmp_dir/contig_index
+        metrics, metrics_path: optionally write these metrics (see metrics.py) from the in memory profile
+        counts_path: count table written by collapse for the reads, else counts are parsed from the names
+
+    outputs:
+        output_path
+    '''
+    cmd = bowtie_command(reads, tmp_dir, num_threads, index_prefix=index_prefix)
+    print(cmd)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1024 * 1024)
+    try:
+        count = table_counter(counts_path) if counts_path else name_count
+        references, bases, keys, counts = count_sam(process.stdout, offset, count=count)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+    df = profile_frame(references, bases, keys, counts)
+    if bed_path or bw_path or store_path:
+        chrom_sizes = sorted(references)
+        write_profile(profile_entries(df), bed_path, bw_path, chrom_sizes, store_path)
+
+    if metrics:
+        compute_metrics(df, metrics, lengths=dict(references)).to_csv(metrics_path, sep='\t', index=False)
+
+    return write_periodicity(df, output_path)
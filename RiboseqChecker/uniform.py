@@ -1,37 +1,178 @@
 """
 Obtain a score for the uniformity of a ribosome profile
+
+The uniformity of a transcript is the shannon entropy of its reads over its positions.
+It is normalized by the largest entropy possible for the transcript (log2 of its length),
+so 1 means every position of the transcript has the same number of reads and values near
+0 mean the reads pile up on a few positions. Normalizing by the number of covered
+positions instead would give a transcript with a handful of single reads the top score.
+Lengths are read from the header of the bam the profile came from (--bam) or from the
+reference fasta (--fasta, its .fai if there is one); without either, or for contigs
+missing from them, the span of the profile (last covered position) is used.
+
+All transcripts are scored in one grouped pass (factorize the contigs, then bincount
+per contig), so the cost grows linearly with the number of bed rows.
+
+outputs:
+    tsv: contig, length, positions, coverage (fraction of positions with reads), total,
+        entropy, normalized_entropy per transcript
+    summary: library level distribution of the normalized entropy of transcripts
+        with at least --min-reads reads (quantiles and a histogram)
 """
 
 import argparse
+import os
 import pandas as pd
-from scipy.stats import kstest, uniform
+import pysam
 import numpy as np
-import math
+
+from profile_store import read_profile
+
+
+# quantiles reported in the library summary
+SUMMARY_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+# histogram bins of the normalized entropy in the library summary
+SUMMARY_BINS = 10
+
+
+def reference_lengths(fasta_path:str=None, bam_path:str=None) -> dict:
+    """
+    {contig: length} from the bam header if a bam is given, else from the fasta index
+    (fasta_path.fai) or, without one, by streaming the fasta. Nothing is written next
+    to the reference. None if neither is given
+    """
+    if bam_path:
+        with pysam.AlignmentFile(bam_path, 'rb') as bam:
+            return dict(zip(bam.references, bam.lengths))
+    if not fasta_path:
+        return None
+    if os.path.exists(fasta_path + '.fai'):
+        with open(fasta_path + '.fai') as fai:
+            return {fields[0]: int(fields[1]) for fields in (line.split('\t') for line in fai)}
+    with pysam.FastxFile(fasta_path) as fasta:
+        return {record.name: len(record.sequence) for record in fasta}
+
+
+def entropy_scores(df:pd.DataFrame, lengths:dict=None) -> pd.DataFrame:
+    """
+    shannon entropy (bits) of the read distribution over the rows of each contig and
+    the entropy normalized by log2 of the contig length, in a single grouped pass
+
+    inputs:
+        df: profile dataframe (contig, start, end, count)
+        lengths: {contig: length}. Contigs without one use their last covered position
+
+    outputs:
+        dataframe with contig, length, positions (rows with reads), coverage, total,
+        entropy and normalized_entropy in order of first appearance
+    """
+    codes, contigs = pd.factorize(df['contig'])
+    counts = df['count'].to_numpy().astype(np.float64)
+    totals = np.bincount(codes, weights=counts, minlength=len(contigs))
+
+    p = counts / np.where(totals > 0, totals, 1)[codes]
+    terms = np.zeros(len(p))
+    np.log2(p, out=terms, where=p > 0)
+    terms *= p
+
+    positions = np.bincount(codes, weights=counts > 0, minlength=len(contigs)).astype(np.int64)
+    entropy = -np.bincount(codes, weights=terms, minlength=len(contigs)) + 0.0
+
+    spans = np.zeros(len(contigs), dtype=np.int64)
+    np.maximum.at(spans, codes, df['end'].to_numpy().astype(np.int64))
+    if lengths:
+        known = np.array([lengths.get(contig, 0) for contig in contigs], dtype=np.int64)
+        spans = np.where(known > 0, known, spans)
+    contig_lengths = np.maximum(spans, positions)
+
+    # a single position is as uneven as a profile can be
+    normalized = np.zeros(len(contigs))
+    several = contig_lengths > 1
+    normalized[several] = entropy[several] / np.log2(contig_lengths[several])
+
+    return pd.DataFrame({
+        'contig': contigs,
+        'length': contig_lengths,
+        'positions': positions,
+        'coverage': positions / np.maximum(contig_lengths, 1),
+        'total': totals,
+        'entropy': entropy,
+        'normalized_entropy': normalized,
+    })
+
+
+def summarise_uniformity(scores:pd.DataFrame, min_reads:float=0) -> pd.DataFrame:
+    """
+    library summary of the normalized entropy of transcripts with at least min_reads reads
+
+    outputs:
+        two column dataframe (statistic, value): counts, mean, read weighted mean,
+        quantiles, the fraction of transcripts in each histogram bin and the mean coverage
+    """
+    kept = scores[(scores['total'] >= min_reads) & (scores['total'] > 0)]
+    values = kept['normalized_entropy'].to_numpy()
+    reads = kept['total'].to_numpy()
+
+    rows = [
+        ('transcripts', len(kept)),
+        ('transcripts_below_min_reads', len(scores) - len(kept)),
+        ('reads', reads.sum()),
+        ('mean', values.mean() if len(values) else np.nan),
+        ('read_weighted_mean', np.average(values, weights=reads) if len(values) else np.nan),
+        ('sd', values.std() if len(values) else np.nan),
+    ]
+    quantiles = np.quantile(values, SUMMARY_QUANTILES) if len(values) else [np.nan] * len(SUMMARY_QUANTILES)
+    rows += [(f'q{int(q * 100):02d}', value) for q, value in zip(SUMMARY_QUANTILES, quantiles)]
+
+    edges = np.linspace(0, 1, SUMMARY_BINS + 1)
+    histogram = np.histogram(values, bins=edges)[0] / max(len(values), 1)
+    rows += [(f'hist_{low:.1f}_{high:.1f}', fraction) for low, high, fraction in zip(edges[:-1], edges[1:], histogram)]
+    rows.append(('mean_coverage', kept['coverage'].mean() if len(kept) else np.nan))
+    return pd.DataFrame(rows, columns=['statistic', 'value'])
+
+
+def uniformity(profile_path:str, output_path:str, summary_path:str=None, min_reads:float=0,
+               fasta_path:str=None, bam_path:str=None) -> pd.DataFrame:
+    """
+    score the uniformity of every transcript of a profile and write the tables
+
+    inputs:
+        profile_path: bed file or profile store
+        output_path: per transcript tsv
+        summary_path: library summary tsv (optional)
+        min_reads: transcripts with fewer reads are left out of the summary
+        fasta_path, bam_path: reference fasta or bam giving the transcript lengths (see reference_lengths)
+
+    outputs:
+        summary dataframe
+    """
+    lengths = reference_lengths(fasta_path, bam_path)
+    scores = entropy_scores(read_profile(profile_path), lengths)
+    scores.to_csv(output_path, sep='\t', index=False)
+
+    summary = summarise_uniformity(scores, min_reads)
+    if summary_path:
+        summary.to_csv(summary_path, sep='\t', index=False)
+    return summary
+
 
 def main(args):
     """
-    wrapper function to obtain the uniformity score
-    """
-    # Read in the bed file
-    df = pd.read_csv(args.bed, sep='\t', header=None)
-    print(df)
-    # Get the read counts
-    for transcript in df[0].unique():
-        print(transcript)
-        # Get the read counts for this transcript
-        df_transcript = df[df[0] == transcript]
-        # Get the read counts
-        counts = np.array(df_transcript[3].values)
-        # calculate total number of reads
-        total_reads = sum(counts)
-        # calculate probability distribution of coverage values
-        probability_distribution = [float(count) / total_reads for count in counts]
-
-        max_entropy = -sum(p * math.log(p, 2) for p in probability_distribution if p != 0)
-        print(max_entropy)
+    wrapper function to obtain the uniformity scores
+    """
+    summary = uniformity(args.bed, args.output, args.summary, args.min_reads, args.fasta, args.bam)
+    print(summary.to_string(index=False))
+    return summary
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Obtain a score for the uniformity of a ribosome profile')
-    parser.add_argument('--bed', help='bed file containing read counts')
+    parser.add_argument('--bed', help='bed file (or profile store) containing read counts')
+    parser.add_argument('--output', help='path of the per transcript uniformity tsv')
+    parser.add_argument('--summary', default=None, help='path of the library summary tsv')
+    parser.add_argument('--min-reads', type=float, default=0, help='leave transcripts with fewer reads out of the summary')
+    parser.add_argument('--fasta', default=None, help='reference fasta for the transcript lengths (default: last covered position)')
+    parser.add_argument('--bam', default=None, help='bam the profile was made from, its header gives the transcript lengths (instead of --fasta)')
     args = parser.parse_args()
     main(args)
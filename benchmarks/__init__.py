@@ -0,0 +1,21 @@
+'''
+Benchmarks for the periodicity checker
+
+    synthetic.py    synthetic transcriptome, fastq, bam and bed generator
+    suites.py       benchmark suites of the pipeline stages (airspeed velocity layout)
+    run.py          run the suites without asv
+    bench_*.py      standalone comparison scripts for individual optimizations
+'''
+import os
+import sys
+
+
+# the pipeline modules import each other by module name, so their directory goes on the
+# path: the installed package when there is one (asv builds one per commit), else the checkout
+try:
+    import RiboseqChecker
+    RIBOSEQ_DIR = os.path.dirname(os.path.abspath(RiboseqChecker.__file__))
+except ImportError:
+    RIBOSEQ_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'RiboseqChecker')
+if RIBOSEQ_DIR not in sys.path:
+    sys.path.insert(0, RIBOSEQ_DIR)
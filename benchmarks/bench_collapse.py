@@ -0,0 +1,89 @@
+'''
+Benchmark collapse_fastq_to_single_fasta.collapse throughput against the number of workers
+
+A gzipped synthetic FASTQ with a skewed duplication profile is generated and collapsed
+with each worker count. Reads per second are reported and the collapsed counts are
+checked against the single worker result. The main process of the parallel collapse
+only decompresses and cuts the file into chunks (read_chunks); its rate is reported
+first, as no number of workers can collapse faster than that.
+
+usage:
+    python benchmarks/bench_collapse.py --reads 2000000 --workers 1 2 4 8
+'''
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RiboseqChecker'))
+
+from collapse_fastq_to_single_fasta import collapse, read_chunks
+
+
+def write_synthetic_fastq(path:str, num_reads:int, num_unique:int, seed:int=0):
+    '''
+    write a gzipped fastq with num_reads reads drawn (zipf-like) from num_unique sequences
+    '''
+    rng = np.random.default_rng(seed)
+    bases = np.array(list('ACGT'))
+    lengths = rng.integers(26, 34, size=num_unique)
+    unique = [''.join(bases[rng.integers(0, 4, size=length)]) for length in lengths]
+    picks = np.minimum(rng.zipf(1.3, size=num_reads) - 1, num_unique - 1)
+
+    with gzip.open(path, 'wt', compresslevel=1) as f:
+        for i, pick in enumerate(picks):
+            sequence = unique[pick]
+            f.write(f"@read{i}\n{sequence}\n+\n{'I' * len(sequence)}\n")
+
+
+def read_counts(fasta:str) -> dict:
+    '''
+    sequence -> count from a collapsed fasta
+    '''
+    counts = {}
+    with open(fasta) as f:
+        for header in f:
+            counts[next(f).strip()] = int(header.split('_x')[1])
+    return counts
+
+
+def main(args):
+    '''
+    generate the fastq and collapse it with each worker count
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fastq = os.path.join(tmp_dir, 'synthetic.fq.gz')
+        write_synthetic_fastq(fastq, args.reads, args.unique, seed=args.seed)
+        print(f"reads: {args.reads}  fastq.gz size: {os.path.getsize(fastq) / 1e6:.1f} MB")
+
+        start = time.perf_counter()
+        for chunk in read_chunks(fastq):
+            pass
+        elapsed = time.perf_counter() - start
+        print(f"main process reader  {elapsed:7.2f} s  {args.reads / elapsed:12,.0f} reads/s")
+
+        reference = None
+        for num_workers in args.workers:
+            fasta = os.path.join(tmp_dir, f'collapsed_{num_workers}.fa')
+            start = time.perf_counter()
+            collapse(fastq, fasta, num_workers=num_workers)
+            elapsed = time.perf_counter() - start
+
+            counts = read_counts(fasta)
+            if reference is None:
+                reference = counts
+            print(f"workers: {num_workers:>3}  {elapsed:7.2f} s  {args.reads / elapsed:12,.0f} reads/s  matches: {counts == reference}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark collapse throughput against worker count')
+    parser.add_argument('--reads', type=int, default=2000000, help='number of synthetic reads')
+    parser.add_argument('--unique', type=int, default=200000, help='number of distinct sequences')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to compare')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
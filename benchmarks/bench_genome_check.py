@@ -0,0 +1,215 @@
+'''
+Benchmark the genome coordinate mode (genome_check.check_genome_bam) on a synthetic
+genome aligned library
+
+Genes with 2 to 6 CDS exons separated by introns are placed on random strands of a few
+chromosomes. Some genes also get a shorter isoform without their last exon. Footprints
+are drawn from the CDS as benchmarks/synthetic.py draws them (frame_bias of the p-sites in
+frame 0, READ_LENGTHS, p-site PSITE_OFFSET nt from the 5' end) and written as spliced
+genome alignments (N in the cigar across introns, flag 16 on the minus strand), with the
+CDS exons as a GTF and as an Ensembl style GFF3 (gene and mRNA features, CDS lines with
+only Parent=transcript:..., so genes are found through the mRNA's Parent).
+
+check_genome_bam is timed with one worker and with --threads workers, and the fraction of
+CDS reads in frame 0 is compared with frame_bias. The GFF3 run is checked to give the
+same periodicity.txt as the GTF. check_bam's transcript frame
+((reference_start + offset) % 3 over whole chromosomes) is shown for comparison.
+
+usage:
+    python benchmarks/bench_genome_check.py --genes 2000 --reads 1000000 --threads 4
+'''
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import READ_LENGTHS, PSITE_OFFSET
+
+from genome_check import check_genome_bam
+from bam_check import check_bam
+from batch import summarise_periodicity
+
+
+def make_genome(num_genes: int, num_chroms: int, rng) -> dict:
+    '''
+    genes with CDS exons laid out along num_chroms chromosomes
+
+    outputs:
+        chrom_lengths: {chrom: length}
+        genes: list of (chrom, strand, exons) with exons as [(start, end)] ascending
+    '''
+    genes = []
+    chrom_lengths = {}
+    for chrom_number in range(num_chroms):
+        chrom = f'chr{chrom_number + 1}'
+        position = 1000
+        for _ in range(num_genes // num_chroms):
+            exons = []
+            for _ in range(rng.integers(2, 7)):
+                length = int(rng.integers(50, 300))
+                exons.append((position, position + length))
+                position += length + int(rng.integers(100, 2000))
+            genes.append((chrom, '-' if rng.random() < 0.5 else '+', exons))
+            position += int(rng.integers(1000, 20000))
+        chrom_lengths[chrom] = position + 1000
+    return {'chrom_lengths': chrom_lengths, 'genes': genes}
+
+
+def transcript_positions(strand: str, exons: list) -> np.ndarray:
+    '''
+    genomic position of every CDS base in transcript order
+    '''
+    positions = np.concatenate([np.arange(start, end) for start, end in exons])
+    return positions[::-1] if strand == '-' else positions
+
+
+def isoforms(genome: dict, rng) -> list:
+    '''
+    (chrom, strand, gene number, [(transcript, exons)]) per gene, some with a shorter
+    isoform without the last exon
+    '''
+    genes = []
+    for number, (chrom, strand, exons) in enumerate(genome['genes']):
+        transcripts = [(f'tx{number}', exons)]
+        if rng.random() < 0.3:
+            transcripts.append((f'tx{number}.short', exons[:-1]))
+        genes.append((chrom, strand, number, transcripts))
+    return genes
+
+
+def write_gtf(genes: list, path: str) -> str:
+    with open(path, 'w') as f:
+        for chrom, strand, number, transcripts in genes:
+            for transcript, exons in transcripts:
+                for start, end in exons:
+                    f.write(f'{chrom}\tsynthetic\tCDS\t{start + 1}\t{end}\t.\t{strand}\t.\t'
+                            f'gene_id "gene{number}"; transcript_id "{transcript}";\n')
+    return path
+
+
+def write_gff3(genes: list, path: str) -> str:
+    '''
+    Ensembl style GFF3: the CDS lines carry no gene_id
+    '''
+    with open(path, 'w') as f:
+        f.write('##gff-version 3\n')
+        for chrom, strand, number, transcripts in genes:
+            first, last = transcripts[0][1][0][0], transcripts[0][1][-1][1]
+            f.write(f'{chrom}\tsynthetic\tgene\t{first + 1}\t{last}\t.\t{strand}\t.\tID=gene:gene{number}\n')
+            for transcript, exons in transcripts:
+                f.write(f'{chrom}\tsynthetic\tmRNA\t{exons[0][0] + 1}\t{exons[-1][1]}\t.\t{strand}\t.\t'
+                        f'ID=transcript:{transcript};Parent=gene:gene{number}\n')
+                for start, end in exons:
+                    f.write(f'{chrom}\tsynthetic\tCDS\t{start + 1}\t{end}\t.\t{strand}\t0\t'
+                            f'ID=CDS:{transcript};Parent=transcript:{transcript}\n')
+    return path
+
+
+def cigar(positions: np.ndarray) -> list:
+    '''
+    cigar tuples of sorted aligned genomic positions (M blocks joined by N)
+    '''
+    gaps = np.flatnonzero(np.diff(positions) > 1)
+    blocks = np.split(positions, gaps + 1)
+    tuples = []
+    for block_number, block in enumerate(blocks):
+        if block_number:
+            tuples.append((3, int(block[0] - blocks[block_number - 1][-1] - 1)))
+        tuples.append((0, len(block)))
+    return tuples
+
+
+def write_genome_bam(genome: dict, num_reads: int, frame_bias: float, path: str, rng) -> str:
+    '''
+    coordinate sorted, indexed genome alignments of footprints drawn from the CDS
+    '''
+    header = {'HD': {'VN': '1.6', 'SO': 'unsorted'},
+              'SQ': [{'SN': chrom, 'LN': length} for chrom, length in genome['chrom_lengths'].items()]}
+    chrom_ids = {chrom: number for number, chrom in enumerate(genome['chrom_lengths'])}
+    genes = genome['genes']
+    positions = [transcript_positions(strand, exons) for chrom, strand, exons in genes]
+    weights = rng.lognormal(0, 1, size=len(genes))
+    drawn_genes = rng.choice(len(genes), size=num_reads, p=weights / weights.sum())
+    lengths = rng.choice(list(READ_LENGTHS), size=num_reads, p=list(READ_LENGTHS.values()))
+    frames = np.where(rng.random(num_reads) < frame_bias, 0, rng.integers(1, 3, size=num_reads))
+
+    unsorted = path + '.unsorted.bam'
+    with pysam.AlignmentFile(unsorted, 'wb', header=header) as bam:
+        for i, (gene, length, frame) in enumerate(zip(drawn_genes, lengths, frames)):
+            chrom, strand, exons = genes[gene]
+            cds_length = len(positions[gene])
+            codons = (cds_length - length) // 3
+            psite = 3 * int(rng.integers(PSITE_OFFSET // 3 + 1, codons)) + int(frame)
+            five_prime = psite - PSITE_OFFSET
+            covered = np.sort(positions[gene][five_prime:five_prime + length])
+
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f'read{i}_x1'
+            read.query_sequence = 'A' * int(length)
+            read.flag = 16 if strand == '-' else 0
+            read.reference_id = chrom_ids[chrom]
+            read.reference_start = int(covered[0])
+            read.mapping_quality = 255
+            read.cigartuples = cigar(covered)
+            bam.write(read)
+    pysam.sort('-o', path, unsorted)
+    os.remove(unsorted)
+    pysam.index(path)
+    return path
+
+
+def dominant_fraction(periodicity_path: str) -> float:
+    return summarise_periodicity(periodicity_path)['periodicity']
+
+
+def main(args):
+    '''
+    generate the genome library and time the genome mode
+    '''
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        genome = make_genome(args.genes, args.chroms, rng)
+        genes = isoforms(genome, rng)
+        gtf = write_gtf(genes, os.path.join(tmp_dir, 'cds.gtf'))
+        gff3 = write_gff3(genes, os.path.join(tmp_dir, 'cds.gff3'))
+        bam = write_genome_bam(genome, args.reads, args.frame_bias, os.path.join(tmp_dir, 'genome.bam'), rng)
+        print(f"{args.reads} reads over {args.genes} genes on {args.chroms} chromosomes, frame bias {args.frame_bias}")
+
+        for threads in sorted({1, args.threads}):
+            output = os.path.join(tmp_dir, f'genome_{threads}.txt')
+            start = time.perf_counter()
+            frame_counts = check_genome_bam(bam, gtf, output, num_threads=threads, region_size=args.region_size)
+            elapsed = time.perf_counter() - start
+            frames = np.array([[counts[frame] for frame in range(3)] for counts in frame_counts.values()]).sum(axis=0)
+            print(f"genome mode, {threads} worker(s): {elapsed:8.2f} s  frame 0 {frames[0] / frames.sum():.4f}  "
+                  f"periodicity {dominant_fraction(output):.4f}")
+
+        output = os.path.join(tmp_dir, 'gff3.txt')
+        check_genome_bam(bam, gff3, output, region_size=args.region_size)
+        same = filecmp.cmp(output, os.path.join(tmp_dir, 'genome_1.txt'), shallow=False)
+        print(f"GFF3 annotation: {'same' if same else 'DIFFERENT'} periodicity.txt as the GTF")
+
+        output = os.path.join(tmp_dir, 'transcript.txt')
+        start = time.perf_counter()
+        check_bam(bam, output)
+        print(f"transcript frame check_bam: {time.perf_counter() - start:8.2f} s  periodicity {dominant_fraction(output):.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the genome coordinate mode on synthetic spliced alignments')
+    parser.add_argument('--genes', type=int, default=2000, help='number of synthetic genes')
+    parser.add_argument('--chroms', type=int, default=4, help='number of chromosomes')
+    parser.add_argument('--reads', type=int, default=1000000, help='number of synthetic reads')
+    parser.add_argument('--frame-bias', type=float, default=0.7, help='fraction of p-sites in frame 0')
+    parser.add_argument('--region-size', type=int, default=1000000, help='nt per region handed to a worker')
+    parser.add_argument('--threads', type=int, default=4, help='worker processes')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,94 @@
+'''
+Benchmark the in-process k-mer agnostic engine against inchworm + bowtie
+
+A synthetic data set is generated and collapsed, then agnostic periodicity is computed
+with kmer_agnostic.kmer_periodicity and, when inchworm, bowtie, bowtie-build and
+samtools are on the PATH, with the assembly and realignment path of check.py -A.
+Both are timed and their scores compared with the periodicity of the true alignments
+(check_bam on the synthetic bam): the library periodicity (reads in the dominant frame
+of their contig over all reads), the median per contig periodicity and the fraction of
+reads placed.
+
+usage:
+    python benchmarks/bench_kmer_agnostic.py --transcripts 1000 --reads 1000000
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+
+from collapse_fastq_to_single_fasta import collapse
+from kmer_agnostic import kmer_periodicity, KMER_LENGTH
+from build_contigs import build_contigs
+from realign_to_contigs import realign
+from bam_to_ribosome_profile import generate_profile
+from calculate_periodicity import calculate
+from bam_check import check_bam
+from batch import summarise_periodicity
+
+
+TOOLS = ['inchworm', 'bowtie', 'bowtie-build', 'samtools']
+
+
+def aligner_path(fa_path: str, tmp_dir: str, threads: int) -> str:
+    '''
+    check.py -A with the default inchworm engine
+    '''
+    contigs = build_contigs(fa_path, tmp_dir)
+    bam = realign(contigs, fa_path, tmp_dir, num_threads=threads)
+    bed = generate_profile(bam, contigs, offset=15)
+    return calculate(bed, os.path.join(tmp_dir, 'periodicity.txt'))
+
+
+def report(name: str, elapsed, periodicity_path: str, reads: int):
+    summary = summarise_periodicity(periodicity_path)
+    timing = f"{elapsed:8.2f} s" if elapsed is not None else ' ' * 10
+    print(f"{name:>18}: {timing}  contigs {summary['contigs']:6d}  placed {summary['reads'] / reads:6.1%}  "
+          f"periodicity {summary['periodicity']:.4f}  median {summary['median_periodicity']:.4f}")
+
+
+def main(args):
+    '''
+    generate the data and run both engines
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data = generate(os.path.join(tmp_dir, 'data'), args.transcripts, args.reads, frame_bias=args.frame_bias,
+                        seed=args.seed, formats=['fastq', 'bam'])
+        fa_path = collapse(data['fastq'], os.path.join(tmp_dir, 'collapsed.fa'))
+
+        truth = os.path.join(tmp_dir, 'truth.txt')
+        check_bam(data['bam'], truth)
+        report('true alignments', None, truth, args.reads)
+
+        start = time.perf_counter()
+        kmer = kmer_periodicity(fa_path, os.path.join(tmp_dir, 'kmer.txt'), k=args.kmer)
+        report('kmer engine', time.perf_counter() - start, kmer, args.reads)
+
+        missing = [tool for tool in TOOLS if shutil.which(tool) is None]
+        if missing:
+            print(f"inchworm + bowtie path skipped, not on PATH: {', '.join(missing)}")
+            return
+
+        aligner_dir = os.path.join(tmp_dir, 'aligner')
+        os.makedirs(aligner_dir)
+        start = time.perf_counter()
+        aligned = aligner_path(fa_path, aligner_dir, args.threads)
+        report('inchworm + bowtie', time.perf_counter() - start, aligned, args.reads)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the k-mer agnostic engine against inchworm + bowtie')
+    parser.add_argument('--transcripts', type=int, default=1000, help='number of synthetic transcripts')
+    parser.add_argument('--reads', type=int, default=1000000, help='number of synthetic reads')
+    parser.add_argument('--frame-bias', type=float, default=0.7, help='fraction of CDS reads in frame 0')
+    parser.add_argument('--kmer', type=int, default=KMER_LENGTH, help='k-mer length of the kmer engine')
+    parser.add_argument('--threads', type=int, default=4, help='bowtie and samtools threads')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,93 @@
+'''
+Microbenchmark of the ribosome profile engines in bam_to_ribosome_profile
+
+A coordinate sorted synthetic bam is generated and, for every reference, the dict
+based run_offset/run_weight_centered are timed against the array based
+offset_array/weight_centered_array on the same fetched reads.
+
+usage:
+    python benchmarks/bench_profile_engine.py --references 200 --reads 500000
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RiboseqChecker'))
+
+from bam_to_ribosome_profile import run_offset, run_weight_centered, offset_array, weight_centered_array
+
+
+def write_synthetic_bam(path:str, num_references:int, num_reads:int, seed:int=0):
+    '''
+    write and index a coordinate sorted bam of collapsed (readN_xC) 28-32 nt alignments
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(500, 3000, size=num_references)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': f'tx{i}', 'LN': int(length)} for i, length in enumerate(lengths)]}
+
+    references = np.sort(rng.integers(0, num_references, size=num_reads))
+    read_lengths = rng.integers(28, 33, size=num_reads)
+    starts = (rng.random(num_reads) * (lengths[references] - read_lengths)).astype(int)
+    order = np.lexsort((starts, references))
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for i in order:
+            read = pysam.AlignedSegment()
+            read.query_name = f'read{i}_x{rng.integers(1, 10)}'
+            read.query_sequence = 'A' * int(read_lengths[i])
+            read.flag = 0
+            read.reference_id = int(references[i])
+            read.reference_start = int(starts[i])
+            read.mapping_quality = 255
+            read.cigartuples = ((0, int(read_lengths[i])),)
+            bam.write(read)
+    pysam.index(path)
+
+
+def time_engine(bam_path:str, run) -> float:
+    '''
+    total time for run(all_reads, length) over every reference
+    '''
+    elapsed = 0
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        for reference, length in zip(bam.references, bam.lengths):
+            all_reads = list(bam.fetch(reference))
+            start = time.perf_counter()
+            run(all_reads, length)
+            elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def main(args):
+    '''
+    generate the bam and time each engine
+    '''
+    engines = {
+        'dict offset': lambda reads, length: run_offset(reads, args.offset),
+        'array offset': lambda reads, length: offset_array(reads, length, args.offset),
+        'dict weight': lambda reads, length: run_weight_centered(reads),
+        'array weight': lambda reads, length: weight_centered_array(reads, length),
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bam_path = os.path.join(tmp_dir, 'synthetic.bam')
+        write_synthetic_bam(bam_path, args.references, args.reads, seed=args.seed)
+        print(f"references: {args.references}  reads: {args.reads}")
+
+        for name, run in engines.items():
+            elapsed = time_engine(bam_path, run)
+            print(f"{name:>13}: {elapsed:7.2f} s  {args.reads / elapsed:12,.0f} reads/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmark ribosome profile engines')
+    parser.add_argument('--references', type=int, default=200, help='number of synthetic references')
+    parser.add_argument('--reads', type=int, default=500000, help='number of synthetic alignments')
+    parser.add_argument('--offset', type=int, default=15, help='a-site offset')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
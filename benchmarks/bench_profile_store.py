@@ -0,0 +1,82 @@
+'''
+Benchmark reading a ribosome profile from a text bed against the binary profile store
+
+Three reads are timed:
+    full read: pd.read_csv of the bed against ProfileStore(...).frame()
+    single reference: pd.read_csv plus a filter against slicing one reference out of the store
+    periodicity: calculate() from the bed against calculate() from the store (outputs compared)
+
+usage:
+    python benchmarks/bench_profile_store.py --references 20000 --length 1500 --density 0.3
+'''
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RiboseqChecker'))
+
+from calculate_periodicity import calculate
+from profile_store import ProfileStore, bed_to_store
+
+
+def write_bed(bed_path:str, num_references:int, length:int, density:float, seed:int=0):
+    '''
+    write a sorted random profile bed with about density * length covered positions per reference
+    '''
+    rng = np.random.default_rng(seed)
+    with open(bed_path, 'w') as f:
+        for i in range(num_references):
+            positions = np.flatnonzero(rng.random(length) < density)
+            counts = rng.geometric(0.3, size=len(positions))
+            f.write(''.join(f'tx{i}\t{position}\t{position + 1}\t{count}\n' for position, count in zip(positions, counts)))
+
+
+def measure(name:str, function):
+    '''
+    print the wall time of function()
+    '''
+    start = time.perf_counter()
+    result = function()
+    print(f"{name:>28}: {time.perf_counter() - start:8.3f} s")
+    return result
+
+
+def main(args):
+    '''
+    generate the profile, convert it and time each read
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bed_path = os.path.join(tmp_dir, 'profile.bed')
+        write_bed(bed_path, args.references, args.length, args.density, seed=args.seed)
+        store_path = measure('convert bed to store', lambda: bed_to_store(bed_path))
+        print(f"bed size: {os.path.getsize(bed_path) / 1e6:.1f} MB, store size: {os.path.getsize(store_path) / 1e6:.1f} MB")
+
+        names = ['contig', 'start', 'end', 'count']
+        measure('full read, read_csv', lambda: pd.read_csv(bed_path, sep='\t', header=None, names=names))
+        measure('full read, store', lambda: ProfileStore(store_path).frame())
+
+        reference = f'tx{args.references // 2}'
+        bed_slice = measure('one reference, read_csv', lambda: (lambda df: df[df['contig'] == reference])(
+            pd.read_csv(bed_path, sep='\t', header=None, names=names)))
+        store_slice = measure('one reference, store', lambda: ProfileStore(store_path)[reference])
+        print(f"same reference slice: {np.array_equal(bed_slice['start'].to_numpy(), store_slice[0])}")
+
+        measure('periodicity from bed', lambda: calculate(bed_path, os.path.join(tmp_dir, 'bed.txt')))
+        measure('periodicity from store', lambda: calculate(store_path, os.path.join(tmp_dir, 'store.txt')))
+        print(f"identical periodicity.txt: {filecmp.cmp(os.path.join(tmp_dir, 'bed.txt'), os.path.join(tmp_dir, 'store.txt'), shallow=False)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark profile bed parsing against the binary profile store')
+    parser.add_argument('--references', type=int, default=20000, help='number of references')
+    parser.add_argument('--length', type=int, default=1500, help='length of each reference')
+    parser.add_argument('--density', type=float, default=0.3, help='fraction of positions with reads')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
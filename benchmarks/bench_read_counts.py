@@ -0,0 +1,147 @@
+'''
+Benchmark reading the collapse count of every alignment from the query name against
+the count tag (read_counts.COUNT_TAG) and the count table collapse writes
+
+A synthetic collapsed bam (readN_xC names) is written three ways: as generated, with
+the count tag added by tag_counts, and uncollapsed (every readN_xC alignment written C
+times as readN.i). A count table is written from the generated names. Two costs are
+reported:
+
+    per read: ns per alignment to get its count from pysam records already in memory
+              (the former split('_x') parse, name_count, the count table, get_tag and
+              the constant 1)
+    count_frames: wall time of check_bam's frame counting on each bam, together with
+              the former inline split('_x') loop on the collapsed names
+
+The frame counts of all bams and sources are checked to be identical.
+
+usage:
+    python benchmarks/bench_read_counts.py --transcripts 1000 --reads 1000000
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+
+from bam_check import count_frames
+from read_counts import COUNT_TAG, name_count, read_number, count_source, read_counter, tag_counts
+
+
+def split_count_frames(bam_path, references, offset=15) -> list:
+    '''
+    count_frames as it was, parsing every query name with split('_x')
+    '''
+    frame_counts = []
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        for transcript in references:
+            counts = {0: 0, 1: 0, 2: 0}
+            for read in bam.fetch(transcript):
+                if read.is_unmapped:
+                    continue
+                counts[(read.reference_start + offset) % 3] += int(read.qname.split('_x')[1])
+            frame_counts.append((transcript, counts))
+    return frame_counts
+
+
+def write_uncollapsed(bam_path: str, output_path: str) -> str:
+    '''
+    copy of a collapsed bam with every readN_xC alignment written C times
+    '''
+    with pysam.AlignmentFile(bam_path, 'rb') as bam, \
+            pysam.AlignmentFile(output_path, 'wb', template=bam) as output:
+        for read in bam.fetch(until_eof=True):
+            name = read.query_name
+            for copy in range(name_count(name)):
+                read.query_name = f"{name.partition('_x')[0]}.{copy}"
+                output.write(read)
+    pysam.index(output_path)
+    return output_path
+
+
+def write_table_from_names(bam_path: str, counts_path: str) -> str:
+    '''
+    count table of a readN_xC bam, as collapse writes it for its own reads
+    '''
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        pairs = [(read_number(read.query_name), name_count(read.query_name)) for read in bam.fetch(until_eof=True)]
+    table = np.zeros(max(number for number, count in pairs) + 1, dtype=np.uint32)
+    for number, count in pairs:
+        table[number] = count
+    np.save(counts_path, table)
+    return counts_path
+
+
+def per_read(name: str, reads: list, function):
+    '''
+    print the cost per alignment of function over records in memory
+    '''
+    start = time.perf_counter()
+    total = sum(function(read) for read in reads)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>24}: {elapsed / len(reads) * 1e9:8.1f} ns/read  (total count {total})")
+
+
+def timed(name: str, function, reads: int):
+    '''
+    print the wall time of function() and return its result
+    '''
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>24}: {elapsed:8.3f} s  {elapsed / reads * 1e9:8.1f} ns/alignment")
+    return result
+
+
+def main(args):
+    '''
+    generate the bams and time both count encodings
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data = generate(os.path.join(tmp_dir, 'data'), args.transcripts, args.reads, seed=args.seed, formats=['bam'])
+        named = data['bam']
+        tagged = tag_counts(named, os.path.join(tmp_dir, 'tagged.bam'))
+        uncollapsed = write_uncollapsed(named, os.path.join(tmp_dir, 'uncollapsed.bam'))
+        counts_path = write_table_from_names(named, os.path.join(tmp_dir, 'collapsed.counts.npy'))
+
+        with pysam.AlignmentFile(named, 'rb') as bam:
+            references = list(bam.references)
+        for path in (named, tagged, uncollapsed):
+            print(f"{os.path.basename(path)}: counts from {count_source(path)}")
+        print(f"{os.path.basename(named)} with the count table: counts from {count_source(named, counts_path=counts_path)}")
+
+        with pysam.AlignmentFile(tagged, 'rb') as bam:
+            reads = list(bam.fetch(until_eof=True))
+        print(f"per read cost over {len(reads)} collapsed alignments")
+        per_read("split('_x')", reads, lambda read: int(read.qname.split('_x')[1]))
+        per_read('name_count', reads, lambda read: name_count(read.query_name))
+        per_read('count table', reads, read_counter('table', counts_path))
+        per_read(f'get_tag({COUNT_TAG})', reads, lambda read: read.get_tag(COUNT_TAG))
+        per_read('constant 1', reads, lambda read: 1)
+
+        print('count_frames')
+        expected = timed("split('_x') names", lambda: split_count_frames(named, references), len(reads))
+        results = [
+            timed('names', lambda: count_frames(named, references), len(reads)),
+            timed('count table', lambda: count_frames(named, references, counts_path=counts_path), len(reads)),
+            timed('count tag', lambda: count_frames(tagged, references), len(reads)),
+            timed('uncollapsed', lambda: count_frames(uncollapsed, references),
+                  sum(count for frames in dict(expected).values() for count in frames.values())),
+        ]
+        print('frame counts identical' if all(result == expected for result in results) else 'frame counts DIFFER')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark read count parsing from names against the count tag')
+    parser.add_argument('--transcripts', type=int, default=1000, help='number of synthetic transcripts')
+    parser.add_argument('--reads', type=int, default=1000000, help='number of synthetic reads')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,93 @@
+'''
+Benchmark reference enumeration at the start of generate_profile
+
+Compares the previous approach (SeqIO.to_dict over the whole fasta, then sorting
+the keys) with bam_to_ribosome_profile.reference_names, which reads names from the
+bam header or the fasta .fai index. Wall time and peak python memory are reported.
+
+usage:
+    python benchmarks/bench_reference_startup.py --references 50000 --length 2000
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pysam
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RiboseqChecker'))
+
+from bam_to_ribosome_profile import reference_names
+
+
+def write_reference(fasta_path:str, bam_path:str, num_references:int, length:int, seed:int=0):
+    '''
+    write a random fasta, a read-less bam with the matching header and a .fai index
+    '''
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    with open(fasta_path, 'w') as f:
+        for i in range(num_references):
+            sequence = bases[rng.integers(0, 4, size=length)].tobytes().decode()
+            f.write(f'>tx{i}\n')
+            for start in range(0, length, 60):
+                f.write(sequence[start:start + 60] + '\n')
+
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': f'tx{i}', 'LN': length} for i in range(num_references)]}
+    with pysam.AlignmentFile(bam_path, 'wb', header=header):
+        pass
+
+
+def seqio_names(fasta_path:str) -> list:
+    '''
+    the previous enumeration in generate_profile
+    '''
+    with open(fasta_path) as in_seq_handle:
+        seq_dict = SeqIO.to_dict(SeqIO.parse(in_seq_handle, "fasta"))
+        return sorted(seq_dict.keys())
+
+
+def measure(name:str, function):
+    '''
+    print wall time and peak traced memory of function()
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    names = function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:>16}: {elapsed:7.2f} s  peak {peak / 1e6:9.1f} MB  ({len(names)} references)")
+    return names
+
+
+def main(args):
+    '''
+    generate the reference and time each enumeration
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fasta_path = os.path.join(tmp_dir, 'reference.fa')
+        bam_path = os.path.join(tmp_dir, 'empty.bam')
+        write_reference(fasta_path, bam_path, args.references, args.length, seed=args.seed)
+        print(f"fasta size: {os.path.getsize(fasta_path) / 1e6:.1f} MB")
+
+        before = measure('SeqIO.to_dict', lambda: seqio_names(fasta_path))
+        with pysam.AlignmentFile(bam_path, 'rb') as alignments:
+            header = measure('bam header', lambda: reference_names(alignments))
+            pysam.faidx(fasta_path)
+            fai = measure('fasta .fai', lambda: reference_names(alignments, fasta_path))
+        print(f"same references: {before == header == fai}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reference enumeration in generate_profile')
+    parser.add_argument('--references', type=int, default=50000, help='number of reference sequences')
+    parser.add_argument('--length', type=int, default=2000, help='length of each reference')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
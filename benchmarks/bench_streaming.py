@@ -0,0 +1,140 @@
+'''
+Compare the file based fastq pipeline with the streaming pipeline (check.py -O --stream)
+
+Both paths start from the same collapsed fasta and bowtie index:
+    file based: bowtie -> contigs.sam -> samtools sort -> contigs.bam -> bed -> periodicity.txt
+    streaming:  bowtie | stream_counts -> periodicity.txt
+
+Wall time and peak disk usage of each working directory are reported (disk usage is
+polled every 0.1 s) and the two periodicity tables are compared. Requires bowtie,
+bowtie-build and samtools on the PATH. Without --fasta/--fastq a small synthetic
+transcriptome and read set are generated.
+
+usage:
+    python benchmarks/bench_streaming.py --fasta transcripts.fa --fastq sample.fastq.gz --threads 8
+'''
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RiboseqChecker'))
+
+from collapse_fastq_to_single_fasta import collapse
+from realign_to_contigs import index_contigs, algin_reads_to_contigs
+from bam_to_ribosome_profile import generate_profile
+from calculate_periodicity import calculate
+from stream_counts import stream_periodicity
+
+
+def write_synthetic(fasta_path:str, fastq_path:str, num_transcripts:int, num_reads:int, seed:int=0):
+    '''
+    random transcripts and 28-32 nt reads starting mostly in frame 0
+    '''
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    transcripts = [bases[rng.integers(0, 4, size=int(rng.integers(600, 3000)))].tobytes().decode()
+                   for _ in range(num_transcripts)]
+    with open(fasta_path, 'w') as f:
+        for i, sequence in enumerate(transcripts):
+            f.write(f'>tx{i}\n{sequence}\n')
+
+    with open(fastq_path, 'w') as f:
+        for i in range(num_reads):
+            transcript = transcripts[rng.integers(0, num_transcripts)]
+            length = int(rng.integers(28, 33))
+            start = int(rng.integers(0, (len(transcript) - length) // 3)) * 3 + int(rng.random() < 0.2)
+            sequence = transcript[start:start + length]
+            f.write(f'@read{i}\n{sequence}\n+\n{"I" * len(sequence)}\n')
+
+
+def disk_usage(path:str) -> int:
+    '''
+    total size of the files below path
+    '''
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def measure(work_dir:str, run):
+    '''
+    run() while polling the disk usage of work_dir. Returns (seconds, peak bytes)
+    '''
+    peak = [disk_usage(work_dir)]
+    done = threading.Event()
+
+    def poll():
+        while not done.is_set():
+            peak[0] = max(peak[0], disk_usage(work_dir))
+            time.sleep(0.1)
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    start = time.perf_counter()
+    try:
+        run()
+    finally:
+        elapsed = time.perf_counter() - start
+        done.set()
+        poller.join()
+    return elapsed, max(peak[0], disk_usage(work_dir))
+
+
+def main(args):
+    '''
+    run both pipelines in separate working directories
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fasta, fastq = args.fasta, args.fastq
+        if not fasta or not fastq:
+            fasta, fastq = os.path.join(tmp_dir, 'transcripts.fa'), os.path.join(tmp_dir, 'reads.fq')
+            write_synthetic(fasta, fastq, args.transcripts, args.reads, seed=args.seed)
+
+        shared = os.path.join(tmp_dir, 'shared')
+        os.makedirs(shared)
+        collapsed = collapse(fastq, os.path.join(shared, 'collapsed.fa'), num_workers=args.threads)
+        index_contigs(fasta, shared)
+
+        outputs = {}
+        for name in ['file based', 'streaming']:
+            work_dir = os.path.join(tmp_dir, name.replace(' ', '_'))
+            shutil.copytree(shared, work_dir)
+            baseline = disk_usage(work_dir)
+            outputs[name] = os.path.join(work_dir, 'periodicity.txt')
+
+            if name == 'file based':
+                def run():
+                    bam = algin_reads_to_contigs(collapsed, work_dir, args.threads)
+                    calculate(generate_profile(bam, fasta, offset=15), outputs['file based'])
+            else:
+                def run():
+                    stream_periodicity(collapsed, work_dir, outputs['streaming'], num_threads=args.threads, offset=15)
+
+            elapsed, peak = measure(work_dir, run)
+            print(f"{name:>10}: {elapsed:8.2f} s  peak disk above index+reads {(peak - baseline) / 1e6:10.1f} MB")
+
+        print(f"identical periodicity.txt: {filecmp.cmp(outputs['file based'], outputs['streaming'], shallow=False)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare file based and streaming fastq pipelines')
+    parser.add_argument('--fasta', default=None, help='reference transcriptome (synthetic if omitted)')
+    parser.add_argument('--fastq', default=None, help='reads (synthetic if omitted)')
+    parser.add_argument('--transcripts', type=int, default=2000, help='synthetic transcripts')
+    parser.add_argument('--reads', type=int, default=1000000, help='synthetic reads')
+    parser.add_argument('--threads', type=int, default=1, help='bowtie/samtools threads')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,112 @@
+'''
+Run the benchmark suites without asv
+
+Every suite's setup_cache runs once in a scratch directory, then each time_* method
+is run --repeat times per parameter and the best and median wall times are printed
+(peakmem_* methods report the peak resident memory of one run instead). With --json
+the results are saved together with the current git commit, so runs on different
+commits can be compared.
+
+usage:
+    python -m benchmarks.run
+    python -m benchmarks.run --suite Calculate Fourier --sizes 100000 --repeat 5
+'''
+import argparse
+import inspect
+import itertools
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import suites
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def suite_classes(names=None) -> list:
+    classes = [cls for name, cls in inspect.getmembers(suites, inspect.isclass)
+               if issubclass(cls, suites.Suite) and cls is not suites.Suite]
+    return [cls for cls in classes if not names or cls.__name__ in names]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def run_benchmark(instance, method, data, params, repeat: int) -> dict:
+    '''
+    time (or measure the memory of) one benchmark method for one parameter combination
+    '''
+    times = []
+    for _ in range(1 if method.__name__.startswith('peakmem_') else repeat):
+        instance.setup(data, *params)
+        try:
+            start = time.perf_counter()
+            method(data, *params)
+            times.append(time.perf_counter() - start)
+        finally:
+            instance.teardown(data, *params)
+
+    result = {'best_s': min(times), 'median_s': statistics.median(times), 'repeat': len(times)}
+    if method.__name__.startswith('peakmem_'):
+        # peak of the whole process, so only meaningful relative to other runs of this script
+        result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def main(args):
+    '''
+    run the selected suites and print (and optionally save) the results
+    '''
+    if args.sizes:
+        suites.SIZES[:] = args.sizes
+        for cls in suite_classes():
+            cls.params = [suites.SIZES]
+
+    results = {'commit': git_commit(), 'benchmarks': []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            for cls in suite_classes(args.suite):
+                instance = cls()
+                print(f"{cls.__name__}: generating data")
+                data = instance.setup_cache()
+                methods = [getattr(instance, name) for name in dir(instance)
+                           if name.startswith(('time_', 'peakmem_'))]
+                for method, params in itertools.product(methods, itertools.product(*cls.params)):
+                    result = run_benchmark(instance, method, data, params, args.repeat)
+                    name = f"{cls.__name__}.{method.__name__}"
+                    label = ', '.join(f'{key}={value}' for key, value in zip(cls.param_names, params))
+                    memory = f"  peak {result['peak_rss_mb']:.0f} MB" if 'peak_rss_mb' in result else ''
+                    print(f"  {name:<45} {label:<15} best {result['best_s']:8.3f} s  median {result['median_s']:8.3f} s{memory}")
+                    results['benchmarks'].append(dict(name=name, params=dict(zip(cls.param_names, params)), **result))
+        finally:
+            os.chdir(cwd)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmark suites on synthetic data')
+    parser.add_argument('--suite', nargs='+', default=None, help='suites to run (default: all)')
+    parser.add_argument('--sizes', nargs='+', type=int, default=None, help=f'numbers of reads (default: {suites.SIZES})')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark')
+    parser.add_argument('--json', default=None, help='write the results to this json file')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,124 @@
+'''
+Benchmark suites for the main pipeline stages, on synthetic data
+
+The classes follow airspeed velocity conventions (setup_cache, params, time_* and
+peakmem_* methods), so `asv run` (see asv.conf.json at the top of the repository)
+tracks them across commits. They can also be run without asv:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --suite CheckBam --repeat 5 --json results.json
+
+setup_cache generates every data set once into the working directory; the size
+parameter is the number of reads.
+'''
+import os
+import shutil
+import tempfile
+
+from benchmarks import RIBOSEQ_DIR  # noqa: F401 (puts the pipeline modules on the path)
+from benchmarks.synthetic import generate
+
+from collapse_fastq_to_single_fasta import collapse, read_chunks
+from bam_check import check_bam
+from bam_to_ribosome_profile import generate_profile
+from calculate_periodicity import calculate, read_bed
+from fourier import fourier_scores
+
+
+# reads per data set (transcripts scale with them)
+SIZES = [100000, 1000000]
+
+
+def data_set(size: int) -> str:
+    return os.path.abspath(f'synthetic_{size}')
+
+
+def generate_all(formats) -> dict:
+    '''
+    {size: {format: path}} for every size, generated into the working directory
+    '''
+    return {size: generate(data_set(size), num_transcripts=max(size // 1000, 100), num_reads=size, formats=formats)
+            for size in SIZES}
+
+
+class Suite:
+    '''
+    a scratch directory per benchmark for outputs
+    '''
+    params = [SIZES]
+    param_names = ['reads']
+    timeout = 600
+
+    def setup(self, data, size):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self, data, size):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class Collapse(Suite):
+    def setup_cache(self):
+        return generate_all(['fastq'])
+
+    def time_collapse(self, data, size):
+        collapse(data[size]['fastq'], os.path.join(self.tmp_dir, 'collapsed.fa'))
+
+    def time_collapse_parallel(self, data, size):
+        collapse(data[size]['fastq'], os.path.join(self.tmp_dir, 'collapsed.fa'), num_workers=4)
+
+    def time_read_chunks(self, data, size):
+        # the main process share of time_collapse_parallel: the ceiling on its throughput
+        for chunk in read_chunks(data[size]['fastq']):
+            pass
+
+    def peakmem_collapse(self, data, size):
+        collapse(data[size]['fastq'], os.path.join(self.tmp_dir, 'collapsed.fa'))
+
+
+class CheckBam(Suite):
+    def setup_cache(self):
+        return generate_all(['bam'])
+
+    def time_check_bam(self, data, size):
+        check_bam(data[size]['bam'], os.path.join(self.tmp_dir, 'periodicity.txt'))
+
+    def time_check_bam_offsets(self, data, size):
+        check_bam(data[size]['bam'], os.path.join(self.tmp_dir, 'periodicity.txt'), offsets='auto')
+
+
+class GenerateProfile(Suite):
+    def setup_cache(self):
+        return generate_all(['bam'])
+
+    def setup(self, data, size):
+        # generate_profile writes next to the bam, so work on a copy
+        super().setup(data, size)
+        self.bam = os.path.join(self.tmp_dir, 'alignments.bam')
+        shutil.copy(data[size]['bam'], self.bam)
+        shutil.copy(data[size]['bam'] + '.bai', self.bam + '.bai')
+
+    def time_generate_profile(self, data, size):
+        generate_profile(self.bam, offset=15)
+
+    def time_generate_profile_store(self, data, size):
+        generate_profile(self.bam, offset=15, create_bed=False, create_store=True)
+
+
+class Calculate(Suite):
+    def setup_cache(self):
+        return generate_all(['bed'])
+
+    def time_calculate(self, data, size):
+        calculate(data[size]['bed'], os.path.join(self.tmp_dir, 'periodicity.txt'))
+
+
+class Fourier(Suite):
+    def setup_cache(self):
+        return generate_all(['bed'])
+
+    def setup(self, data, size):
+        super().setup(data, size)
+        self.df = read_bed(data[size]['bed'])
+
+    def time_fourier_scores(self, data, size):
+        fourier_scores(self.df)
@@ -0,0 +1,236 @@
+'''
+Synthetic Ribo-seq data for the benchmarks
+
+A random transcriptome is generated with a 5' UTR, a CDS and a 3' UTR per transcript
+(GENCODE style names, ...|CDS:start-end|, so offsets.parse_cds finds the CDS).
+Footprints are drawn from it with:
+    expression      lognormal transcript weights
+    cds_fraction    fraction of footprints whose p-site is in the CDS, the rest are in the UTRs
+    start_peak      fraction of CDS footprints with the p-site on the start codon (initiating ribosomes)
+    frame_bias      fraction of CDS p-sites in frame 0, the rest split between frames 1 and 2
+    read lengths    READ_LENGTHS, the p-site PSITE_OFFSET nt from the 5' end
+    duplication     fraction of reads that are exact copies of an earlier read
+
+and written as any of:
+    transcripts.fa      the transcriptome (with a .fai index)
+    reads.fq.gz         one fastq record per read
+    alignments.bam      coordinate sorted and indexed, identical alignments collapsed
+                        into one record named readN_xCOUNT as collapse() names them
+    profile.bed         a-site profile at BED_OFFSET from the 5' end, ordered as
+                        generate_profile writes it (references by name, positions ascending)
+
+Everything is generated from the seed, so the same arguments give the same files.
+
+usage:
+    python -m benchmarks.synthetic --output synthetic --transcripts 1000 --reads 1000000
+'''
+import argparse
+import gzip
+import os
+
+import numpy as np
+import pysam
+
+
+# read length: probability
+READ_LENGTHS = {28: 0.15, 29: 0.25, 30: 0.3, 31: 0.2, 32: 0.1}
+
+# distance from the 5' end to the p-site for every read length
+PSITE_OFFSET = 12
+
+# a-site offset used for the bed profile (generate_profile's offset mode)
+BED_OFFSET = 15
+
+FORMATS = ['fasta', 'fastq', 'bam', 'bed']
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def make_transcriptome(num_transcripts: int, rng) -> dict:
+    '''
+    random transcripts with UTRs and a CDS starting with ATG and ending with a stop codon
+
+    outputs:
+        dictionary of arrays: name, sequence (bytes), cds_start (0 based), cds_end (exclusive), length
+    '''
+    utr5 = rng.integers(50, 151, size=num_transcripts)
+    cds = rng.integers(100, 501, size=num_transcripts) * 3
+    utr3 = rng.integers(50, 201, size=num_transcripts)
+
+    names, sequences = [], []
+    for i in range(num_transcripts):
+        sequence = BASES[rng.integers(0, 4, size=utr5[i] + cds[i] + utr3[i])]
+        sequence[utr5[i]:utr5[i] + 3] = np.frombuffer(b'ATG', dtype=np.uint8)
+        sequence[utr5[i] + cds[i] - 3:utr5[i] + cds[i]] = np.frombuffer(b'TAA', dtype=np.uint8)
+        sequences.append(sequence.tobytes())
+        names.append(f'tx{i}|gene{i}|UTR5:1-{utr5[i]}|CDS:{utr5[i] + 1}-{utr5[i] + cds[i]}|'
+                     f'UTR3:{utr5[i] + cds[i] + 1}-{utr5[i] + cds[i] + utr3[i]}|')
+
+    return {
+        'name': names,
+        'sequence': sequences,
+        'cds_start': utr5,
+        'cds_end': utr5 + cds,
+        'length': utr5 + cds + utr3,
+    }
+
+
+def draw_footprints(transcriptome: dict, num_reads: int, rng, frame_bias=0.7, cds_fraction=0.9,
+                    duplication=0.2, start_peak=0.05) -> dict:
+    '''
+    draw footprints from a transcriptome
+
+    outputs:
+        dictionary of arrays per read: transcript index, five_prime (0 based) and length
+    '''
+    num_transcripts = len(transcriptome['name'])
+    weights = rng.lognormal(0, 1.5, size=num_transcripts)
+    lengths_available = np.array(list(READ_LENGTHS))
+    length_weights = np.array(list(READ_LENGTHS.values()))
+
+    # distinct reads, duplicates are filled in afterwards
+    transcript = rng.choice(num_transcripts, size=num_reads, p=weights / weights.sum())
+    length = rng.choice(lengths_available, size=num_reads, p=length_weights / length_weights.sum())
+    cds_start = transcriptome['cds_start'][transcript]
+    cds_end = transcriptome['cds_end'][transcript]
+    tx_length = transcriptome['length'][transcript]
+
+    in_cds = rng.random(num_reads) < cds_fraction
+    codon = (rng.random(num_reads) * ((cds_end - cds_start) // 3)).astype(np.int64)
+    frame = np.where(rng.random(num_reads) < frame_bias, 0, rng.integers(1, 3, size=num_reads))
+    initiating = rng.random(num_reads) < start_peak
+    codon[initiating] = 0
+    frame[initiating] = 0
+    psite = np.where(in_cds, cds_start + codon * 3 + frame, 0)
+
+    # utr p-sites are uniform over both UTRs
+    utr_length = cds_start + tx_length - cds_end
+    utr_position = (rng.random(num_reads) * utr_length).astype(np.int64)
+    psite = np.where(in_cds, psite, np.where(utr_position < cds_start, utr_position, utr_position - cds_start + cds_end))
+
+    # keep every footprint inside its transcript
+    five_prime = np.clip(psite - PSITE_OFFSET, 0, tx_length - length)
+
+    duplicate = rng.random(num_reads) < duplication
+    duplicate[0] = False
+    source = np.where(duplicate, (rng.random(num_reads) * np.arange(num_reads)).astype(np.int64), np.arange(num_reads))
+    # follow chains of duplicates back to an original read
+    while True:
+        resolved = source[source]
+        if np.array_equal(resolved, source):
+            break
+        source = resolved
+
+    return {'transcript': transcript[source], 'five_prime': five_prime[source], 'length': length[source]}
+
+
+def write_fasta(transcriptome: dict, path: str) -> str:
+    with open(path, 'w') as f:
+        for name, sequence in zip(transcriptome['name'], transcriptome['sequence']):
+            f.write(f'>{name}\n')
+            for start in range(0, len(sequence), 60):
+                f.write(sequence[start:start + 60].decode() + '\n')
+    pysam.faidx(path)
+    return path
+
+
+def write_fastq(transcriptome: dict, footprints: dict, path: str) -> str:
+    sequences = transcriptome['sequence']
+    with gzip.open(path, 'wt', compresslevel=1) as f:
+        for i, (transcript, five_prime, length) in enumerate(zip(footprints['transcript'], footprints['five_prime'], footprints['length'])):
+            sequence = sequences[transcript][five_prime:five_prime + length].decode()
+            f.write(f'@read{i}\n{sequence}\n+\n{"I" * length}\n')
+    return path
+
+
+def unique_footprints(footprints: dict):
+    '''
+    (transcript, five_prime, length) rows with their read counts, sorted by transcript and position
+    '''
+    keys = np.stack([footprints['transcript'], footprints['five_prime'], footprints['length']], axis=1)
+    unique, counts = np.unique(keys, axis=0, return_counts=True)
+    return unique, counts
+
+
+def write_bam(transcriptome: dict, footprints: dict, path: str) -> str:
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': name, 'LN': int(length)} for name, length in zip(transcriptome['name'], transcriptome['length'])]}
+    unique, counts = unique_footprints(footprints)
+    sequences = transcriptome['sequence']
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for i, ((transcript, five_prime, length), count) in enumerate(zip(unique, counts)):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f'read{i}_x{count}'
+            read.query_sequence = sequences[transcript][five_prime:five_prime + length].decode()
+            read.flag = 0
+            read.reference_id = int(transcript)
+            read.reference_start = int(five_prime)
+            read.mapping_quality = 255
+            read.cigarstring = f'{length}M'
+            read.query_qualities = pysam.qualitystring_to_array('I' * int(length))
+            bam.write(read)
+    pysam.index(path)
+    return path
+
+
+def write_bed(transcriptome: dict, footprints: dict, path: str) -> str:
+    names = np.array(transcriptome['name'], dtype=object)
+    asite = footprints['five_prime'] + BED_OFFSET
+    keys = np.stack([footprints['transcript'], asite], axis=1)
+    unique, counts = np.unique(keys, axis=0, return_counts=True)
+
+    # references by name, as generate_profile visits them
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[np.argsort(names, kind='stable')] = np.arange(len(names))
+    order = np.lexsort((unique[:, 1], rank[unique[:, 0]]))
+    with open(path, 'w') as f:
+        for (transcript, position), count in zip(unique[order], counts[order]):
+            f.write(f'{names[transcript]}\t{position}\t{position + 1}\t{count}\n')
+    return path
+
+
+def generate(output_dir: str, num_transcripts=1000, num_reads=1000000, frame_bias=0.7, cds_fraction=0.9,
+             duplication=0.2, start_peak=0.05, seed=0, formats=FORMATS) -> dict:
+    '''
+    generate a synthetic data set into output_dir
+
+    outputs:
+        {format: path} for every requested format
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    transcriptome = make_transcriptome(num_transcripts, rng)
+    footprints = draw_footprints(transcriptome, num_reads, rng, frame_bias, cds_fraction, duplication, start_peak)
+
+    writers = {
+        'fasta': (write_fasta, 'transcripts.fa'),
+        'fastq': (write_fastq, 'reads.fq.gz'),
+        'bam': (write_bam, 'alignments.bam'),
+        'bed': (write_bed, 'profile.bed'),
+    }
+    paths = {}
+    for data_format in formats:
+        writer, name = writers[data_format]
+        if data_format == 'fasta':
+            paths[data_format] = writer(transcriptome, os.path.join(output_dir, name))
+        else:
+            paths[data_format] = writer(transcriptome, footprints, os.path.join(output_dir, name))
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Ribo-seq data set')
+    parser.add_argument('--output', help='output directory')
+    parser.add_argument('--transcripts', type=int, default=1000, help='number of transcripts')
+    parser.add_argument('--reads', type=int, default=1000000, help='number of reads')
+    parser.add_argument('--frame-bias', type=float, default=0.7, help='fraction of CDS p-sites in frame 0')
+    parser.add_argument('--cds-fraction', type=float, default=0.9, help='fraction of reads with the p-site in the CDS')
+    parser.add_argument('--duplication', type=float, default=0.2, help='fraction of reads that duplicate an earlier read')
+    parser.add_argument('--start-peak', type=float, default=0.05, help='fraction of CDS reads with the p-site on the start codon')
+    parser.add_argument('--formats', nargs='+', default=FORMATS, choices=FORMATS, help='files to write')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    for data_format, path in generate(args.output, args.transcripts, args.reads, args.frame_bias, args.cds_fraction,
+                                      args.duplication, args.start_peak, args.seed, args.formats).items():
+        print(f'{data_format}: {path}')
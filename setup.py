@@ -3,5 +3,5 @@ from setuptools import setup, find_packages
 setup(
     name='Periodicity-checker',
     version='0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
 )
\ No newline at end of file